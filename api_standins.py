@@ -0,0 +1,294 @@
+import threading
+import time
+import uuid
+
+import embedders
+import rate_limit
+
+# In-process stand-ins for the Gmail and Gemini clients, used by
+# benchmark.py. They answer the same calls the pipeline makes (and
+# nothing more) from a synthetic_mailbox.SyntheticMailbox, with
+# configurable latency and rate limits. Throttled calls raise the same
+# error types as the real clients, so the pipeline's retry logic runs
+# unchanged. For Gemini embeddings over HTTP see embed_standin_server.py.
+
+# --- Configuration ---
+
+# 1. Gmail quota units per call (https://developers.google.com/gmail/api/reference/quota)
+GMAIL_UNITS = {
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.send": 100,
+    "history.list": 2,
+    "getProfile": 1,
+}
+
+# 2. Largest messages().list page, like the real API
+MAX_LIST_PAGE_SIZE = 500
+
+
+class CallStats:
+    """
+    Thread-safe per-call latency samples (seconds) of accepted calls, and
+    counts of calls rejected by the rate limits.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.throttled = {}
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+    def record_throttled(self, name):
+        with self.lock:
+            self.throttled[name] = self.throttled.get(name, 0) + 1
+
+
+def make_limiter(per_second):
+    # None means unlimited; one second of burst, like the real quotas
+    if not per_second:
+        return None
+    return rate_limit.TokenBucket(per_second, capacity=max(1.0, per_second))
+
+def gmail_http_error(status, reason):
+    from googleapiclient.errors import HttpError
+    import httplib2
+    return HttpError(httplib2.Response({'status': status}), reason.encode('utf-8'))
+
+def resource_exhausted(message):
+    from google.api_core import exceptions as google_exceptions
+    return google_exceptions.ResourceExhausted(message)
+
+
+class StandInRequest:
+    """
+    One pending Gmail call; execute() runs it like an HttpRequest.
+    """
+
+    def __init__(self, service, name, func):
+        self.service = service
+        self.name = name
+        self.func = func
+
+    def execute(self):
+        return self.service._call(self.name, self.func)
+
+
+class StandInBatch:
+    """
+    Gmail batch request: one round trip of latency for up to 100 calls,
+    each still charged against the quota and answered through the callback.
+    """
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request, request_id or str(len(self.requests))))
+
+    def execute(self):
+        started = time.perf_counter()
+        self.service._wait()
+        for request, request_id in self.requests:
+            try:
+                response = self.service._charge(request.name, request.func)
+            except Exception as e:
+                self.callback(request_id, None, e)
+            else:
+                self.callback(request_id, response, None)
+        self.service.stats.record("batch", time.perf_counter() - started)
+
+
+class StandInGmailService:
+    """
+    Mimics the parts of the googleapiclient Gmail service the pipeline
+    uses: users().getProfile, users().messages().list/get/send,
+    users().history().list and new_batch_http_request. Every call sleeps
+    'latency' seconds; with units_per_second set, calls over the per-user
+    quota fail with HTTP 429. Sent messages are kept in 'sent'.
+    """
+
+    def __init__(self, mailbox, latency=0.0, units_per_second=0, stats=None):
+        self.mailbox = mailbox
+        self.latency = latency
+        self.limiter = make_limiter(units_per_second)
+        self.stats = stats or CallStats()
+        self.sent = []
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _charge(self, name, func):
+        if self.limiter is not None and not self.limiter.try_acquire(GMAIL_UNITS[name]):
+            self.stats.record_throttled(name)
+            raise gmail_http_error(429, "rateLimitExceeded (stand-in)")
+        return func()
+
+    def _call(self, name, func):
+        # Latency samples cover accepted calls; throttled ones are only counted
+        started = time.perf_counter()
+        self._wait()
+        result = self._charge(name, func)
+        self.stats.record(name, time.perf_counter() - started)
+        return result
+
+    # users() returns the service itself; the resource methods live here
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return StandInHistory(self)
+
+    def new_batch_http_request(self, callback=None):
+        return StandInBatch(self, callback)
+
+    def getProfile(self, userId='me'):
+        return StandInRequest(self, "getProfile", lambda: {
+            'emailAddress': "me@example.com",
+            'historyId': str(self.mailbox.size),
+        })
+
+    def list(self, userId='me', q=None, maxResults=100, pageToken=None, **kwargs):
+        def page():
+            start = int(pageToken or 0)
+            stop = start + min(maxResults, MAX_LIST_PAGE_SIZE)
+            result = {'messages': [{'id': msg_id, 'threadId': msg_id}
+                                   for msg_id in self.mailbox.ids(start, stop)]}
+            if stop < self.mailbox.size:
+                result['nextPageToken'] = str(stop)
+            return result
+        return StandInRequest(self, "messages.list", page)
+
+    def get(self, userId='me', id=None, format='raw'):
+        def fetch():
+            try:
+                return self.mailbox.get_raw(id)
+            except KeyError:
+                raise gmail_http_error(404, "Not Found")
+        return StandInRequest(self, "messages.get", fetch)
+
+    def send(self, userId='me', body=None):
+        def deliver():
+            self.sent.append(body)
+            return {'id': uuid.uuid4().hex[:16], 'labelIds': ['SENT']}
+        return StandInRequest(self, "messages.send", deliver)
+
+
+class StandInHistory:
+    """
+    history().list that always reports the checkpoint as expired (404),
+    so an incremental run falls back to a full listing of the mailbox.
+    """
+
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, **kwargs):
+        def expired():
+            raise gmail_http_error(404, "Requested entity was not found.")
+        return StandInRequest(self.service, "history.list", expired)
+
+
+class StandInCredentials:
+    """
+    Credentials placeholder for the concurrent fetch mode: build() below
+    returns the stand-in service it carries.
+    """
+
+    def __init__(self, service):
+        self.service = service
+
+def build(service_name, version, credentials=None, **kwargs):
+    """
+    Drop-in for googleapiclient.discovery.build with StandInCredentials.
+    """
+    return credentials.service
+
+
+class StandInResponse:
+
+    def __init__(self, text):
+        self.text = text
+
+
+class StandInGenerativeModel:
+
+    def __init__(self, genai, model_name, system_instruction=None):
+        self.genai = genai
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+
+    def generate_content(self, prompt, request_options=None, **kwargs):
+        def generate():
+            # Cheap deterministic text; prompt size is what costs time upstream
+            return StandInResponse(f"- Stand-in summary of a {len(prompt)} character prompt.")
+        return self.genai._call("generate_content", self.genai.generate_limiter,
+                                self.genai.generate_latency, generate)
+
+
+class StandInGenAI:
+    """
+    Mimics the google.generativeai module: configure(), embed_content()
+    (hashing vectors, like embed_standin_server.py) and GenerativeModel.
+    Calls over the requests-per-minute budgets raise ResourceExhausted.
+    """
+
+    def __init__(self, embed_latency=0.0, embed_rpm=0, generate_latency=0.0, generate_rpm=0,
+                 dim=embedders.LOCAL_EMBEDDING_DIM, stats=None):
+        self.embed_latency = embed_latency
+        self.generate_latency = generate_latency
+        self.embed_limiter = make_limiter(embed_rpm / 60.0)
+        self.generate_limiter = make_limiter(generate_rpm / 60.0)
+        self.dim = dim
+        self.stats = stats or CallStats()
+
+    def _call(self, name, limiter, latency, func):
+        if limiter is not None and not limiter.try_acquire():
+            self.stats.record_throttled(name)
+            raise resource_exhausted("Quota exceeded (stand-in)")
+        started = time.perf_counter()
+        if latency:
+            time.sleep(latency)
+        result = func()
+        self.stats.record(name, time.perf_counter() - started)
+        return result
+
+    def configure(self, api_key=None, **kwargs):
+        pass
+
+    def embed_content(self, model, content, task_type=None, output_dimensionality=None, **kwargs):
+        dim = output_dimensionality or self.dim
+
+        def embed():
+            if isinstance(content, str):
+                return {'embedding': embedders.hashing_vector(content, dim)}
+            return {'embedding': [embedders.hashing_vector(text, dim) for text in content]}
+        return self._call("embed_content", self.embed_limiter, self.embed_latency, embed)
+
+    def GenerativeModel(self, model_name, system_instruction=None, **kwargs):
+        return StandInGenerativeModel(self, model_name, system_instruction)
+
+
+class StandInGeminiEmbedder(embedders.GeminiEmbedder):
+    """
+    The regular Gemini SDK embedder, wired to a StandInGenAI instead of
+    google.generativeai.
+    """
+
+    hashing_vectors = True
+
+    def __init__(self, genai, model, output_dimensionality=embedders.OUTPUT_DIMENSIONALITY):
+        self.genai = genai
+        self.api_key = "stand-in"
+        self.model = model
+        self.output_dimensionality = output_dimensionality
+        self.model_name = embedders.space_name(model, output_dimensionality)
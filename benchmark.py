@@ -0,0 +1,389 @@
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import api_standins
+import embed_standin_server
+import embedders
+import metrics
+import synthetic_mailbox
+import vector_store
+
+# The phase modules (and chromadb) are imported in the phase worker, so
+# each phase's peak RSS only counts what that phase loads.
+
+# --- Configuration ---
+
+# 1. Mailbox sizes benchmarked by default (each gets a fresh working directory)
+DEFAULT_SIZES = [1000]
+
+# 2. Phases, in pipeline order; each runs in its own process
+PHASES = ("fetch", "index", "generate", "send")
+
+# 3. Default stand-in latencies (milliseconds per call or batch round trip)
+GMAIL_LATENCY_MS = 20
+EMBED_LATENCY_MS = 50
+GENERATE_LATENCY_MS = 800
+
+# 4. Default stand-in rate limits (0 = unlimited)
+GMAIL_UNITS_PER_SECOND = 0
+EMBED_RPM = 0
+GENERATE_RPM = 0
+
+# 5. Results file, to compare across commits with --compare
+OUTPUT_FILE = "benchmark_results.json"
+
+# Call whose latency is reported as the phase's p50/p99
+PHASE_CALLS = {
+    "fetch": "batch",
+    "index": "embed_content",
+    "generate": "generate_content",
+    "send": "messages.send",
+}
+
+
+class TimedEmbedder(embedders.Embedder):
+    """
+    Wraps an embedder and records each embed() call in a CallStats, for
+    backends the in-process stand-ins do not see (embed_standin_server).
+    """
+
+    def __init__(self, embedder, stats):
+        self.embedder = embedder
+        self.stats = stats
+        self.model_name = embedder.model_name
+        self.rate_limited = embedder.rate_limited
+        # embed_standin_server answers with hashing vectors
+        self.hashing_vectors = True
+
+    def embed(self, texts, task_type):
+        started = time.perf_counter()
+        try:
+            return self.embedder.embed(texts, task_type)
+        finally:
+            self.stats.record("embed_content", time.perf_counter() - started)
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a non-empty list
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+def summarize_calls(stats):
+    """
+    Per-call count, throttled count and p50/p99 latency in milliseconds.
+    """
+    calls = {}
+    for name in set(stats.latencies) | set(stats.throttled):
+        samples = stats.latencies.get(name)
+        calls[name] = {
+            'count': len(samples or ()),
+            'throttled': stats.throttled.get(name, 0),
+            'p50_ms': round(percentile(samples, 0.50) * 1000, 2) if samples else None,
+            'p99_ms': round(percentile(samples, 0.99) * 1000, 2) if samples else None,
+        }
+    return calls
+
+def peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def directory_mb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return round(total / 1e6, 2)
+
+def count_rows(query):
+    conn = sqlite3.connect("my_emails.db")
+    try:
+        return conn.execute(query).fetchone()[0]
+    finally:
+        conn.close()
+
+def run_phase(phase, workdir, settings):
+    """
+    Runs one pipeline phase against the stand-ins, in workdir, and returns
+    its measurements. The phase's own output goes to <phase>.log there.
+    """
+    os.chdir(workdir)
+    stats = api_standins.CallStats()
+    mailbox = synthetic_mailbox.SyntheticMailbox(settings['messages'], settings['seed'],
+                                                 newest=settings['newest'])
+    gmail = api_standins.StandInGmailService(
+        mailbox, settings['gmail_latency_ms'] / 1000.0, settings['gmail_units_per_second'], stats
+    )
+    genai = api_standins.StandInGenAI(
+        settings['embed_latency_ms'] / 1000.0, settings['embed_rpm'],
+        settings['generate_latency_ms'] / 1000.0, settings['generate_rpm'], stats=stats
+    )
+
+    dims = settings['embedding_dimensionality']
+
+    def get_embedder(model):
+        if settings['embed_url']:
+            return TimedEmbedder(embedders.GeminiRestEmbedder(
+                "stand-in", model, settings['embed_url'], output_dimensionality=dims
+            ), stats)
+        return api_standins.StandInGeminiEmbedder(genai, model, dims)
+
+    def get_chroma_client():
+        return vector_store.get_client("email_vector_db", settings['vector_store'])
+
+    with open(f"{phase}.log", "w", encoding="utf-8") as log, contextlib.redirect_stdout(log):
+        started = time.perf_counter()
+        if phase == "fetch":
+            import gmail_fetcher
+            # The concurrent mode builds one service per thread from the credentials
+            gmail_fetcher.build = api_standins.build
+            ok = gmail_fetcher.run(gmail, api_standins.StandInCredentials(gmail), full=True,
+                                   max_messages=None, workers=settings['workers'])
+            elapsed = time.perf_counter() - started
+            items = count_rows("SELECT COUNT(*) FROM emails")
+        elif phase == "index":
+            import indexing
+            ok = indexing.run(get_embedder(indexing.EMBEDDING_MODEL), get_chroma_client())
+            elapsed = time.perf_counter() - started
+            items = count_rows("SELECT COUNT(*) FROM emails WHERE processed_for_rag = 1")
+        elif phase == "generate":
+            import report_generation
+            report_generation.genai = genai
+            report_filename = report_generation.run(
+                True, get_embedder(report_generation.EMBEDDING_MODEL), get_chroma_client()
+            )
+            elapsed = time.perf_counter() - started
+            ok = report_filename is not None
+            items = 0
+            if ok:
+                with open(report_filename, encoding="utf-8") as f:
+                    items = sum(1 for line in f if line.startswith("## "))
+        else:
+            import send_report
+            ok = send_report.run(gmail)
+            elapsed = time.perf_counter() - started
+            items = len(gmail.sent)
+        # The phase's own counters and spans, in workdir/metrics/
+        metrics.flush(phase)
+
+    calls = summarize_calls(stats)
+    store_mb = None
+    if phase == "index":
+        store_mb = directory_mb(vector_store.store_path("email_vector_db", settings['vector_store']))
+    main_call = "messages.get" if phase == "fetch" and settings['workers'] else PHASE_CALLS[phase]
+    return {
+        'ok': bool(ok),
+        'items': items,
+        'seconds': round(elapsed, 3),
+        'throughput_per_s': round(items / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'call': main_call,
+            'p50': calls.get(main_call, {}).get('p50_ms'),
+            'p99': calls.get(main_call, {}).get('p99_ms'),
+        },
+        'peak_rss_mb': peak_rss_mb(),
+        'store_mb': store_mb,
+        'calls': calls,
+    }
+
+def phase_worker(phase, workdir, settings, results):
+    # Process body: always report back, even when the phase raises
+    try:
+        results.put(run_phase(phase, workdir, settings))
+    except BaseException as e:
+        results.put({'ok': False, 'error': f"{type(e).__name__}: {e}",
+                     'traceback': traceback.format_exc()})
+
+def run_in_process(phase, workdir, settings):
+    """
+    Runs a phase in a fresh interpreter so its peak RSS is its own.
+    """
+    # The phase modules read the vector store settings from the
+    # environment when the new interpreter imports them
+    os.environ['VECTOR_STORE'] = settings['vector_store']
+    os.environ['VECTOR_STORE_DTYPE'] = settings['vector_dtype']
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=phase_worker, args=(phase, workdir, settings, results))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=1.0)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                result = {'ok': False, 'error': f"phase process exited with code {process.exitcode}"}
+                break
+    process.join()
+    return result
+
+def run_benchmark(sizes, phases, settings, workdir):
+    """
+    Runs the selected phases in order for each mailbox size. Later phases
+    are skipped for a size once one fails. Returns the list of runs.
+    """
+    runs = []
+    for size in sizes:
+        size_dir = os.path.join(workdir, f"messages_{size}")
+        os.makedirs(size_dir, exist_ok=True)
+        run_settings = dict(settings, messages=size)
+        print(f"\n--- Benchmarking {size} messages in {size_dir} ---")
+
+        results = {}
+        for phase in phases:
+            result = run_in_process(phase, size_dir, run_settings)
+            results[phase] = result
+            if not result['ok']:
+                print(f"  > {phase}: FAILED ({result.get('error', f'see {phase}.log')})")
+                break
+            latency = result['latency_ms']
+            print(f"  > {phase}: {result['items']} items in {result['seconds']:.1f}s "
+                  f"({result['throughput_per_s']}/s), {latency['call']} "
+                  f"p50 {latency['p50']} ms / p99 {latency['p99']} ms, "
+                  f"peak RSS {result['peak_rss_mb']} MB"
+                  + (f", vector store {result['store_mb']} MB" if result.get('store_mb') is not None else ""))
+        runs.append({'messages': size, 'phases': results})
+    return runs
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_file):
+    """
+    Prints throughput and p99 changes against an earlier results file.
+    """
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = json.load(f)
+    before = {(run['messages'], phase): result
+              for run in baseline['runs'] for phase, result in run['phases'].items()}
+
+    print(f"\nCompared with {baseline_file} (commit {baseline.get('commit')}):")
+    for run in results['runs']:
+        for phase, result in run['phases'].items():
+            old = before.get((run['messages'], phase))
+            if not old or not old.get('ok') or not result.get('ok'):
+                continue
+            speedup = result['throughput_per_s'] / old['throughput_per_s'] if old['throughput_per_s'] else 0
+            print(f"  > {run['messages']} messages, {phase}: throughput x{speedup:.2f}, "
+                  f"p99 {old['latency_ms']['p99']} -> {result['latency_ms']['p99']} ms, "
+                  f"peak RSS {old['peak_rss_mb']} -> {result['peak_rss_mb']} MB")
+
+def parse_phases(value):
+    phases = [phase.strip() for phase in value.split(',') if phase.strip()]
+    unknown = [phase for phase in phases if phase not in PHASES]
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            f"unknown phase(s) {', '.join(unknown)}; choose from {', '.join(PHASES)}"
+        )
+    return [phase for phase in PHASES if phase in phases]
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline offline against a synthetic mailbox and API stand-ins."
+    )
+    parser.add_argument('--messages', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="Mailbox sizes to benchmark, e.g. --messages 1000 10000 100000.")
+    parser.add_argument('--phases', type=parse_phases, default=list(PHASES),
+                        help=f"Comma-separated phases (default: {','.join(PHASES)}).")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=0,
+                        help="fetch: concurrent fetch threads (0 = batch endpoint).")
+    parser.add_argument('--gmail-latency-ms', type=float, default=GMAIL_LATENCY_MS)
+    parser.add_argument('--gmail-units-per-second', type=float, default=GMAIL_UNITS_PER_SECOND,
+                        help="Gmail quota units per second before HTTP 429 (0 = unlimited).")
+    parser.add_argument('--embed-latency-ms', type=float, default=EMBED_LATENCY_MS)
+    parser.add_argument('--embed-rpm', type=int, default=EMBED_RPM)
+    parser.add_argument('--generate-latency-ms', type=float, default=GENERATE_LATENCY_MS)
+    parser.add_argument('--generate-rpm', type=int, default=GENERATE_RPM)
+    parser.add_argument('--embed-transport', choices=("sdk", "rest"), default="sdk",
+                        help="sdk: in-process stand-in; rest: embed_standin_server over HTTP.")
+    parser.add_argument('--vector-store', choices=("chroma", "memmap"),
+                        default=vector_store.VECTOR_STORE_BACKEND)
+    parser.add_argument('--vector-dtype', choices=("float16", "int8"), default=vector_store.MEMMAP_DTYPE,
+                        help="memmap: how vectors are stored.")
+    parser.add_argument('--embedding-dimensionality', type=int,
+                        default=embedders.OUTPUT_DIMENSIONALITY,
+                        help="Request reduced-size embeddings (output_dimensionality).")
+    parser.add_argument('--workdir', help="Where to keep the databases (default: a temp directory).")
+    parser.add_argument('--keep', action='store_true', help="Keep the working directory afterwards.")
+    parser.add_argument('--output', default=OUTPUT_FILE)
+    parser.add_argument('--compare', metavar='BASELINE_JSON',
+                        help="Print changes against an earlier results file.")
+    return parser.parse_args()
+
+def main():
+    """
+    Runs the benchmark scenarios and writes the results as JSON.
+    """
+    args = parse_args()
+    settings = {
+        'seed': args.seed,
+        'workers': args.workers,
+        'gmail_latency_ms': args.gmail_latency_ms,
+        'gmail_units_per_second': args.gmail_units_per_second,
+        'embed_latency_ms': args.embed_latency_ms,
+        'embed_rpm': args.embed_rpm,
+        'generate_latency_ms': args.generate_latency_ms,
+        'generate_rpm': args.generate_rpm,
+        'embed_transport': args.embed_transport,
+        'embed_url': None,
+        'vector_store': args.vector_store,
+        'vector_dtype': args.vector_dtype,
+        'embedding_dimensionality': args.embedding_dimensionality,
+        # Every phase sees the same mailbox, inside the report window
+        'newest': datetime.datetime.now(datetime.timezone.utc),
+    }
+
+    server = None
+    if args.embed_transport == "rest":
+        server, _ = embed_standin_server.start_server(
+            port=0, latency=args.embed_latency_ms / 1000.0, requests_per_minute=args.embed_rpm
+        )
+        host, port = server.server_address[:2]
+        settings['embed_url'] = f"http://{host}:{port}"
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="rag_benchmark_"))
+    try:
+        runs = run_benchmark(args.messages, args.phases, settings, workdir)
+    finally:
+        if server is not None:
+            server.shutdown()
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        'created_at': datetime.datetime.now().isoformat(' ', 'seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': dict(settings, newest=settings['newest'].isoformat()),
+        'runs': runs,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}.")
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import math
+import re
+from collections import Counter
+
+import near_dedup
+
+# --- Configuration ---
+
+# 1. Prompt tokens available for the retrieved context of one section
+CONTEXT_TOKEN_BUDGET = 2000
+
+# 2. Rough characters per token, used to estimate chunk sizes without an
+# API call
+CHARS_PER_TOKEN = 4
+
+# 3. Maximal marginal relevance trade-off: 1.0 ranks purely by relevance,
+# lower values favour chunks unlike the ones already picked
+MMR_LAMBDA = 0.7
+
+# 4. Chunks allowed from any single email
+MAX_CHUNKS_PER_EMAIL = 1
+
+WORD_RE = re.compile(r"\w+")
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+def term_vector(text):
+    """
+    Lowercase word counts of a text and their L2 norm.
+    """
+    counts = Counter(WORD_RE.findall(text.lower()))
+    return counts, math.sqrt(sum(c * c for c in counts.values()))
+
+def cosine(a, b):
+    (counts_a, norm_a), (counts_b, norm_b) = a, b
+    if not norm_a or not norm_b:
+        return 0.0
+    if len(counts_a) > len(counts_b):
+        counts_a, counts_b = counts_b, counts_a
+    return sum(c * counts_b.get(word, 0) for word, c in counts_a.items()) / (norm_a * norm_b)
+
+def truncate_to_budget(text, tokens):
+    return text[:tokens * CHARS_PER_TOKEN].rsplit(' ', 1)[0] + " ..."
+
+def drop_redundant(candidates, max_per_email=MAX_CHUNKS_PER_EMAIL):
+    """
+    Keeps candidates in order, dropping those beyond max_per_email for
+    their email and those whose text is a near-duplicate (SimHash) of a
+    candidate already kept.
+    """
+    kept = []
+    per_email = Counter()
+    fingerprints = []
+    for hit in candidates:
+        if per_email[hit['email_id']] >= max_per_email:
+            continue
+        fingerprint = near_dedup.simhash(hit['text'])
+        if any(bin(fingerprint ^ other).count('1') <= near_dedup.MAX_HAMMING_DISTANCE
+               for other in fingerprints):
+            continue
+        per_email[hit['email_id']] += 1
+        fingerprints.append(fingerprint)
+        kept.append(hit)
+    return kept
+
+def build_context(candidates, token_budget=CONTEXT_TOKEN_BUDGET, mmr_lambda=MMR_LAMBDA,
+                  max_per_email=MAX_CHUNKS_PER_EMAIL):
+    """
+    Picks the context for one section from scored candidate hits (each with
+    a 'score', best first). Redundant candidates are dropped, the rest are
+    reranked with maximal marginal relevance, and chunks are added until
+    the token budget is used up, so the number of chunks adapts to their
+    size rather than being fixed.
+    Returns the chosen hits in selection order.
+    """
+    candidates = drop_redundant(candidates, max_per_email)
+    if not candidates:
+        return []
+
+    top_score = max(hit['score'] for hit in candidates) or 1.0
+    vectors = [term_vector(hit['text']) for hit in candidates]
+    # Highest similarity of each candidate to anything selected so far
+    max_similarity = [0.0] * len(candidates)
+    remaining = set(range(len(candidates)))
+
+    selected = []
+    used_tokens = 0
+    while remaining and used_tokens < token_budget:
+        best = max(
+            remaining,
+            key=lambda i: (mmr_lambda * candidates[i]['score'] / top_score
+                           - (1 - mmr_lambda) * max_similarity[i], -i)
+        )
+        remaining.discard(best)
+
+        hit = candidates[best]
+        tokens = estimate_tokens(hit['text'])
+        if used_tokens + tokens > token_budget:
+            if selected:
+                # Too big for what is left; a smaller candidate may still fit
+                continue
+            # Never return an empty context just because the best chunk is long
+            hit = dict(hit, text=truncate_to_budget(hit['text'], token_budget))
+            tokens = token_budget
+
+        selected.append(hit)
+        used_tokens += tokens
+        for i in remaining:
+            max_similarity[i] = max(max_similarity[i], cosine(vectors[i], vectors[best]))
+    return selected
+
+def pack_groups(candidates, token_budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Splits candidates, in order, into consecutive groups that each fit
+    token_budget (a chunk larger than the budget is truncated and goes
+    alone). Used to summarize large candidate sets piece by piece.
+    """
+    groups = []
+    group = []
+    used_tokens = 0
+    for hit in candidates:
+        tokens = estimate_tokens(hit['text'])
+        if tokens > token_budget:
+            hit = dict(hit, text=truncate_to_budget(hit['text'], token_budget))
+            tokens = token_budget
+        if group and used_tokens + tokens > token_budget:
+            groups.append(group)
+            group = []
+            used_tokens = 0
+        group.append(hit)
+        used_tokens += tokens
+    if group:
+        groups.append(group)
+    return groups
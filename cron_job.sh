@@ -33,25 +33,20 @@ echo "Attempting to change directory to $PROJECT_DIR..."
 cd $PROJECT_DIR
 echo "Script is now running in directory: $(pwd)"
 
-# 4. NEW: CLEAR OLD DATABASES FOR A FRESH DAILY RUN
-echo "Clearing old databases (my_emails.db and email_vector_db/)..."
-rm -f my_emails.db
-rm -rf email_vector_db/
-echo "Old databases cleared."
-
-# 5. RUN THE SCRIPTS IN ORDER
-# (Your filenames are correct, I am using them as you provided)
-echo "Running Phase 1: Fetcher..."
-$PYTHON_EXE gmail_fetcher.py
-
-echo "Running Phase 2: Indexing..."
-$PYTHON_EXE indexing.py
-
-echo "Running Phase 3: Generation..."
-$PYTHON_EXE report_generation.py
-
-echo "Running Phase 4: Sending Email..."
-$PYTHON_EXE send_report.py
+# 4. NIGHTLY MAINTENANCE (in place of deleting the databases)
+# Expires emails older than the retention window, rebuilds the vector
+# collection when enough of it has been deleted and vacuums the SQLite
+# files. The fetch phase then only
+# pulls messages added since the last run.
+echo "Running maintenance (retention, compaction)..."
+$PYTHON_EXE maintenance.py
+
+# 5. RUN ALL FOUR PHASES IN ONE PROCESS
+# pipeline.py runs fetch -> index -> generate -> send, sharing the Gmail,
+# Gemini and Chroma clients, and stops at the first phase that fails.
+# After a failure, rerun with --resume to continue from that phase.
+echo "Running the pipeline (fetch, index, generate, send)..."
+$PYTHON_EXE pipeline.py
 
 echo "--- Pipeline finished at $(date) ---"
 echo ""
@@ -0,0 +1,241 @@
+import math
+
+# --- Configuration ---
+
+# 1. Labels assigned at index time. Each report section searches only the
+# emails carrying its label.
+CATEGORIES = ("jobs", "banking", "linkedin", "rent_utilities", "other")
+
+# 2. Sender-domain rules, checked first. A rule also matches subdomains
+# (e.g. "chase.com" matches "alerts.chase.com").
+SENDER_DOMAIN_RULES = {
+    "linkedin.com": "linkedin",
+    "greenhouse.io": "jobs",
+    "lever.co": "jobs",
+    "myworkday.com": "jobs",
+    "workday.com": "jobs",
+    "smartrecruiters.com": "jobs",
+    "icims.com": "jobs",
+    "ashbyhq.com": "jobs",
+    "jobvite.com": "jobs",
+    "hackerrank.com": "jobs",
+    "codesignal.com": "jobs",
+    "handshake.com": "jobs",
+    "joinhandshake.com": "jobs",
+    "chase.com": "banking",
+    "bankofamerica.com": "banking",
+    "wellsfargo.com": "banking",
+    "capitalone.com": "banking",
+    "citi.com": "banking",
+    "discover.com": "banking",
+    "americanexpress.com": "banking",
+    "usbank.com": "banking",
+    "pnc.com": "banking",
+    "appfolio.com": "rent_utilities",
+    "buildium.com": "rent_utilities",
+    "rentcafe.com": "rent_utilities",
+    "yardi.com": "rent_utilities",
+    "coned.com": "rent_utilities",
+    "pge.com": "rent_utilities",
+    "duke-energy.com": "rent_utilities",
+    "xfinity.com": "rent_utilities",
+    "comcast.net": "rent_utilities",
+    "spectrum.net": "rent_utilities",
+}
+
+# 3. Short descriptions embedded once to form each category's centroid.
+# Emails no rule covers go to the closest centroid.
+CATEGORY_DESCRIPTIONS = {
+    "jobs": [
+        "Thank you for applying. Your job application has been received.",
+        "You are invited to complete an online assessment for the software engineer role.",
+        "We would like to schedule an interview with you for the internship position.",
+        "Unfortunately we have decided not to move forward with your application.",
+        "We are pleased to extend you an offer of employment.",
+    ],
+    "banking": [
+        "Your monthly bank account statement is now available.",
+        "A transaction on your credit card exceeded your alert amount.",
+        "Low balance alert: your checking account balance is below your threshold.",
+        "Security alert: a new device signed in to your online banking.",
+    ],
+    "linkedin": [
+        "You have a new message on LinkedIn.",
+        "A recruiter wants to connect with you on LinkedIn.",
+        "You appeared in search results and people viewed your LinkedIn profile.",
+    ],
+    "rent_utilities": [
+        "Your rent payment is due on the first of the month.",
+        "Your electricity bill is ready. Amount due and payment due date.",
+        "Your internet service bill is available; autopay is scheduled.",
+        "Reminder from your property management office about your lease renewal.",
+    ],
+}
+
+# 4. Minimum cosine similarity to the closest centroid; below it an email
+# is labelled "other". Similarities depend on the embedding model: the
+# first is tuned for text-embedding-004, the second for the local hashing
+# vectorizer (the "local" backend and the benchmark stand-ins).
+MIN_CENTROID_SIMILARITY = 0.5
+HASHING_MIN_CENTROID_SIMILARITY = 0.2
+
+# 5. Emails whose probe chunk is embedded together when classifying
+CLASSIFY_BATCH_SIZE = 100
+
+
+def rule_category(sender_domain):
+    """
+    Returns the category a sender domain (or a parent domain) maps to, or None.
+    """
+    parts = (sender_domain or '').lower().split('.')
+    for i in range(len(parts) - 1):
+        category = SENDER_DOMAIN_RULES.get('.'.join(parts[i:]))
+        if category is not None:
+            return category
+    return None
+
+def normalize(vector):
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector] if norm else list(vector)
+
+def dot(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+
+class EmailClassifier:
+    """
+    Labels each email once, at index time, with one of CATEGORIES.
+
+    Sender-domain rules are tried first and cost nothing. Remaining emails
+    are buffered, and the first of their chunks that survived
+    near-duplicate collapsing (the 'probe') is embedded in one batched
+    call; each goes to the nearest category centroid. The probe's vector is
+    left on the chunk ('embedding') for the EmbeddingScheduler to store, so
+    this step adds no embedding calls or cache lookups overall. An email
+    with no surviving chunk takes the label of the chunk its first chunk
+    collapsed into: from this run, or through category_of(vector_id) for
+    one stored earlier.
+    """
+
+    def __init__(self, embedder, cache=None, limiter=None, batch_size=CLASSIFY_BATCH_SIZE,
+                 category_of=None):
+        self.embedder = embedder
+        self.cache = cache
+        self.limiter = limiter
+        self.batch_size = batch_size
+        self.category_of = category_of
+        self.min_similarity = (HASHING_MIN_CENTROID_SIMILARITY if embedder.hashing_vectors
+                               else MIN_CENTROID_SIMILARITY)
+        self.centroids = None
+        self.buffer = []
+        self.labels = {}
+        self.vector_labels = {}
+        self.by_rule = 0
+        self.by_centroid = 0
+        self.by_duplicate = 0
+
+    def add(self, email_id, sender_domain, chunks, probe=None):
+        """
+        Offers one email for labelling; probe is its chunk to embed, or None
+        if every chunk collapsed into an existing one. Returns a list of
+        (email_id, chunks, category) for every email that is now labelled;
+        rule matches come back at once, the rest once a batch fills up.
+        """
+        category = rule_category(sender_domain)
+        if category is None and not chunks:
+            category = "other"
+        if category is not None:
+            if category != "other":
+                self.by_rule += 1
+            self._label(email_id, chunks, category)
+            return [(email_id, chunks, category)]
+
+        self.buffer.append((email_id, chunks, probe))
+        if len(self.buffer) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        Labels every buffered email by centroid similarity, or by the label
+        of the chunk it collapsed into.
+        """
+        if not self.buffer:
+            return []
+        batch = self.buffer
+        self.buffer = []
+
+        probes = [probe for _, _, probe in batch if probe is not None]
+        try:
+            vectors = self._embed([probe['text'] for probe in probes]) if probes else []
+            for probe, vector in zip(probes, vectors):
+                probe['embedding'] = vector
+            centroids = self._get_centroids() if probes else None
+        except Exception as e:
+            print(f"  > ERROR classifying {len(probes)} emails, labelling them 'other': {e}")
+            vectors = None
+
+        ready = []
+        for email_id, chunks, probe in batch:
+            category = "other"
+            if probe is None:
+                category = self._duplicate_category(chunks[0]['vector_id'])
+            elif vectors is not None:
+                vector = normalize(probe['embedding'])
+                best, similarity = max(
+                    ((label, dot(vector, centroid)) for label, centroid in centroids.items()),
+                    key=lambda item: item[1]
+                )
+                if similarity >= self.min_similarity:
+                    category = best
+                    self.by_centroid += 1
+            self._label(email_id, chunks, category)
+            ready.append((email_id, chunks, category))
+        return ready
+
+    def _label(self, email_id, chunks, category):
+        self.labels[email_id] = category
+        for chunk in chunks:
+            self.vector_labels.setdefault(chunk['vector_id'], category)
+
+    def _duplicate_category(self, vector_id):
+        category = self.vector_labels.get(vector_id)
+        if category is None and self.category_of is not None:
+            category = self.category_of(vector_id)
+        if category is None:
+            return "other"
+        if category != "other":
+            self.by_duplicate += 1
+        return category
+
+    def _embed(self, texts, count=True):
+        vectors = [None] * len(texts)
+        if self.cache is not None:
+            vectors = self.cache.get_many(texts, self.embedder.model_name, "retrieval_document",
+                                          count=count)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            new_vectors = self.embedder.embed([texts[i] for i in missing], "retrieval_document")
+            for i, vector in zip(missing, new_vectors):
+                vectors[i] = vector
+            if self.cache is not None:
+                self.cache.put_many([texts[i] for i in missing], new_vectors,
+                                    self.embedder.model_name, "retrieval_document")
+        return vectors
+
+    def _get_centroids(self):
+        # Mean of each category's description vectors, computed once per run
+        if self.centroids is None:
+            labels = [label for label, texts in CATEGORY_DESCRIPTIONS.items() for _ in texts]
+            texts = [text for texts in CATEGORY_DESCRIPTIONS.values() for text in texts]
+            sums = {}
+            # Not chunk lookups, so left out of the cache hit rate
+            for label, vector in zip(labels, self._embed(texts, count=False)):
+                vector = normalize(vector)
+                total = sums.setdefault(label, [0.0] * len(vector))
+                for j, value in enumerate(vector):
+                    total[j] += value
+            self.centroids = {label: normalize(total) for label, total in sums.items()}
+        return self.centroids
@@ -0,0 +1,458 @@
+import datetime
+import hashlib
+import re
+import sqlite3
+from email.utils import parseaddr
+
+# --- Configuration ---
+
+# 1. Rows written per transaction by the bulk writer
+WRITE_BATCH_SIZE = 500
+
+# 2. IDs updated per transaction when marking emails as processed
+UPDATE_BATCH_SIZE = 500
+
+# 3. Unprocessed emails read per query by the indexing scan
+SCAN_PAGE_SIZE = 500
+
+# 4. Words ignored when turning a natural-language query into an FTS query
+FTS_STOPWORDS = {
+    'a', 'about', 'above', 'all', 'an', 'and', 'any', 'are', 'as', 'at', 'be',
+    'by', 'clear', 'did', 'do', 'does', 'for', 'from', 'i', 'in', 'include',
+    'is', 'it', 'items', 'key', 'list', 'look', 'me', 'my', 'new', 'not', 'of',
+    'on', 'or', 'other', 'receive', 'sections', 'summarize', 'the', 'them',
+    'there', 'these', 'this', 'to', 'what', 'with',
+}
+
+WORD_RE = re.compile(r"\w+")
+
+# New messages are inserted; a message already stored is only rewritten
+# (and queued for reindexing) when its body changed
+UPSERT_EMAIL_SQL = '''
+INSERT INTO emails (
+    gmail_id, from_sender, subject, body, received_at
+) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (gmail_id) DO UPDATE SET
+    from_sender = excluded.from_sender,
+    subject = excluded.subject,
+    body = excluded.body,
+    processed_for_rag = 0
+WHERE emails.body IS NOT excluded.body
+'''
+
+
+def connect(db_file):
+    """
+    Opens a connection tuned for bulk writes: WAL journaling, so readers
+    are not blocked, and NORMAL sync, which is safe under WAL.
+    """
+    conn = sqlite3.connect(db_file)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def to_epoch_seconds(received_at):
+    """
+    Converts a stored received_at value (datetime or the ISO string SQLite
+    returns) to integer epoch seconds. Returns 0 if it cannot be parsed.
+    """
+    if isinstance(received_at, datetime.datetime):
+        return int(received_at.timestamp())
+    try:
+        return int(datetime.datetime.fromisoformat(str(received_at)).timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+def body_hash(body):
+    """
+    SHA-256 of an email body, recorded when the email is indexed.
+    """
+    return hashlib.sha256((body or '').encode('utf-8')).hexdigest()
+
+def sender_address(from_sender):
+    """
+    Returns (address, domain) from a From header, lowercased; '' if missing.
+    """
+    address = parseaddr(from_sender or '')[1].lower()
+    domain = address.rsplit('@', 1)[1] if '@' in address else ''
+    return address, domain
+
+def add_sender_functions(conn):
+    """
+    Registers SENDER_ADDRESS(from_sender) and SENDER_DOMAIN(from_sender)
+    (see sender_address) on a connection, for the conditions built by
+    email_filter_sql.
+    """
+    conn.create_function("SENDER_ADDRESS", 1, lambda value: sender_address(value)[0],
+                         deterministic=True)
+    conn.create_function("SENDER_DOMAIN", 1, lambda value: sender_address(value)[1],
+                         deterministic=True)
+
+def add_column_if_missing(conn, table, column, definition):
+    """
+    Adds a column to an existing table (older databases predate it).
+    """
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        conn.commit()
+
+def setup_fts(conn):
+    """
+    Creates the 'emails_fts' FTS5 index over subject, sender and body,
+    plus triggers that keep it in sync with the 'emails' table.
+    Existing rows are indexed the first time the index is created.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'emails_fts'"
+    ).fetchone()
+
+    conn.executescript('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(
+        subject, from_sender, body,
+        content='emails', content_rowid='id',
+        tokenize='porter unicode61'
+    );
+
+    CREATE TRIGGER IF NOT EXISTS emails_fts_insert AFTER INSERT ON emails BEGIN
+        INSERT INTO emails_fts (rowid, subject, from_sender, body)
+        VALUES (new.id, new.subject, new.from_sender, new.body);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS emails_fts_delete AFTER DELETE ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, from_sender, body)
+        VALUES ('delete', old.id, old.subject, old.from_sender, old.body);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS emails_fts_update AFTER UPDATE OF subject, from_sender, body ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, from_sender, body)
+        VALUES ('delete', old.id, old.subject, old.from_sender, old.body);
+        INSERT INTO emails_fts (rowid, subject, from_sender, body)
+        VALUES (new.id, new.subject, new.from_sender, new.body);
+    END;
+    ''')
+
+    if not exists:
+        conn.execute("INSERT INTO emails_fts (emails_fts) VALUES ('rebuild')")
+    conn.commit()
+
+def setup_chunks(conn):
+    """
+    Creates the 'chunks' table (one row per chunk of an indexed email)
+    and the indexes behind the indexing scan: a partial index over the
+    unprocessed emails, so finding them does not scan the whole table,
+    and one on received_at for time-window queries and retention.
+    """
+    conn.executescript('''
+    CREATE TABLE IF NOT EXISTS chunks (
+        email_id INTEGER NOT NULL,
+        ordinal INTEGER NOT NULL,
+        text_hash TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        vector_id TEXT,
+        PRIMARY KEY (email_id, ordinal)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_chunks_vector_id ON chunks (vector_id);
+
+    CREATE INDEX IF NOT EXISTS idx_emails_unprocessed ON emails (id) WHERE processed_for_rag = 0;
+
+    CREATE INDEX IF NOT EXISTS idx_emails_received_at ON emails (received_at);
+    ''')
+    conn.commit()
+
+def to_fts_query(text):
+    """
+    Turns a natural-language question into an FTS5 OR-query of its
+    content words, each quoted so punctuation cannot break the syntax.
+    """
+    words = []
+    for word in WORD_RE.findall(text.lower()):
+        if word not in FTS_STOPWORDS and word not in words:
+            words.append(word)
+    return ' OR '.join(f'"{word}"' for word in words)
+
+def search_emails(db_file, query_text, k, since=None, until=None,
+                  senders=None, sender_domains=None, categories=None):
+    """
+    BM25 keyword search over the emails table.
+    since/until (epoch seconds), senders/sender_domains and categories
+    restrict the emails searched, matching the metadata filters of the
+    vector search.
+    Returns up to k hits, best first, as dictionaries with 'email_id',
+    'subject' and 'snippet' (the best-matching part of the body).
+    """
+    fts_query = to_fts_query(query_text)
+    if not fts_query:
+        return []
+
+    conditions, params = email_filter_sql(since, until, senders, sender_domains, categories)
+    conditions.insert(0, "emails_fts MATCH ?")
+    params.insert(0, fts_query)
+    params.append(k)
+
+    conn = sqlite3.connect(db_file)
+    add_sender_functions(conn)
+    try:
+        rows = conn.execute(f'''
+        SELECT emails_fts.rowid, e.subject, snippet(emails_fts, 2, '', '', ' ... ', 48)
+        FROM emails_fts
+        JOIN emails e ON e.id = emails_fts.rowid
+        WHERE {" AND ".join(conditions)}
+        ORDER BY bm25(emails_fts, 5.0, 2.0, 1.0)
+        LIMIT ?
+        ''', params).fetchall()
+    finally:
+        conn.close()
+
+    return [
+        {'email_id': email_id, 'subject': subject, 'snippet': snippet}
+        for email_id, subject, snippet in rows
+    ]
+
+def email_filter_sql(since=None, until=None, senders=None, sender_domains=None, categories=None):
+    """
+    SQL conditions on the emails table (aliased 'e') for the search
+    filters of search_emails. Senders and domains are compared exactly
+    with the address parsed from the From header, like the 'sender' and
+    'sender_domain' chunk metadata; the connection needs
+    add_sender_functions. Returns (conditions, params).
+    """
+    conditions = []
+    params = []
+    # received_at is stored as an ISO string, which sorts chronologically
+    if since is not None:
+        conditions.append("e.received_at >= ?")
+        params.append(datetime.datetime.fromtimestamp(since).isoformat(' '))
+    if until is not None:
+        conditions.append("e.received_at < ?")
+        params.append(datetime.datetime.fromtimestamp(until).isoformat(' '))
+    sender_conditions = []
+    if senders:
+        sender_conditions.append(f"SENDER_ADDRESS(e.from_sender) IN ({','.join('?' for _ in senders)})")
+        params.extend(address.lower() for address in senders)
+    if sender_domains:
+        sender_conditions.append(f"SENDER_DOMAIN(e.from_sender) IN ({','.join('?' for _ in sender_domains)})")
+        params.extend(domain.lower() for domain in sender_domains)
+    if sender_conditions:
+        conditions.append("(" + " OR ".join(sender_conditions) + ")")
+    if categories:
+        conditions.append(f"e.category IN ({','.join('?' for _ in categories)})")
+        params.extend(categories)
+    return conditions, params
+
+
+class EmailWriter:
+    """
+    Keeps one SQLite connection open for a whole run and inserts emails
+    with executemany inside batched transactions.
+
+    Use as a context manager; pending rows are flushed on exit.
+    After the run, 'inserted' holds the number of new rows plus stored
+    rows whose body changed, and 'skipped' the number of unchanged
+    duplicates (same gmail_id).
+    """
+
+    def __init__(self, db_file, batch_size=WRITE_BATCH_SIZE):
+        self.conn = connect(db_file)
+        self.batch_size = batch_size
+        self.pending = []
+        self.inserted = 0
+        self.skipped = 0
+
+    def add(self, email_data):
+        """
+        Queues a single email dictionary; writes a batch once enough are queued.
+        """
+        self.pending.append((
+            email_data['gmail_id'],
+            email_data['from'],
+            email_data['subject'],
+            email_data['body'],
+            email_data['received_at']
+        ))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all queued emails in one transaction.
+        Upserts on the UNIQUE gmail_id: unchanged duplicates are skipped,
+        changed bodies are rewritten and marked for reindexing.
+        """
+        if not self.pending:
+            return
+
+        with self.conn:
+            # rowcount, unlike total_changes, leaves out the FTS trigger writes
+            new_rows = self.conn.executemany(UPSERT_EMAIL_SQL, self.pending).rowcount
+
+        self.inserted += new_rows
+        self.skipped += len(self.pending) - new_rows
+        self.pending = []
+
+    def insert_returning_ids(self, emails):
+        """
+        Writes the given email dictionaries at once, in one transaction.
+        Returns one (id, indexed_hash) pair per email that was inserted or
+        whose body changed, and None for unchanged duplicates.
+        Used when the rows are needed right away, e.g. by the streaming indexer.
+        """
+        self.flush()
+        rows = []
+        with self.conn:
+            for email_data in emails:
+                rows.append(self.conn.execute(UPSERT_EMAIL_SQL + " RETURNING id, indexed_hash", (
+                    email_data['gmail_id'],
+                    email_data['from'],
+                    email_data['subject'],
+                    email_data['body'],
+                    email_data['received_at']
+                )).fetchone())
+
+        written = sum(1 for row in rows if row is not None)
+        self.inserted += written
+        self.skipped += len(rows) - written
+        return rows
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ChunkTable:
+    """
+    The 'chunks' table for one indexing run. Each chunk of an email
+    (email_id, ordinal) records the hash of its text, its embedding status
+    ('pending', 'stored' or 'failed') and the ID of the vector holding it:
+    its own, or the near-duplicate representative's it was collapsed into.
+    A chunk's status follows its vector, so collapsed chunks count as
+    stored once their representative is.
+    """
+
+    def __init__(self, db_file):
+        self.conn = connect(db_file)
+        setup_chunks(self.conn)
+
+    def get(self, email_id):
+        """
+        Returns {ordinal: (text_hash, status, vector_id)} for one email.
+        """
+        return {
+            ordinal: (text_hash, status, vector_id)
+            for ordinal, text_hash, status, vector_id in self.conn.execute(
+                "SELECT ordinal, text_hash, status, vector_id FROM chunks WHERE email_id = ?", (email_id,)
+            )
+        }
+
+    def put(self, email_id, rows):
+        """
+        Writes (ordinal, text_hash, status, vector_id) rows for one email.
+        """
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO chunks (email_id, ordinal, text_hash, status, vector_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(email_id,) + tuple(row) for row in rows]
+            )
+
+    def delete(self, email_id, ordinals):
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM chunks WHERE email_id = ? AND ordinal = ?",
+                [(email_id, ordinal) for ordinal in ordinals]
+            )
+
+    def set_status(self, vector_ids, status):
+        """
+        Moves every chunk held by the given vectors to 'stored', or its
+        pending chunks to 'failed'.
+        """
+        condition = "status != 'stored'" if status == "stored" else "status = 'pending'"
+        with self.conn:
+            self.conn.executemany(
+                f"UPDATE chunks SET status = ? WHERE vector_id = ? AND {condition}",
+                [(status, vector_id) for vector_id in vector_ids]
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+def iter_unprocessed_pages(db_file, page_size=SCAN_PAGE_SIZE):
+    """
+    Yields the unprocessed emails in pages of up to page_size rows, in ID
+    order. Each page is one keyset query (id > last ID seen) over the
+    partial index, so memory stays bounded and no read is held open
+    while a page is indexed.
+    """
+    last_id = 0
+    while True:
+        conn = sqlite3.connect(db_file)
+        conn.row_factory = sqlite3.Row
+        try:
+            page = conn.execute(
+                "SELECT id, from_sender, subject, body, received_at, indexed_hash FROM emails "
+                "WHERE processed_for_rag = 0 AND id > ? ORDER BY id LIMIT ?", (last_id, page_size)
+            ).fetchall()
+        finally:
+            conn.close()
+        if not page:
+            return
+        yield page
+        last_id = page[-1]['id']
+
+def mark_emails_processed(db_file, email_ids, batch_size=UPDATE_BATCH_SIZE, body_hashes=None):
+    """
+    Sets processed_for_rag = 1 for those of the given email IDs whose
+    chunks are all stored (see ChunkTable); emails with a pending or
+    failed chunk stay queued. Uses one parameter per statement
+    (executemany) instead of a large IN (...) list, so big runs never hit
+    SQLite's variable limit. body_hashes (email ID -> body_hash) records
+    which body was indexed, so maintenance can tell when it changes.
+    Returns the number of emails marked.
+    """
+    body_hashes = body_hashes or {}
+    email_ids = list(email_ids)
+    marked = 0
+    conn = connect(db_file)
+    try:
+        add_column_if_missing(conn, "emails", "indexed_hash", "TEXT")
+        setup_chunks(conn)
+        for start in range(0, len(email_ids), batch_size):
+            batch = email_ids[start:start + batch_size]
+            with conn:
+                marked += conn.executemany(
+                    "UPDATE emails SET processed_for_rag = 1, "
+                    "indexed_hash = COALESCE(?, indexed_hash) WHERE id = ? "
+                    "AND NOT EXISTS (SELECT 1 FROM chunks WHERE chunks.email_id = emails.id "
+                    "AND chunks.status != 'stored')",
+                    [(body_hashes.get(email_id), email_id) for email_id in batch]
+                ).rowcount
+    finally:
+        conn.close()
+    return marked
+
+def set_categories(db_file, categories, batch_size=UPDATE_BATCH_SIZE):
+    """
+    Stores index-time category labels, given as (email_id, category) pairs.
+    """
+    categories = list(categories)
+    conn = connect(db_file)
+    try:
+        add_column_if_missing(conn, "emails", "category", "TEXT")
+        for start in range(0, len(categories), batch_size):
+            with conn:
+                conn.executemany(
+                    "UPDATE emails SET category = ? WHERE id = ?",
+                    [(category, email_id) for email_id, category in categories[start:start + batch_size]]
+                )
+    finally:
+        conn.close()
@@ -0,0 +1,152 @@
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import embedders
+import rate_limit
+
+# --- Configuration ---
+
+# 1. Where the stand-in listens
+HOST = "127.0.0.1"
+PORT = 8765
+
+# 2. Largest batch accepted, like the real API
+MAX_BATCH_SIZE = 100
+
+PATH_RE = re.compile(r"^/v1beta/(models/[^:/]+):(embedContent|batchEmbedContents)$")
+
+
+class StandInState:
+    """
+    Settings and counters shared by all request handlers.
+    """
+
+    def __init__(self, latency, requests_per_minute, dim):
+        self.latency = latency
+        self.dim = dim
+        self.limiter = None
+        if requests_per_minute:
+            rate = requests_per_minute / 60.0
+            self.limiter = rate_limit.TokenBucket(rate, capacity=max(1.0, rate))
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+
+    def allow(self):
+        """
+        Non-blocking limiter check: True if the request fits the budget.
+        """
+        return self.limiter is None or self.limiter.try_acquire()
+
+
+def make_handler(state):
+
+    class Handler(BaseHTTPRequestHandler):
+        """
+        Mimics the Gemini embedContent / batchEmbedContents REST endpoints,
+        answering with deterministic hashing vectors.
+        """
+
+        def _reply(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            match = PATH_RE.match(self.path.split('?', 1)[0])
+            if not match:
+                self._reply(404, {"error": {"code": 404, "message": "Not found"}})
+                return
+
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+
+            with state.lock:
+                state.requests += 1
+            if not state.allow():
+                with state.lock:
+                    state.throttled += 1
+                self._reply(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED",
+                                            "message": "Quota exceeded (stand-in)"}})
+                return
+
+            if state.latency:
+                time.sleep(state.latency)
+
+            if match.group(2) == "embedContent":
+                text = ''.join(part.get('text', '') for part in request['content']['parts'])
+                dim = request.get('outputDimensionality') or state.dim
+                self._reply(200, {"embedding": {"values": embedders.hashing_vector(text, dim)}})
+                return
+
+            items = request.get("requests", [])
+            if len(items) > MAX_BATCH_SIZE:
+                self._reply(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT",
+                                            "message": f"At most {MAX_BATCH_SIZE} requests per batch"}})
+                return
+            embeddings = []
+            for item in items:
+                text = ''.join(part.get('text', '') for part in item['content']['parts'])
+                dim = item.get('outputDimensionality') or state.dim
+                embeddings.append({"values": embedders.hashing_vector(text, dim)})
+            self._reply(200, {"embeddings": embeddings})
+
+        def log_message(self, format, *args):
+            # Keep load tests quiet
+            pass
+
+    return Handler
+
+def make_server(host=HOST, port=PORT, latency=0.0, requests_per_minute=0,
+                dim=embedders.LOCAL_EMBEDDING_DIM):
+    """
+    Builds (but does not start) the stand-in server. Returns (server, state).
+    """
+    state = StandInState(latency, requests_per_minute, dim)
+    return ThreadingHTTPServer((host, port), make_handler(state)), state
+
+def start_server(host=HOST, port=PORT, latency=0.0, requests_per_minute=0,
+                 dim=embedders.LOCAL_EMBEDDING_DIM):
+    """
+    Starts the stand-in in a background thread and returns (server, state).
+    Call server.shutdown() to stop it.
+    """
+    server, state = make_server(host, port, latency, requests_per_minute, dim)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, state
+
+def main():
+    """
+    Runs the stand-in Gemini embedding server in the foreground.
+    Use it with EMBEDDING_BACKEND=gemini-rest EMBED_API_URL=http://HOST:PORT.
+    """
+    parser = argparse.ArgumentParser(description="Local stand-in for the Gemini embedding API.")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help="Delay added to every successful response.")
+    parser.add_argument('--rpm', type=int, default=0,
+                        help="Requests per minute before answering 429 (0 = unlimited).")
+    parser.add_argument('--dim', type=int, default=embedders.LOCAL_EMBEDDING_DIM)
+    args = parser.parse_args()
+
+    server, state = make_server(args.host, args.port, args.latency_ms / 1000.0, args.rpm, args.dim)
+    print(f"Stand-in Gemini embedding API listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Served {state.requests} requests ({state.throttled} throttled).")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+import hashlib
+import json
+import math
+import os
+import re
+import time
+import urllib.error
+import urllib.request
+
+import metrics
+import rate_limit
+
+# --- Configuration ---
+
+# 1. Which backend to use: "gemini" (Google SDK), "gemini-rest" (plain HTTP
+# against EMBED_API_URL, e.g. the local stand-in server), or "local"
+# (offline hashing vectorizer, no network).
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "gemini")
+
+# 2. Base URL for the "gemini-rest" backend. Point it at
+# embed_standin_server.py (e.g. http://127.0.0.1:8765) for load tests.
+EMBED_API_URL = os.environ.get("EMBED_API_URL", "https://generativelanguage.googleapis.com")
+
+# 3. Vector size of the local hashing vectorizer (matches text-embedding-004)
+LOCAL_EMBEDDING_DIM = 768
+
+# 4. Reduced vector size to request from the Gemini backends (the API's
+# output_dimensionality; text-embedding-004 accepts 1-768), or None for
+# the model's full size. Smaller vectors shrink the vector store and
+# speed up search. Changing it starts a new vector space: reindex after.
+OUTPUT_DIMENSIONALITY = int(os.environ.get("EMBEDDING_DIMENSIONALITY", 0)) or None
+
+# 5. Startup probe: whether to make a test call at all, and how long a
+# successful probe is remembered
+PROBE_EMBEDDER = True
+PROBE_CACHE_FILE = ".embedder_probe.json"
+PROBE_CACHE_SECONDS = 24 * 60 * 60
+
+WORD_RE = re.compile(r"\w+")
+
+
+def is_retryable_error(error):
+    """
+    True for embedding errors worth retrying: rate limits and transient
+    server failures, from either the Google SDK or plain HTTP.
+    """
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code == 429 or error.code >= 500
+    if isinstance(error, urllib.error.URLError):
+        return True
+    try:
+        from google.api_core import exceptions as google_exceptions
+    except ImportError:
+        return False
+    return isinstance(error, (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.DeadlineExceeded,
+    ))
+
+
+class Embedder:
+    """
+    Common interface for embedding backends.
+
+    embed(texts, task_type) returns one vector per text; task_type is
+    "retrieval_document" for stored chunks or "retrieval_query" for searches.
+    'model_name' identifies the vector space (used in cache keys, and
+    includes a reduced output size), 'rate_limited' says whether calls
+    should go through a request budget, and 'hashing_vectors' says the
+    vectors come from hashing_vector() (their similarities run much lower
+    than a trained model's).
+    """
+
+    model_name = None
+    rate_limited = True
+    hashing_vectors = False
+
+    def embed(self, texts, task_type):
+        raise NotImplementedError
+
+    def probe(self, force=False):
+        """
+        Makes one test embedding call to validate the setup. A success is
+        remembered in PROBE_CACHE_FILE so later runs skip the call.
+        Returns True on success, raises on failure.
+        """
+        key = hashlib.sha256(self.probe_key().encode('utf-8')).hexdigest()
+        cache = {}
+        if os.path.exists(PROBE_CACHE_FILE):
+            try:
+                with open(PROBE_CACHE_FILE, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {}
+
+        if not force and time.time() - cache.get(key, 0) < PROBE_CACHE_SECONDS:
+            return True
+
+        self.embed(["test"], "retrieval_document")
+        cache[key] = time.time()
+        with open(PROBE_CACHE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        return True
+
+    def probe_key(self):
+        return f"{type(self).__name__}:{self.model_name}"
+
+
+def space_name(model, output_dimensionality=None):
+    """
+    Name of the vector space of model's embeddings at a given output size.
+    """
+    if output_dimensionality:
+        return f"{model}@{output_dimensionality}"
+    return model
+
+class GeminiEmbedder(Embedder):
+    """
+    Embeds through the google.generativeai SDK.
+    """
+
+    def __init__(self, api_key, model, output_dimensionality=OUTPUT_DIMENSIONALITY):
+        import google.generativeai as genai
+        self.genai = genai
+        self.genai.configure(api_key=api_key)
+        self.api_key = api_key
+        self.model = model
+        self.output_dimensionality = output_dimensionality
+        self.model_name = space_name(model, output_dimensionality)
+
+    def embed(self, texts, task_type):
+        options = {}
+        if self.output_dimensionality:
+            options['output_dimensionality'] = self.output_dimensionality
+
+        def call():
+            return self.genai.embed_content(
+                model=self.model,
+                content=list(texts),
+                task_type=task_type,
+                **options
+            )
+        with metrics.span("external_call_seconds", service="embed", call="embed_content"):
+            result = rate_limit.retry_with_backoff(call, is_retryable_error, name="embed")
+        metrics.inc("embedded_texts_total", len(result['embedding']), backend="gemini")
+        return result['embedding']
+
+    def probe_key(self):
+        return f"gemini:{self.model_name}:{self.api_key}"
+
+
+class GeminiRestEmbedder(Embedder):
+    """
+    Calls the Gemini batchEmbedContents REST endpoint directly with urllib.
+    Works against the real API or against embed_standin_server.py.
+    """
+
+    def __init__(self, api_key, model, base_url=EMBED_API_URL, timeout=60,
+                 output_dimensionality=OUTPUT_DIMENSIONALITY):
+        self.api_key = api_key
+        self.model = model
+        self.output_dimensionality = output_dimensionality
+        self.model_name = space_name(model, output_dimensionality)
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def embed(self, texts, task_type):
+        url = f"{self.base_url}/v1beta/{self.model}:batchEmbedContents?key={self.api_key}"
+        requests = []
+        for text in texts:
+            request = {
+                "model": self.model,
+                "content": {"parts": [{"text": text}]},
+                "taskType": task_type.upper(),
+            }
+            if self.output_dimensionality:
+                request["outputDimensionality"] = self.output_dimensionality
+            requests.append(request)
+        body = json.dumps({"requests": requests}).encode('utf-8')
+
+        def call():
+            request = urllib.request.Request(
+                url, data=body, headers={"Content-Type": "application/json"}
+            )
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.load(response)
+
+        with metrics.span("external_call_seconds", service="embed", call="batchEmbedContents"):
+            result = rate_limit.retry_with_backoff(call, is_retryable_error, name="embed")
+        metrics.inc("embedded_texts_total", len(result['embeddings']), backend="gemini-rest")
+        return [item['values'] for item in result['embeddings']]
+
+    def probe_key(self):
+        return f"gemini-rest:{self.base_url}:{self.model_name}:{self.api_key}"
+
+
+class HashingEmbedder(Embedder):
+    """
+    Offline CPU embedder: a signed feature-hashing vectorizer over word
+    unigrams and bigrams, L2-normalized. No network, no model download;
+    good enough for keyword-heavy mail and for running the pipeline offline.
+    """
+
+    rate_limited = False
+    hashing_vectors = True
+
+    def __init__(self, dim=LOCAL_EMBEDDING_DIM):
+        self.dim = dim
+        self.model_name = f"local/hashing-{dim}"
+
+    def embed(self, texts, task_type):
+        vectors = [hashing_vector(text, self.dim) for text in texts]
+        metrics.inc("embedded_texts_total", len(vectors), backend="local")
+        return vectors
+
+def hashing_vector(text, dim=LOCAL_EMBEDDING_DIM):
+    """
+    Signed feature-hashing vector of a text (unigrams + bigrams), L2-normalized.
+    """
+    words = WORD_RE.findall(text.lower())
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    vector = [0.0] * dim
+    for feature in features:
+        h = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+        index = h % dim
+        vector[index] += 1.0 if (h >> 63) & 1 else -1.0
+
+    norm = math.sqrt(sum(value * value for value in vector))
+    if norm:
+        vector = [value / norm for value in vector]
+    return vector
+
+def get_embedder(api_key, model, backend=EMBEDDING_BACKEND):
+    """
+    Builds the embedder for the configured backend.
+    """
+    if backend == "gemini":
+        return GeminiEmbedder(api_key, model)
+    if backend == "gemini-rest":
+        return GeminiRestEmbedder(api_key, model)
+    if backend == "local":
+        return HashingEmbedder(OUTPUT_DIMENSIONALITY or LOCAL_EMBEDDING_DIM)
+    raise ValueError(f"Unknown embedding backend: {backend}")
@@ -0,0 +1,170 @@
+import array
+import hashlib
+import sqlite3
+import time
+
+import metrics
+
+# --- Configuration ---
+
+# 1. Cache file. Kept apart from my_emails.db and email_vector_db/ so it
+# survives the daily wipe in cron_job.sh.
+CACHE_FILE = "embedding_cache.db"
+
+# 2. Upper bound on stored vector bytes; least recently used entries are
+# evicted beyond this (a 768-dim float32 vector is ~3 KB)
+MAX_CACHE_BYTES = 200 * 1024 * 1024
+
+
+def cache_key(text, model, task_type):
+    """
+    SHA-256 over the model, task type and chunk text.
+    """
+    h = hashlib.sha256()
+    for part in (model, task_type, text):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+def pack_vector(vector):
+    return array.array('f', vector).tobytes()
+
+def unpack_vector(blob):
+    vector = array.array('f')
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed store of embeddings, keyed by
+    cache_key(text, model, task_type) and stored as float32 blobs.
+
+    'hits' and 'misses' count lookups made through this instance (except
+    those made with count=False).
+    """
+
+    def __init__(self, path=CACHE_FILE, max_bytes=MAX_CACHE_BYTES):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS embeddings (
+            key TEXT PRIMARY KEY,
+            vector BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL
+        )
+        ''')
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)"
+        )
+        self.conn.commit()
+        self.max_bytes = max_bytes
+        self.total_bytes = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM embeddings"
+        ).fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, texts, model, task_type, count=True):
+        """
+        Returns a list aligned with 'texts': the cached vector, or None on a miss.
+        Hits are marked as recently used. With count=False the lookups are
+        left out of the hit/miss counts and metrics.
+        """
+        keys = [cache_key(text, model, task_type) for text in texts]
+        found = {}
+        for part in self._key_slices(keys):
+            placeholders = ','.join('?' for _ in part)
+            rows = self.conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", part
+            )
+            for key, blob in rows:
+                found[key] = unpack_vector(blob)
+
+        if found:
+            now = time.time()
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+
+        results = [found.get(key) for key in keys]
+        if not count:
+            return results
+        hit_count = sum(1 for vector in results if vector is not None)
+        self.hits += hit_count
+        self.misses += len(results) - hit_count
+        metrics.inc("cache_total", hit_count, cache="embedding", result="hit")
+        metrics.inc("cache_total", len(results) - hit_count, cache="embedding", result="miss")
+        return results
+
+    def _key_slices(self, keys):
+        # Slices small enough to stay under SQLite's variable limit
+        for start in range(0, len(keys), 500):
+            yield keys[start:start + 500]
+
+    def _existing_keys(self, keys):
+        for part in self._key_slices(keys):
+            placeholders = ','.join('?' for _ in part)
+            for (key,) in self.conn.execute(
+                f"SELECT key FROM embeddings WHERE key IN ({placeholders})", part
+            ):
+                yield key
+
+    def put_many(self, texts, vectors, model, task_type):
+        """
+        Stores vectors for the given texts, then evicts old entries if the
+        cache has grown past max_bytes.
+        """
+        now = time.time()
+        rows = {}
+        for text, vector in zip(texts, vectors):
+            blob = pack_vector(vector)
+            key = cache_key(text, model, task_type)
+            rows[key] = (key, blob, len(blob), now)
+        # Skip keys already stored (same key means same vector)
+        existing = set(self._existing_keys(list(rows)))
+        rows = [row for key, row in rows.items() if key not in existing]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO embeddings (key, vector, size, last_used) VALUES (?, ?, ?, ?)",
+                rows
+            )
+        self.total_bytes += sum(row[2] for row in rows)
+        self.evict()
+
+    def evict(self):
+        """
+        Deletes least recently used entries until the total size fits max_bytes.
+        """
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        evicted = 0
+        while self.total_bytes > self.max_bytes:
+            oldest = self.conn.execute(
+                "SELECT key, size FROM embeddings ORDER BY last_used LIMIT 500"
+            ).fetchall()
+            if not oldest:
+                break
+
+            to_delete = []
+            for key, size in oldest:
+                to_delete.append((key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+            with self.conn:
+                self.conn.executemany("DELETE FROM embeddings WHERE key = ?", to_delete)
+            evicted += len(to_delete)
+
+        print(f"  > Embedding cache: evicted {evicted} least recently used entries.")
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def close(self):
+        self.conn.close()
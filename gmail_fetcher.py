@@ -1,8 +1,16 @@
 import os.path
+import argparse
+import itertools
+import json
 import base64
-import email
 import sqlite3
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import email_db
+import metrics
+import mime_extract
+import rate_limit
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -15,6 +23,41 @@ SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 # Define the database file
 DB_FILE = "my_emails.db"
 
+# Gmail allows at most 100 calls per batch HTTP request
+BATCH_SIZE = 100
+
+# Query used for a full (non-incremental) listing
+FULL_SYNC_QUERY = "is:unread newer_than:1d"
+
+# Key under which the last synced Gmail historyId is kept in 'sync_state'
+HISTORY_ID_KEY = "last_history_id"
+
+# Key under which IDs of messages that could not be fetched are kept; the
+# next run fetches them first
+FAILED_IDS_KEY = "failed_message_ids"
+
+# Page size for list calls (500 is the Gmail maximum)
+LIST_PAGE_SIZE = 500
+
+# Upper bound on messages ingested per run (None = no limit)
+MAX_MESSAGES = 10000
+
+# Concurrent fetch mode: number of worker threads (0 = use the batch endpoint)
+FETCH_WORKERS = 0
+
+# Gmail allows 250 quota units per user per second; keep some headroom
+GMAIL_QUOTA_UNITS_PER_SECOND = 225
+
+# Quota cost of a single messages().get call
+MESSAGES_GET_UNITS = 5
+
+# HTTP statuses worth retrying (rate limiting and transient server errors)
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class HistoryExpiredError(Exception):
+    """Raised when the stored historyId is too old for history().list."""
+
 def setup_database():
     """
     Creates the database and the 'emails' table if it doesn't exist.
@@ -33,80 +76,374 @@ def setup_database():
         subject TEXT,
         body TEXT,
         received_at TIMESTAMP,
-        processed_for_rag INTEGER DEFAULT 0
+        processed_for_rag INTEGER DEFAULT 0,
+        category TEXT,
+        indexed_hash TEXT
+    )
+    ''')
+    # Set by Phase 2; databases created before they existed lack the columns
+    email_db.add_column_if_missing(conn, "emails", "category", "TEXT")
+    email_db.add_column_if_missing(conn, "emails", "indexed_hash", "TEXT")
+
+    # Small key/value table for sync checkpoints (e.g. the Gmail historyId)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sync_state (
+        key TEXT PRIMARY KEY,
+        value TEXT
     )
     ''')
     
     conn.commit()
+
+    # Keyword (BM25) index over the emails, kept in sync by triggers
+    email_db.setup_fts(conn)
+
+    # Per-chunk indexing state, and the indexes the Phase 2 scan uses
+    email_db.setup_chunks(conn)
+
     conn.close()
     print(f"Database '{DB_FILE}' is ready.")
 
-def save_email_to_db(email_data):
+def get_sync_state(key):
     """
-    Saves a single email dictionary to the SQLite database.
-    Uses 'INSERT OR IGNORE' to skip duplicates based on the UNIQUE gmail_id.
+    Returns the stored value for a sync checkpoint key, or None if unset.
     """
     conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
     try:
-        cursor.execute('''
-        INSERT OR IGNORE INTO emails (
-            gmail_id, from_sender, subject, body, received_at
-        ) VALUES (?, ?, ?, ?, ?)
-        ''', (
-            email_data['gmail_id'],
-            email_data['from'],
-            email_data['subject'],
-            email_data['body'],
-            email_data['received_at']
-        ))
-        
+        row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+def set_sync_state(key, value):
+    """
+    Stores (or replaces) the value for a sync checkpoint key.
+    """
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+            (key, str(value))
+        )
         conn.commit()
-        
-        # cursor.rowcount will be 1 if a new row was inserted,
-        # and 0 if the gmail_id already existed (and was ignored).
-        if cursor.rowcount > 0:
-            print(f"  > Saved new email to DB: {email_data['subject'][:40]}...")
-        else:
-            print(f"  > Email already in DB: {email_data['subject'][:40]}...")
-            
-    except sqlite3.Error as e:
-        print(f"Database error: {e}")
     finally:
         conn.close()
 
-def get_email_body(mime_msg):
+def record_fetch_failure(msg_id, error, failed=None):
+    # Reports a message that could not be fetched; failed collects
+    # (msg_id, error) pairs for the caller
+    print(f"Could not fetch email with ID {msg_id}: {error}")
+    metrics.inc("messages_total", state="fetch_failed")
+    if failed is not None:
+        failed.append((msg_id, error))
+
+def fetch_messages_batch(service, msg_ids, failed=None):
     """
-    Parses a MIME message to find the plain text body.
+    Fetches messages in 'raw' format through the Gmail batch endpoint,
+    sending up to BATCH_SIZE GETs per HTTP round trip.
+    msg_ids can be any iterable (e.g. a listing generator); it is consumed
+    one batch at a time.
+    Every GET in a batch is charged against the same per-user token bucket
+    as the concurrent mode, and throttled or failed GETs are sent again in
+    a smaller batch with exponential backoff.
+    Yields each message response; messages that still fail are reported
+    and appended to failed as (msg_id, error).
     """
-    if not mime_msg.is_multipart():
-        if mime_msg.get_content_type() == 'text/plain':
-            try:
-                return mime_msg.get_payload(decode=True).decode()
-            except:
-                return ""
-        else:
-            return ""
+    limiter = rate_limit.TokenBucket(GMAIL_QUOTA_UNITS_PER_SECOND)
+    msg_ids = iter(msg_ids)
+    while True:
+        chunk = list(itertools.islice(msg_ids, BATCH_SIZE))
+        if not chunk:
+            break
+        responses = {}
+        errors = {}
+        pending = chunk
+
+        def on_response(request_id, response, exception):
+            if exception is not None:
+                errors[request_id] = exception
+            else:
+                responses[request_id] = response
+
+        def send():
+            # Sends the pending GETs; raises if some are worth retrying
+            nonlocal pending
+            errors.clear()
+            batch = service.new_batch_http_request(callback=on_response)
+            for msg_id in pending:
+                limiter.acquire(MESSAGES_GET_UNITS)
+                batch.add(
+                    service.users().messages().get(userId='me', id=msg_id, format='raw'),
+                    request_id=msg_id
+                )
+            with metrics.span("external_call_seconds", service="gmail", call="batchGet"):
+                batch.execute()
 
-    body = ""
-    for part in mime_msg.walk():
-        if part.get_content_type() == 'text/plain':
-            if part.get('Content-Disposition') is None:
+            for msg_id in pending:
+                if msg_id in errors and not is_retryable_error(errors[msg_id]):
+                    record_fetch_failure(msg_id, errors[msg_id], failed)
+            pending = [msg_id for msg_id in pending
+                       if msg_id in errors and is_retryable_error(errors[msg_id])]
+            if pending:
+                raise errors[pending[0]]
+
+        try:
+            rate_limit.retry_with_backoff(send, is_retryable_error, name="gmail")
+        except Exception as e:
+            for msg_id in pending:
+                record_fetch_failure(msg_id, errors.get(msg_id, e), failed)
+
+        # Keep the original listing order
+        for msg_id in chunk:
+            if msg_id in responses:
+                yield responses[msg_id]
+
+def is_retryable_error(error):
+    """
+    True for Gmail errors that should be retried with backoff: 429, 5xx,
+    and the 403 'rate limit exceeded' variants.
+    """
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    if status in RETRYABLE_STATUSES:
+        return True
+    return status == 403 and b'RateLimitExceeded' in (error.content or b'')
+
+def fetch_messages_concurrent(creds, msg_ids, workers=FETCH_WORKERS, failed=None):
+    """
+    Fetches messages in 'raw' format with a bounded thread pool.
+    Each thread builds its own Gmail service (the client is not thread-safe),
+    all threads share one token bucket sized to the per-user quota, and
+    throttled or failed calls are retried with exponential backoff.
+    msg_ids is consumed lazily; at most 2 * workers requests are in flight.
+    Yields message responses as they complete; messages that still fail
+    are appended to failed as (msg_id, error).
+    """
+    limiter = rate_limit.TokenBucket(GMAIL_QUOTA_UNITS_PER_SECOND)
+    local = threading.local()
+
+    def fetch_one(msg_id):
+        if not hasattr(local, 'service'):
+            local.service = build('gmail', 'v1', credentials=creds, cache_discovery=False)
+
+        def call():
+            limiter.acquire(MESSAGES_GET_UNITS)
+            with metrics.span("external_call_seconds", service="gmail", call="messages.get"):
+                return local.service.users().messages().get(
+                    userId='me', id=msg_id, format='raw'
+                ).execute()
+
+        return rate_limit.retry_with_backoff(call, is_retryable_error, name="gmail")
+
+    msg_ids = iter(msg_ids)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = {}
+
+        while True:
+            # Top up the pool without listing further ahead than needed
+            for msg_id in itertools.islice(msg_ids, 2 * workers - len(in_flight)):
+                in_flight[executor.submit(fetch_one, msg_id)] = msg_id
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                msg_id = in_flight.pop(future)
                 try:
-                    body = part.get_payload(decode=True).decode()
-                    break
-                except:
+                    yield future.result()
+                except Exception as e:
+                    record_fetch_failure(msg_id, e, failed)
+
+def parse_raw_message(msg_raw):
+    """
+    Turns a 'raw' format message response into the email dictionary
+    stored in the database. The 'raw' response already carries internalDate,
+    so no second 'full' GET is needed.
+    """
+    raw_data = msg_raw['raw']
+    msg_str = base64.urlsafe_b64decode(raw_data.encode('ASCII'))
+    mime_msg = mime_extract.parse_message(msg_str)
+
+    # Extract headers (already decoded by the modern email policy)
+    from_ = mime_extract.get_header(mime_msg, 'from')
+    subject = mime_extract.get_header(mime_msg, 'subject')
+
+    # Extract body (plain text, or HTML converted to text; attachments skipped)
+    body = mime_extract.get_email_body(mime_msg)
+
+    # Get received date (milliseconds since epoch)
+    internal_date_ms = int(msg_raw['internalDate'])
+    received_at = datetime.datetime.fromtimestamp(internal_date_ms / 1000.0)
+
+    return {
+        'gmail_id': msg_raw['id'],
+        'from': from_,
+        'subject': subject,
+        'body': body,
+        'received_at': received_at
+    }
+
+def list_message_ids_full(service, max_messages=MAX_MESSAGES):
+    """
+    Yields message IDs matching FULL_SYNC_QUERY, following nextPageToken
+    until the listing ends or max_messages IDs have been produced.
+    """
+    count = 0
+    page_token = None
+
+    while True:
+        with metrics.span("external_call_seconds", service="gmail", call="messages.list"):
+            result = service.users().messages().list(
+                userId='me',
+                q=FULL_SYNC_QUERY,
+                maxResults=LIST_PAGE_SIZE,
+                pageToken=page_token
+            ).execute()
+
+        for msg in result.get('messages', []):
+            yield msg['id']
+            count += 1
+            if max_messages is not None and count >= max_messages:
+                print(f"Reached the limit of {max_messages} messages for this run.")
+                return
+
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            return
+
+def list_message_ids_since(service, start_history_id, max_messages=MAX_MESSAGES):
+    """
+    Yields IDs of unread messages added since start_history_id using the
+    Gmail history API, following nextPageToken page by page.
+
+    Raises HistoryExpiredError (before yielding anything) if the checkpoint
+    is too old and a full listing is needed instead.
+    """
+    seen = set()
+    page_token = None
+
+    while True:
+        try:
+            with metrics.span("external_call_seconds", service="gmail", call="history.list"):
+                result = service.users().history().list(
+                    userId='me',
+                    startHistoryId=start_history_id,
+                    historyTypes=['messageAdded'],
+                    maxResults=LIST_PAGE_SIZE,
+                    pageToken=page_token
+                ).execute()
+        except HttpError as error:
+            # Gmail answers 404 when startHistoryId is too old to be served
+            if error.resp.status == 404:
+                raise HistoryExpiredError(start_history_id) from error
+            raise
+
+        for record in result.get('history', []):
+            for added in record.get('messagesAdded', []):
+                msg = added['message']
+                labels = msg.get('labelIds', [])
+                # Mirror FULL_SYNC_QUERY: only unread mail, never spam/trash/drafts
+                if 'UNREAD' not in labels:
+                    continue
+                if 'SPAM' in labels or 'TRASH' in labels or 'DRAFT' in labels:
                     continue
-    return body
+                if msg['id'] in seen:
+                    continue
+                seen.add(msg['id'])
+                yield msg['id']
+                if max_messages is not None and len(seen) >= max_messages:
+                    print(f"Reached the limit of {max_messages} messages for this run.")
+                    return
 
-def main():
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            return
+
+def ingest_messages(service, msg_ids, creds=None, workers=FETCH_WORKERS, failed=None):
     """
-    Main function to authenticate, fetch, and save emails to the database.
+    Fetches, parses and saves messages as their IDs arrive, writing them
+    through a single bulk database connection.
+    With workers > 0 (and creds given) messages are fetched by the
+    concurrent thread pool instead of the batch endpoint.
+    Messages that could not be fetched are appended to failed as
+    (msg_id, error).
+    Returns (listed, fetched): how many IDs were listed and how many
+    messages were actually fetched.
+    """
+    listed = 0
+    fetched = 0
+
+    def counted(ids):
+        nonlocal listed
+        for msg_id in ids:
+            listed += 1
+            yield msg_id
+
+    with email_db.EmailWriter(DB_FILE) as writer:
+        if workers > 0:
+            responses = fetch_messages_concurrent(creds, counted(msg_ids), workers, failed)
+        else:
+            responses = fetch_messages_batch(service, counted(msg_ids), failed)
+
+        for msg_raw in responses:
+            fetched += 1
+            try:
+                email_data = parse_raw_message(msg_raw)
+            except Exception as e:
+                print(f"Could not parse email with ID {msg_raw['id']}: {e}")
+                metrics.inc("messages_total", state="parse_failed")
+                continue
+
+            # Queue for the database; rows are written in batches
+            writer.add(email_data)
+
+    print(f"  > Saved {writer.inserted} new emails to DB "
+          f"({writer.skipped} already in DB).")
+    record_message_counts(listed, fetched, writer.inserted, writer.skipped)
+    return listed, fetched
+
+def retry_first(retry_ids, msg_ids, listing=None):
+    """
+    Yields the IDs left over from an earlier run, then the listed IDs
+    that are not among them. If a listing dict is given,
+    listing['listed'] counts the IDs taken from msg_ids (the retried
+    ones are not counted), to compare against the listing limit.
+    """
+    yield from retry_ids
+    retry_ids = set(retry_ids)
+    for msg_id in msg_ids:
+        if listing is not None:
+            listing['listed'] += 1
+        if msg_id not in retry_ids:
+            yield msg_id
+
+def should_retry(error):
+    # A message deleted since it was listed (404) will never be fetched
+    return not (isinstance(error, HttpError) and error.resp.status == 404)
+
+def record_message_counts(listed, fetched, stored, skipped):
+    metrics.inc("messages_total", listed, state="listed")
+    metrics.inc("messages_total", fetched, state="fetched")
+    metrics.inc("messages_total", stored, state="stored")
+    metrics.inc("messages_total", skipped, state="skipped")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Phase 1: fetch Gmail messages into SQLite.")
+    parser.add_argument('--full', action='store_true',
+                        help="Ignore the stored historyId and do a full listing.")
+    parser.add_argument('--max-messages', type=int, default=MAX_MESSAGES,
+                        help="Upper bound on messages ingested this run (0 = no limit).")
+    parser.add_argument('--workers', type=int, default=FETCH_WORKERS,
+                        help="Fetch with this many concurrent threads (0 = batch endpoint).")
+    metrics.add_profile_argument(parser)
+    return parser.parse_args()
+
+def get_credentials():
+    """
+    Loads the Gmail credentials from token.json, refreshing them or
+    running the browser login flow when needed, and saves them back.
     """
-    # Run the database setup first
-    setup_database()
-    
     creds = None
     if os.path.exists('token.json'):
         creds = Credentials.from_authorized_user_file('token.json', SCOPES)
@@ -120,77 +457,98 @@ def main():
             creds = flow.run_local_server(port=0)
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
+    return creds
 
-    try:
+@metrics.stage("fetch")
+def run(service=None, creds=None, full=False, max_messages=MAX_MESSAGES, workers=FETCH_WORKERS,
+        ingest=ingest_messages):
+    """
+    Runs Phase 1: syncs new emails into the database.
+    An already authenticated Gmail service (and its credentials) can be
+    passed in; otherwise they are loaded from token.json.
+    ingest takes the listed IDs and stores the messages; it has the
+    signature of ingest_messages (see streaming_ingest.py for another).
+    Returns True on success.
+    """
+    # Run the database setup first
+    setup_database()
+
+    if service is None:
+        creds = creds or get_credentials()
         service = build('gmail', 'v1', credentials=creds)
 
-        # We can now fetch more than 1 day old, since the DB handles duplicates.
-        # Let's fetch emails from the last 3 days to be safe.
-        result = service.users().messages().list(
-            userId='me', 
-            q="is:unread newer_than:1d", # Changed from 'is:unread'
-            maxResults=50 # Fetch up to 50
-        ).execute()
-
-        messages = result.get('messages')
-        
-        if not messages:
-            print("No new emails found matching query.")
-            return
+    try:
+        # Read the current historyId *before* listing so that nothing
+        # arriving during this run is missed on the next one.
+        with metrics.span("external_call_seconds", service="gmail", call="getProfile"):
+            profile = service.users().getProfile(userId='me').execute()
+        new_history_id = profile['historyId']
 
-        print(f"Found {len(messages)} emails. Processing...")
+        # --- Incremental sync via historyId, unless full was requested ---
+        last_history_id = None if full else get_sync_state(HISTORY_ID_KEY)
 
-        for msg in messages:
-            msg_id = msg['id']
+        # Messages an earlier run could not fetch are not listed again by
+        # an incremental sync, so they go first
+        retry_ids = json.loads(get_sync_state(FAILED_IDS_KEY) or "[]")
+        if retry_ids:
+            print(f"Retrying {len(retry_ids)} emails that could not be fetched last run.")
+        failed = []
+        listing = {'listed': 0}
+
+        counts = None
+        if last_history_id:
+            print(f"Incremental sync from historyId {last_history_id}...")
             try:
-                # Fetch the full raw message AND metadata
-                msg_full = service.users().messages().get(
-                    userId='me', 
-                    id=msg_id,
-                    format='full' # Use 'full' to get metadata
-                ).execute()
+                counts = ingest(
+                    service,
+                    retry_first(retry_ids, list_message_ids_since(service, last_history_id, max_messages),
+                                listing),
+                    creds, workers, failed=failed)
+            except HistoryExpiredError:
+                print("History checkpoint expired. Falling back to a full listing.")
+                failed.clear()
+                listing['listed'] = 0
 
-                # Get the raw data for parsing
-                msg_raw = service.users().messages().get(
-                    userId='me', 
-                    id=msg_id,
-                    format='raw'
-                ).execute()
+        if counts is None:
+            counts = ingest(
+                service, retry_first(retry_ids, list_message_ids_full(service, max_messages), listing),
+                creds, workers, failed=failed)
 
-                raw_data = msg_raw['raw']
-                msg_str = base64.urlsafe_b64decode(raw_data.encode('ASCII'))
-                mime_msg = email.message_from_bytes(msg_str)
-
-                # Extract headers
-                from_ = str(email.header.make_header(email.header.decode_header(mime_msg['from'])))
-                subject = str(email.header.make_header(email.header.decode_header(mime_msg['subject'])))
-                
-                # Extract body
-                body = get_email_body(mime_msg)
-
-                # Get received date from 'full' format response
-                internal_date_ms = int(msg_full['internalDate'])
-                received_at = datetime.datetime.fromtimestamp(internal_date_ms / 1000.0)
-
-                # Prepare the data dictionary
-                email_data = {
-                    'gmail_id': msg_id,
-                    'from': from_,
-                    'subject': subject,
-                    'body': body,
-                    'received_at': received_at
-                }
-                
-                # Save to our new database
-                save_email_to_db(email_data)
+        listed, fetched = counts
+        if listed == 0:
+            print("No new emails found matching query.")
+        else:
+            print(f"Processed {fetched} of {listed} listed emails.")
 
-            except Exception as e:
-                print(f"Could not parse or save email with ID {msg_id}: {e}")
+        # Only advance the checkpoint once this run's messages are stored,
+        # keeping the IDs that failed for the next run.
+        # If the listing was cut off by the limit, keep the old checkpoint so
+        # the next run picks up the rest (retried IDs do not count towards it).
+        failed_ids = [msg_id for msg_id, error in failed if should_retry(error)]
+        set_sync_state(FAILED_IDS_KEY, json.dumps(failed_ids))
+        if failed_ids:
+            print(f"{len(failed_ids)} emails could not be fetched; they will be retried next run.")
+        if max_messages is not None and listing['listed'] >= max_messages:
+            print("Message limit reached; keeping the previous sync checkpoint.")
+        else:
+            set_sync_state(HISTORY_ID_KEY, new_history_id)
 
         print("\nPhase 1 (Ingestion & Storage) complete.")
+        # Only a run where every listed email failed counts as a failed stage
+        return fetched > 0 or not failed
 
     except HttpError as error:
         print(f'An error occurred: {error}')
+        return False
+
+def main():
+    """
+    Main function to authenticate, fetch, and save emails to the database.
+    """
+    args = parse_args()
+    with metrics.profiled(args.profile, "fetch"):
+        run(full=args.full, max_messages=args.max_messages or None, workers=args.workers)
+    metrics.flush("fetch")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,292 @@
+import argparse
+import datetime
+import os
+import sqlite3
+
+import email_db
+import embedding_cache
+import metrics
+import near_dedup
+import response_cache
+import vector_store
+
+# --- Configuration ---
+
+# 1. Database file from Phase 1
+DB_FILE = "my_emails.db"
+
+# 2. Vector database from Phase 2 (the "chroma" backend's folder; see
+# vector_store.py for the memmap backend)
+CHROMA_PATH = "email_vector_db"
+COLLECTION_NAME = "emails"
+
+# 3. Emails older than this many days are deleted from SQLite and the vector store
+# (the report only looks at the last 24 hours)
+RETENTION_DAYS = 30
+
+# 4. Rebuild the collection once this fraction of the vectors ever stored
+# in it has been deleted. Deleted vectors stay in Chroma's HNSW index
+# files (or the memmap backend's vectors file) until it is rebuilt.
+COMPACT_DELETED_FRACTION = 0.2
+
+# 5. Records copied per page when rebuilding the collection
+COMPACT_PAGE_SIZE = 500
+
+# 6. Emails deleted per transaction
+DELETE_BATCH_SIZE = 500
+
+# 7. Key in 'sync_state' counting vectors deleted since the last rebuild
+DELETED_SINCE_COMPACTION_KEY = "chroma_deleted_since_compaction"
+
+# 8. Key in 'sync_state' set once indexed_hash has been backfilled
+HASHES_BACKFILLED_KEY = "indexed_hash_backfilled"
+
+COMPACTING_NAME = COLLECTION_NAME + "_compacting"
+
+
+def table_exists(conn, table):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+def get_sync_state(conn, key):
+    row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def add_deleted_count(conn, deleted):
+    total = int(get_sync_state(conn, DELETED_SINCE_COMPACTION_KEY) or 0) + deleted
+    conn.execute(
+        "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+        (DELETED_SINCE_COMPACTION_KEY, str(total))
+    )
+    return total
+
+def collection_names(client):
+    # Older chromadb versions return Collection objects, newer ones names
+    return {getattr(collection, 'name', collection) for collection in client.list_collections()}
+
+def open_collection(client):
+    """
+    Returns the "emails" collection, or None if it does not exist yet.
+    Finishes or discards a rebuild interrupted by a crash first.
+    """
+    names = collection_names(client)
+    if COMPACTING_NAME in names:
+        if COLLECTION_NAME in names:
+            # The copy never finished; the original is still complete
+            print("  > Discarding an unfinished collection rebuild.")
+            client.delete_collection(COMPACTING_NAME)
+        else:
+            # The original was already dropped; the copy is complete
+            print("  > Finishing an interrupted collection rebuild.")
+            client.get_collection(COMPACTING_NAME).modify(name=COLLECTION_NAME)
+        names = collection_names(client)
+    if COLLECTION_NAME not in names:
+        return None
+    return client.get_collection(COLLECTION_NAME)
+
+def apply_retention(conn, collection, retention_days=RETENTION_DAYS):
+    """
+    Deletes emails received more than retention_days ago, with their
+    chunk rows and links, their FTS rows (via the table's triggers) and their
+    vectors. Representative chunks still used by newer emails are kept.
+    Returns (emails deleted, vectors deleted).
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+    old_ids = [row[0] for row in conn.execute(
+        "SELECT id FROM emails WHERE received_at < ?", (cutoff.isoformat(' '),)
+    )]
+    print(f"Found {len(old_ids)} emails older than {retention_days} days.")
+
+    orphaned = {}
+    for start in range(0, len(old_ids), DELETE_BATCH_SIZE):
+        batch = old_ids[start:start + DELETE_BATCH_SIZE]
+        with conn:
+            if table_exists(conn, "chunk_sources"):
+                orphaned.update(near_dedup.release_emails(conn, batch))
+            if table_exists(conn, "chunks"):
+                conn.executemany("DELETE FROM chunks WHERE email_id = ?", [(email_id,) for email_id in batch])
+            conn.executemany("DELETE FROM emails WHERE id = ?", [(email_id,) for email_id in batch])
+
+    if collection is None:
+        return len(old_ids), 0
+
+    before = collection.count()
+    orphaned_ids = list(orphaned)
+    for start in range(0, len(orphaned_ids), DELETE_BATCH_SIZE):
+        collection.delete(ids=orphaned_ids[start:start + DELETE_BATCH_SIZE])
+    # Chunks of the deleted emails that have no chunk links (indexed before
+    # near_dedup). Only these emails' chunks are touched, so a live chunk
+    # whose date could not be parsed (received_at 0) stays. Shared
+    # representatives carry their newest source's time (near_dedup.save),
+    # so one still used by a newer email is kept.
+    for start in range(0, len(old_ids), DELETE_BATCH_SIZE):
+        collection.delete(where={'$and': [
+            {'email_id': {'$in': old_ids[start:start + DELETE_BATCH_SIZE]}},
+            {'received_at': {'$lt': int(cutoff.timestamp())}},
+        ]})
+    deleted = before - collection.count()
+
+    with conn:
+        total = add_deleted_count(conn, deleted)
+    print(f"  > Deleted {len(old_ids)} emails and {deleted} vectors "
+          f"({total} vectors deleted since the last rebuild).")
+    return len(old_ids), deleted
+
+def backfill_indexed_hashes(conn):
+    """
+    One-time step for databases indexed before body hashes were kept:
+    records the current hash of every processed email that has none.
+    Changed emails need no scan here: re-fetching one resets its
+    processed flag (email_db.UPSERT_EMAIL_SQL), so Phase 2 reindexes it.
+    Returns the number of emails backfilled.
+    """
+    if get_sync_state(conn, HASHES_BACKFILLED_KEY):
+        return 0
+    email_db.add_column_if_missing(conn, "emails", "indexed_hash", "TEXT")
+    backfill = [
+        (email_db.body_hash(body), email_id) for email_id, body in conn.execute(
+            "SELECT id, body FROM emails WHERE processed_for_rag = 1 AND indexed_hash IS NULL"
+        )
+    ]
+    with conn:
+        conn.executemany("UPDATE emails SET indexed_hash = ? WHERE id = ?", backfill)
+        conn.execute(
+            "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, '1')",
+            (HASHES_BACKFILLED_KEY,)
+        )
+    print(f"  > Recorded body hashes for {len(backfill)} emails indexed before hashes were kept.")
+    return len(backfill)
+
+def compact_collection(client, collection):
+    """
+    Rebuilds the collection without its deleted vectors: copies every
+    record into a new collection, drops the old one and renames the copy.
+    An interrupted rebuild is finished or discarded by open_collection.
+    Returns the rebuilt collection.
+    """
+    count = collection.count()
+    print(f"Rebuilding collection '{COLLECTION_NAME}' ({count} vectors)...")
+    if COMPACTING_NAME in collection_names(client):
+        client.delete_collection(COMPACTING_NAME)
+    rebuilt = client.create_collection(name=COMPACTING_NAME, metadata=collection.metadata)
+
+    for offset in range(0, count, COMPACT_PAGE_SIZE):
+        page = collection.get(
+            limit=COMPACT_PAGE_SIZE, offset=offset,
+            include=['embeddings', 'documents', 'metadatas']
+        )
+        if len(page['ids']) == 0:
+            break
+        rebuilt.add(
+            ids=page['ids'],
+            embeddings=page['embeddings'],
+            documents=page['documents'],
+            metadatas=page['metadatas']
+        )
+
+    client.delete_collection(COLLECTION_NAME)
+    rebuilt.modify(name=COLLECTION_NAME)
+    print(f"  > Rebuilt with {rebuilt.count()} vectors.")
+    return rebuilt
+
+def vacuum(path):
+    """
+    Checkpoints the WAL and rewrites an SQLite file to reclaim the space
+    left by deleted rows. Skips files that do not exist or are in use.
+    """
+    if not os.path.exists(path):
+        return
+    before = os.path.getsize(path)
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("VACUUM")
+    except sqlite3.OperationalError as e:
+        print(f"  > Could not vacuum {path}: {e}")
+        return
+    finally:
+        conn.close()
+    after = os.path.getsize(path)
+    print(f"  > Vacuumed {path}: {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB.")
+
+@metrics.stage("maintenance")
+def run(retention_days=RETENTION_DAYS, compact=False, skip_vacuum=False, chroma_client=None):
+    """
+    Nightly maintenance in place of deleting the databases: expires old
+    emails and their vectors, backfills body hashes once for older
+    databases, rebuilds the vector-store collection when enough of it is deleted, and
+    vacuums the SQLite files. Returns True on success.
+    """
+    print("Starting maintenance...")
+    if not os.path.exists(DB_FILE):
+        print(f"No database at '{DB_FILE}' yet. Nothing to maintain.")
+        return True
+
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        if not table_exists(conn, "emails"):
+            print("No emails table yet. Nothing to maintain.")
+            return True
+        conn.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)")
+
+        client = chroma_client or vector_store.get_client(CHROMA_PATH)
+        collection = open_collection(client)
+
+        # --- 1. Retention ---
+        apply_retention(conn, collection, retention_days)
+
+        # --- 2. Body Hashes for Incremental Reindexing ---
+        backfill_indexed_hashes(conn)
+
+        # --- 3. Compaction ---
+        if collection is not None:
+            deleted = int(get_sync_state(conn, DELETED_SINCE_COMPACTION_KEY) or 0)
+            stored = collection.count() + deleted
+            fraction = deleted / stored if stored else 0.0
+            if compact or fraction >= COMPACT_DELETED_FRACTION:
+                compact_collection(client, collection)
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, '0')",
+                        (DELETED_SINCE_COMPACTION_KEY,)
+                    )
+            else:
+                print(f"  > {fraction:.0%} of the collection is deleted; "
+                      f"rebuilding at {COMPACT_DELETED_FRACTION:.0%}.")
+    finally:
+        conn.close()
+
+    # --- 4. Reclaim Disk Space ---
+    if not skip_vacuum:
+        print("Vacuuming databases...")
+        for path in (DB_FILE, embedding_cache.CACHE_FILE, response_cache.CACHE_FILE,
+                     os.path.join(CHROMA_PATH, "chroma.sqlite3"),
+                     os.path.join(vector_store.MEMMAP_PATH, COLLECTION_NAME, vector_store.SIDECAR_FILE)):
+            vacuum(path)
+
+    print("Maintenance complete.")
+    return True
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Expire old emails and compact the databases."
+    )
+    parser.add_argument('--retention-days', type=int, default=RETENTION_DAYS,
+                        help=f"Delete emails older than this (default: {RETENTION_DAYS}).")
+    parser.add_argument('--compact', action='store_true',
+                        help="Rebuild the vector-store collection even below the threshold.")
+    parser.add_argument('--skip-vacuum', action='store_true',
+                        help="Do not VACUUM the SQLite files.")
+    return parser.parse_args()
+
+def main():
+    """
+    Runs nightly maintenance.
+    """
+    args = parse_args()
+    run(args.retention_days, args.compact, args.skip_vacuum)
+    metrics.flush("maintenance")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+import contextlib
+import cProfile
+import datetime
+import functools
+import io
+import itertools
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+# --- Configuration ---
+
+# 1. Where the JSON-lines run log, the Prometheus files and profiles go.
+# Point METRICS_DIR at node_exporter's textfile-collector directory to
+# scrape the .prom files; the collector ignores the other files.
+METRICS_DIR = os.environ.get("METRICS_DIR", "metrics")
+RUN_LOG_FILE = "run_log.jsonl"
+
+# 2. Prefix of every exported metric name
+METRIC_PREFIX = "rag_"
+
+# 3. Histogram bucket upper bounds, in seconds (API calls up to whole stages)
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+# 4. Rows kept in the text summary of a profile
+PROFILE_TOP_N = 40
+
+METRIC_HELP = {
+    "stage_seconds": "Duration of each pipeline stage.",
+    "stage_runs_total": "Stage runs by result (success, failure).",
+    "external_call_seconds": "Latency of calls to Gmail, the embedding API, the vector store and Gemini.",
+    "first_email_indexed_seconds": "Streaming mode: time from stream start to the first indexed email.",
+    "messages_total": "Gmail messages by state (listed, fetched, stored, skipped, parse_failed).",
+    "chunks_total": "Email chunks by state (created, collapsed, stored, failed).",
+    "embedded_texts_total": "Texts sent to the embedding backend.",
+    "tokens_total": "Generation tokens by kind (prompt, output).",
+    "retries_total": "Calls retried after a retryable error.",
+    "cache_total": "Cache lookups by cache and result (hit, miss).",
+    "span_errors_total": "Spans that ended with an exception.",
+}
+
+
+class Registry:
+    """
+    Thread-safe counters and latency histograms for one process, plus the
+    JSON-lines span log. Metric values are keyed by name and sorted label
+    pairs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.run_id = datetime.datetime.now().strftime("%Y%m%dT%H%M%S") + f"-{os.getpid()}"
+        self.span_ids = itertools.count(1)
+        self.local = threading.local()
+        self.log = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(HISTOGRAM_BUCKETS),
+                                                    'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def write_event(self, event):
+        event = dict(event, run_id=self.run_id, ts=datetime.datetime.now().isoformat(' ', 'milliseconds'))
+        line = json.dumps(event, default=str)
+        with self.lock:
+            if self.log is None:
+                os.makedirs(METRICS_DIR, exist_ok=True)
+                self.log = open(os.path.join(METRICS_DIR, RUN_LOG_FILE), "a", encoding="utf-8")
+            self.log.write(line + "\n")
+            self.log.flush()
+
+    def prometheus_text(self, job):
+        """
+        The registry in the Prometheus text exposition format.
+        """
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# HELP {METRIC_PREFIX}{name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+
+        def label_text(labels, extra=()):
+            pairs = (('job', job),) + labels + tuple(extra)
+            return ','.join(f'{key}="{escape(value)}"' for key, value in pairs)
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                header(name, "counter")
+                lines.append(f"{METRIC_PREFIX}{name}{{{label_text(labels)}}} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                header(name, "histogram")
+                for bound, count in zip(HISTOGRAM_BUCKETS, histogram['buckets']):
+                    lines.append(f"{METRIC_PREFIX}{name}_bucket{{{label_text(labels, [('le', bound)])}}} {count}")
+                lines.append(f"{METRIC_PREFIX}{name}_bucket{{{label_text(labels, [('le', '+Inf')])}}} "
+                             f"{histogram['count']}")
+                lines.append(f"{METRIC_PREFIX}{name}_sum{{{label_text(labels)}}} {histogram['sum']:.6f}")
+                lines.append(f"{METRIC_PREFIX}{name}_count{{{label_text(labels)}}} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+_registry = Registry()
+
+def set_run_id(run_id):
+    """
+    Tags every later run-log line with run_id (e.g. the pipeline's run ID).
+    """
+    _registry.run_id = run_id
+
+def inc(name, value=1, **labels):
+    """
+    Adds value to the counter name{labels}.
+    """
+    _registry.inc(name, value, **labels)
+
+def observe(name, seconds, **labels):
+    """
+    Records one sample in the latency histogram name{labels}.
+    """
+    _registry.observe(name, seconds, **labels)
+
+@contextlib.contextmanager
+def span(name, **labels):
+    """
+    Times the enclosed block: records it in the histogram name{labels}
+    and writes a span line (with its parent span on this thread) to the
+    run log. Yields a dict; keys added to it go into the span line.
+    """
+    stack = getattr(_registry.local, 'stack', None)
+    if stack is None:
+        stack = _registry.local.stack = []
+    span_id = next(_registry.span_ids)
+    parent = stack[-1] if stack else None
+    stack.append(span_id)
+    fields = {}
+    ok = True
+    started = time.perf_counter()
+    try:
+        yield fields
+    except BaseException:
+        ok = False
+        _registry.inc("span_errors_total", span=name)
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        stack.pop()
+        _registry.observe(name, seconds, **labels)
+        _registry.write_event(dict(fields, type="span", name=name, labels=labels, span_id=span_id,
+                                   parent_id=parent, seconds=round(seconds, 6), ok=ok))
+
+def stage(stage_name):
+    """
+    Decorator for a phase's run() function: times it as a 'stage_seconds'
+    span and records whether it succeeded (a truthy return value).
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span("stage_seconds", stage=stage_name) as fields:
+                result = func(*args, **kwargs)
+                fields['succeeded'] = bool(result)
+            inc("stage_runs_total", stage=stage_name, result="success" if result else "failure")
+            return result
+        return wrapper
+    return decorate
+
+def flush(job):
+    """
+    Writes the Prometheus textfile for job (atomically, so a scrape never
+    sees half a file) and a summary line with every counter to the run log.
+    """
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{METRIC_PREFIX}{job}.prom")
+    temp_path = path + ".tmp"
+    text = _registry.prometheus_text(job)
+    text += (f"# HELP {METRIC_PREFIX}last_run_timestamp_seconds Unix time this job last finished.\n"
+             f"# TYPE {METRIC_PREFIX}last_run_timestamp_seconds gauge\n"
+             f'{METRIC_PREFIX}last_run_timestamp_seconds{{job="{escape(job)}"}} {time.time():.0f}\n')
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+    with _registry.lock:
+        counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(_registry.counters.items())]
+    _registry.write_event({'type': "summary", 'job': job, 'counters': counters})
+
+def add_profile_argument(parser):
+    parser.add_argument('--profile', choices=("cpu", "memory"),
+                        help="Profile the run with cProfile (cpu) or tracemalloc (memory) "
+                             f"and save the output under {METRICS_DIR}/.")
+
+@contextlib.contextmanager
+def profiled(kind, name):
+    """
+    Runs the enclosed block under cProfile ('cpu') or tracemalloc
+    ('memory') and saves the result under METRICS_DIR. kind None does
+    nothing. cProfile output is saved both raw (.prof, for snakeviz or
+    pstats) and as a text summary of the top functions.
+    """
+    if kind is None:
+        yield
+        return
+
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    base = os.path.join(METRICS_DIR, f"profile_{name}_{kind}_{datetime.datetime.now():%Y%m%dT%H%M%S}")
+    if kind == "cpu":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(base + ".prof")
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+            with open(base + ".txt", "w", encoding="utf-8") as f:
+                f.write(summary.getvalue())
+            print(f"CPU profile saved to {base}.prof (summary in {base}.txt).")
+        return
+
+    tracemalloc.start(25)
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(f"Traced memory: {current / 1e6:.1f} MB at exit, {peak / 1e6:.1f} MB peak\n\n")
+            for stat in snapshot.statistics("lineno")[:PROFILE_TOP_N]:
+                f.write(f"{stat}\n")
+        print(f"Memory profile saved to {base}.txt (peak {peak / 1e6:.1f} MB).")
@@ -0,0 +1,210 @@
+import base64
+import binascii
+import quopri
+import re
+from email import policy
+from email.parser import BytesParser
+from html.parser import HTMLParser
+
+# --- Configuration ---
+
+# 1. Max characters of body text kept per email
+MAX_BODY_CHARS = 100_000
+
+# 2. Characters of HTML fed to the converter at a time
+HTML_FEED_SIZE = 64 * 1024
+
+# 3. Max bytes of a raw message handed to the MIME parser. Body parts come
+# before attachments, so cutting off the tail of a huge message keeps
+# parse time and memory bounded without losing the text.
+MAX_PARSE_BYTES = 4 * 1024 * 1024
+
+# Tags whose content is never shown to a reader
+SKIP_TAGS = {'script', 'style', 'head', 'title', 'noscript', 'template'}
+
+# Tags that start a new paragraph / a new line in the text output
+PARAGRAPH_TAGS = {'p', 'div', 'table', 'blockquote', 'section', 'article',
+                  'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ul', 'ol', 'hr'}
+LINE_TAGS = {'br', 'tr', 'li'}
+
+# Table cells, separated by a space so "Amount" and "$50" stay apart
+CELL_TAGS = {'td', 'th'}
+
+WHITESPACE_RE = re.compile(r'\s+')
+BLANK_LINES_RE = re.compile(r'\n{3,}')
+
+
+def parse_message(raw_bytes, max_bytes=MAX_PARSE_BYTES):
+    """
+    Parses raw RFC 822 bytes with the modern email policy (headers come
+    back already decoded). Payloads are not decoded at this point.
+    Only the first max_bytes are parsed; the parser tolerates the
+    truncated tail (an unterminated attachment).
+    """
+    if max_bytes is not None and len(raw_bytes) > max_bytes:
+        raw_bytes = raw_bytes[:max_bytes]
+    return BytesParser(policy=policy.default).parsebytes(raw_bytes)
+
+def get_header(mime_msg, name):
+    """
+    Returns a decoded header as a string, or '' if missing or unparseable.
+    """
+    try:
+        value = mime_msg[name]
+    except Exception:
+        return ""
+    return str(value) if value is not None else ""
+
+def is_attachment(part):
+    """
+    True for parts that should never be decoded for the body: explicit
+    attachments, inline parts with a filename, and any non-text leaf
+    (images, PDFs, calendar files...).
+    """
+    disposition = part.get_content_disposition()
+    if disposition == 'attachment':
+        return True
+    if disposition == 'inline' and part.get_filename():
+        return True
+    if part.get_content_maintype() not in ('text', 'multipart', 'message'):
+        return True
+    return False
+
+def iter_body_parts(part):
+    """
+    Yields the text/plain and text/html leaves of a message, depth first,
+    without descending into attachments (including attached emails).
+    """
+    if is_attachment(part):
+        return
+    if part.is_multipart():
+        for sub in part.iter_parts():
+            yield from iter_body_parts(sub)
+    elif part.get_content_type() in ('text/plain', 'text/html'):
+        yield part
+
+def decode_part(part, max_chars=MAX_BODY_CHARS):
+    """
+    Decodes a text part using its declared charset, reading only as much of
+    the transfer-encoded payload as is needed for roughly max_chars.
+    Unknown charsets fall back to UTF-8; undecodable bytes are replaced.
+    """
+    raw = part.get_payload(decode=False)
+    if not isinstance(raw, str):
+        return ""
+
+    # Worst case a character takes 4 bytes in the charset
+    max_bytes = max_chars * 4
+    encoding = (part.get('Content-Transfer-Encoding') or '7bit').strip().lower()
+
+    if encoding == 'base64':
+        # Base64 expands 3 bytes into 4 characters (plus line breaks)
+        head = ''.join(raw[:max_bytes * 2].split())
+        head = head[:len(head) - len(head) % 4]
+        try:
+            data = base64.b64decode(head)
+        except (binascii.Error, ValueError):
+            return ""
+    elif encoding == 'quoted-printable':
+        data = quopri.decodestring(raw[:max_bytes * 3].encode('ascii', 'replace'))
+    else:
+        # 7bit/8bit: the str payload has already been decoded with the
+        # charset, so take the original bytes instead
+        data = (part.get_payload(decode=True) or b'')[:max_bytes]
+
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        text = data.decode(charset, errors='replace')
+    except LookupError:
+        text = data.decode('utf-8', errors='replace')
+    return text[:max_chars]
+
+
+class HTMLToText(HTMLParser):
+    """
+    Streaming HTML-to-text converter. Feed it HTML in pieces; it keeps
+    visible text only, turns block elements into paragraph breaks, and
+    stops collecting once max_chars of text have been produced.
+    """
+
+    def __init__(self, max_chars=MAX_BODY_CHARS):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.parts = []
+        self.length = 0
+        self.skip_depth = 0
+
+    @property
+    def full(self):
+        return self.length >= self.max_chars
+
+    def _emit(self, text):
+        if not self.full:
+            self.parts.append(text)
+            self.length += len(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in PARAGRAPH_TAGS:
+            self._emit('\n\n')
+        elif tag in LINE_TAGS:
+            self._emit('\n')
+        elif tag in CELL_TAGS:
+            self._emit(' ')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in LINE_TAGS or tag in PARAGRAPH_TAGS:
+            self._emit('\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in PARAGRAPH_TAGS:
+            self._emit('\n\n')
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        text = WHITESPACE_RE.sub(' ', data)
+        if text.strip():
+            self._emit(text)
+
+    def text(self):
+        lines = [line.strip() for line in ''.join(self.parts).split('\n')]
+        text = BLANK_LINES_RE.sub('\n\n', '\n'.join(lines)).strip()
+        return text[:self.max_chars]
+
+def html_to_text(html, max_chars=MAX_BODY_CHARS):
+    """
+    Converts HTML to plain text, feeding the parser in slices so it can
+    stop early once enough text has been collected.
+    """
+    converter = HTMLToText(max_chars)
+    for start in range(0, len(html), HTML_FEED_SIZE):
+        converter.feed(html[start:start + HTML_FEED_SIZE])
+        if converter.full:
+            break
+    converter.close()
+    return converter.text()
+
+def get_email_body(mime_msg, max_chars=MAX_BODY_CHARS):
+    """
+    Returns the body text of a parsed message: the first text/plain part
+    if it has content, otherwise the first text/html part converted to text.
+    Attachments are skipped without decoding, and the result is capped at
+    max_chars.
+    """
+    html_part = None
+    for part in iter_body_parts(mime_msg):
+        if part.get_content_type() == 'text/plain':
+            text = decode_part(part, max_chars).strip()
+            if text:
+                return text
+        elif html_part is None:
+            html_part = part
+
+    if html_part is not None:
+        # Markup takes space too, so read more than max_chars of HTML
+        return html_to_text(decode_part(html_part, max_chars * 10), max_chars)
+    return ""
@@ -0,0 +1,372 @@
+import hashlib
+import re
+import sqlite3
+from collections import Counter
+
+import email_db
+
+# --- Configuration ---
+
+# 1. Max Hamming distance between two 64-bit SimHashes for their chunks
+# to count as near-duplicates
+MAX_HAMMING_DISTANCE = 3
+
+# 2. Number of LSH bands the fingerprint is split into. Must be greater
+# than MAX_HAMMING_DISTANCE so every near-duplicate pair shares a band.
+NUM_BANDS = 4
+
+# 3. Words per shingle when fingerprinting
+SHINGLE_SIZE = 3
+
+# 4. What the stored fingerprints were computed on, kept in sync_state.
+# Fingerprints from an older scheme (paragraph only) are dropped on load.
+FINGERPRINT_TEXT_KEY = "fingerprint_text"
+FINGERPRINT_TEXT = "chunk_text"
+
+BAND_BITS = 64 // NUM_BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+WORD_RE = re.compile(r"\w+")
+
+
+def simhash(text):
+    """
+    64-bit SimHash of a text over its lowercase word shingles.
+    """
+    words = WORD_RE.findall(text.lower())
+    if len(words) >= SHINGLE_SIZE:
+        features = Counter(
+            ' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)
+        )
+    else:
+        features = Counter(words)
+
+    weights = [0] * 64
+    for feature, count in features.items():
+        h = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+        for bit in range(64):
+            if (h >> bit) & 1:
+                weights[bit] += count
+            else:
+                weights[bit] -= count
+
+    fingerprint = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+def to_signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+def release_emails(conn, email_ids, batch_size=500):
+    """
+    Removes the chunk links of the given emails (being deleted or
+    reindexed). Representative chunks left with no source email are
+    dropped from 'chunk_fingerprints' too; their IDs are returned, mapped
+    to their fingerprints, so the caller can delete them from the vector
+    store. The caller commits.
+    """
+    email_ids = list(email_ids)
+    orphaned = {}
+    for start in range(0, len(email_ids), batch_size):
+        ids = email_ids[start:start + batch_size]
+        placeholders = ','.join('?' for _ in ids)
+        chunk_ids = [row[0] for row in conn.execute(
+            f"SELECT DISTINCT chunk_id FROM chunk_sources WHERE email_id IN ({placeholders})", ids
+        )]
+        conn.execute(f"DELETE FROM chunk_sources WHERE email_id IN ({placeholders})", ids)
+        orphaned.update(drop_orphans(conn, chunk_ids, batch_size))
+    return orphaned
+
+def release_links(conn, links, batch_size=500):
+    """
+    Like release_emails, for single (chunk_id, email_id) links: the
+    chunks of a reindexed email whose text changed or that are gone.
+    """
+    links = list(links)
+    conn.executemany("DELETE FROM chunk_sources WHERE chunk_id = ? AND email_id = ?", links)
+    return drop_orphans(conn, sorted({chunk_id for chunk_id, _ in links}), batch_size)
+
+def drop_orphans(conn, chunk_ids, batch_size=500):
+    # Fingerprints of the given chunks no email links to any more; returns
+    # {chunk_id: fingerprint or None} for them
+    orphaned = {}
+    for start in range(0, len(chunk_ids), batch_size):
+        batch = chunk_ids[start:start + batch_size]
+        placeholders = ','.join('?' for _ in batch)
+        still_linked = {row[0] for row in conn.execute(
+            f"SELECT DISTINCT chunk_id FROM chunk_sources WHERE chunk_id IN ({placeholders})", batch
+        )}
+        gone = [chunk_id for chunk_id in batch if chunk_id not in still_linked]
+        if not gone:
+            continue
+        g_placeholders = ','.join('?' for _ in gone)
+        for chunk_id, value in conn.execute(
+            f"SELECT chunk_id, simhash FROM chunk_fingerprints WHERE chunk_id IN ({g_placeholders})", gone
+        ):
+            orphaned[chunk_id] = to_unsigned(value)
+        for chunk_id in gone:
+            orphaned.setdefault(chunk_id, None)
+        conn.execute(f"DELETE FROM chunk_fingerprints WHERE chunk_id IN ({g_placeholders})", gone)
+    return orphaned
+
+def chunks_with_matching_source(db_file, chunk_ids, since=None, until=None, senders=None,
+                                sender_domains=None, categories=None):
+    """
+    Returns the subset of chunk_ids with at least one source email that
+    passes the search filters (see email_db.email_filter_sql). Used for
+    representatives, whose own metadata only describes their first email.
+    """
+    chunk_ids = list(chunk_ids)
+    if not chunk_ids:
+        return set()
+    conditions, params = email_db.email_filter_sql(since, until, senders, sender_domains, categories)
+    conn = sqlite3.connect(db_file)
+    email_db.add_sender_functions(conn)
+    try:
+        matching = set()
+        for start in range(0, len(chunk_ids), 500):
+            batch = chunk_ids[start:start + 500]
+            where = " AND ".join([f"cs.chunk_id IN ({','.join('?' for _ in batch)})"] + conditions)
+            matching.update(row[0] for row in conn.execute(
+                f"SELECT DISTINCT cs.chunk_id FROM chunk_sources cs "
+                f"JOIN emails e ON e.id = cs.email_id WHERE {where}", batch + params
+            ))
+        return matching
+    finally:
+        conn.close()
+
+
+class NearDuplicateFilter:
+    """
+    Collapses near-identical chunks (footers, unsubscribe blocks, legal
+    disclaimers) before embedding. Chunks are compared on their full text,
+    subject included, so a representative reads the same as every chunk
+    it stands in for.
+
+    Fingerprints of already stored chunks are loaded from the database, so
+    duplicates are caught both within a run and against the existing
+    corpus. Each chunk that survives is the 'representative' for its
+    near-duplicates; every email it came from is recorded in the
+    'chunk_sources' table.
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.bands = {}
+        self.fingerprinted = set()
+        self.existing_ids = set()
+        self.new_fingerprints = {}
+        self.links = []
+        self.duplicates_found = 0
+
+        conn = sqlite3.connect(db_file)
+        try:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS chunk_fingerprints (
+                chunk_id TEXT PRIMARY KEY,
+                simhash INTEGER NOT NULL
+            )
+            ''')
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS chunk_sources (
+                chunk_id TEXT NOT NULL,
+                email_id INTEGER NOT NULL,
+                PRIMARY KEY (chunk_id, email_id)
+            )
+            ''')
+            conn.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)")
+            row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (FINGERPRINT_TEXT_KEY,)).fetchone()
+            if row is None or row[0] != FINGERPRINT_TEXT:
+                # Paragraph-only fingerprints would collapse chunks with other
+                # subjects; their chunks stay stored, and get new fingerprints
+                # when their email is reindexed unchanged (keep)
+                conn.execute("DELETE FROM chunk_fingerprints")
+                conn.execute(
+                    "INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+                    (FINGERPRINT_TEXT_KEY, FINGERPRINT_TEXT)
+                )
+            conn.commit()
+            for chunk_id, value in conn.execute("SELECT chunk_id, simhash FROM chunk_fingerprints"):
+                self._index(chunk_id, to_unsigned(value))
+                self.existing_ids.add(chunk_id)
+            # Representatives stored without a fingerprint still exist
+            self.existing_ids.update(row[0] for row in conn.execute("SELECT DISTINCT chunk_id FROM chunk_sources"))
+        finally:
+            conn.close()
+
+    def _index(self, chunk_id, fingerprint):
+        self.fingerprinted.add(chunk_id)
+        for band in range(NUM_BANDS):
+            key = (band, (fingerprint >> (band * BAND_BITS)) & BAND_MASK)
+            self.bands.setdefault(key, []).append((fingerprint, chunk_id))
+
+    def _forget(self, chunk_id, fingerprint):
+        self.fingerprinted.discard(chunk_id)
+        for band in range(NUM_BANDS):
+            key = (band, (fingerprint >> (band * BAND_BITS)) & BAND_MASK)
+            entries = self.bands.get(key, [])
+            if (fingerprint, chunk_id) in entries:
+                entries.remove((fingerprint, chunk_id))
+
+    def _find(self, fingerprint):
+        for band in range(NUM_BANDS):
+            key = (band, (fingerprint >> (band * BAND_BITS)) & BAND_MASK)
+            for other, chunk_id in self.bands.get(key, ()):
+                if bin(fingerprint ^ other).count('1') <= MAX_HAMMING_DISTANCE:
+                    return chunk_id
+        return None
+
+    def filter_chunks(self, email_id, chunks):
+        """
+        Splits one email's chunks into (unique_chunks, duplicate_of).
+        unique_chunks still need embedding; duplicate_of lists the IDs of
+        the representative chunks that the remaining chunks collapse into.
+        Every chunk's 'vector_id' is set to the ID of the vector holding it.
+        """
+        unique_chunks = []
+        duplicate_of = []
+        for chunk in chunks:
+            # The full chunk text (subject included), as embedded and stored,
+            # so chunks only collapse into a representative that reads the same
+            fingerprint = simhash(chunk['text'])
+            representative = self._find(fingerprint)
+            if representative is None:
+                self._index(chunk['id'], fingerprint)
+                self.new_fingerprints[chunk['id']] = fingerprint
+                chunk['vector_id'] = chunk['id']
+                unique_chunks.append(chunk)
+                self.links.append((chunk['id'], email_id))
+            else:
+                chunk['vector_id'] = representative
+                duplicate_of.append(representative)
+                self.links.append((representative, email_id))
+                self.duplicates_found += 1
+        return unique_chunks, duplicate_of
+
+    def keep(self, email_id, chunk_id, text):
+        """
+        Records an unchanged chunk of a reindexed email that is already
+        stored as chunk_id, so its link is kept and later chunks can still
+        collapse into it. A fingerprint lost to a crash (or dropped as
+        outdated) is recomputed.
+        """
+        self.links.append((chunk_id, email_id))
+        if chunk_id not in self.fingerprinted:
+            fingerprint = simhash(text)
+            self._index(chunk_id, fingerprint)
+            self.new_fingerprints[chunk_id] = fingerprint
+
+    def release_emails(self, email_ids, collection=None):
+        """
+        Unlinks already indexed emails before they are reindexed (see
+        release_emails). Chunks no other email uses are deleted from the
+        collection and will no longer match as near-duplicates.
+        """
+        return self._release(release_emails, email_ids, collection)
+
+    def release_links(self, links, collection=None):
+        """
+        Unlinks single (chunk_id, email_id) links, like release_emails.
+        """
+        return self._release(release_links, links, collection)
+
+    def _release(self, release, items, collection):
+        conn = sqlite3.connect(self.db_file)
+        try:
+            with conn:
+                orphaned = release(conn, items)
+        finally:
+            conn.close()
+
+        for chunk_id, fingerprint in orphaned.items():
+            if fingerprint is not None:
+                self._forget(chunk_id, fingerprint)
+            self.existing_ids.discard(chunk_id)
+        if collection is not None and orphaned:
+            collection.delete(ids=list(orphaned))
+        return len(orphaned)
+
+    def save(self, stored_ids, collection=None):
+        """
+        Persists fingerprints of the representatives stored this run and
+        the email links of every stored representative. If a collection is
+        given, representatives that gained emails get a 'source_email_ids'
+        metadata field listing all of them and are flagged 'shared' (their
+        sender and category are the first email's; searches filtering on
+        those check the other sources with chunks_with_matching_source),
+        and their 'received_at' is moved to the newest source so
+        time-window queries still find them.
+        Can be called repeatedly during a run: saved representatives then
+        count as existing ones, and only later links are saved next time.
+        """
+        kept_links = [
+            (chunk_id, email_id) for chunk_id, email_id in self.links
+            if chunk_id in stored_ids or chunk_id in self.existing_ids
+        ]
+        saved_fingerprints = {
+            chunk_id: fingerprint for chunk_id, fingerprint in self.new_fingerprints.items()
+            if chunk_id in stored_ids
+        }
+        # Representatives that may now have more than their own email: new
+        # ones linked twice here, or existing ones that gained a link. Which
+        # really are shared is decided by the links stored in chunk_sources.
+        counts = Counter(chunk_id for chunk_id, _ in kept_links)
+        candidates = [
+            chunk_id for chunk_id, count in counts.items()
+            if count > 1 or chunk_id in self.existing_ids
+        ]
+        self.existing_ids.update(saved_fingerprints)
+        self.new_fingerprints = {}
+        self.links = []
+
+        conn = sqlite3.connect(self.db_file)
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO chunk_fingerprints (chunk_id, simhash) VALUES (?, ?)",
+                    [(chunk_id, to_signed(fingerprint)) for chunk_id, fingerprint in saved_fingerprints.items()]
+                )
+                conn.executemany(
+                    "INSERT OR IGNORE INTO chunk_sources (chunk_id, email_id) VALUES (?, ?)",
+                    kept_links
+                )
+
+            if collection is None:
+                return
+
+            for start in range(0, len(candidates), 500):
+                ids = candidates[start:start + 500]
+                placeholders = ','.join('?' for _ in ids)
+                sources = {}
+                newest = {}
+                for chunk_id, email_id, received_at in conn.execute(
+                    f"SELECT cs.chunk_id, cs.email_id, e.received_at FROM chunk_sources cs "
+                    f"LEFT JOIN emails e ON e.id = cs.email_id "
+                    f"WHERE cs.chunk_id IN ({placeholders}) ORDER BY cs.email_id", ids
+                ):
+                    sources.setdefault(chunk_id, []).append(str(email_id))
+                    if received_at is not None:
+                        epoch = email_db.to_epoch_seconds(received_at)
+                        newest[chunk_id] = max(newest.get(chunk_id, 0), epoch)
+
+                shared = [chunk_id for chunk_id in ids if len(sources.get(chunk_id, [])) > 1]
+                if not shared:
+                    continue
+                existing = collection.get(ids=shared, include=['metadatas'])
+                metadatas = []
+                for chunk_id, metadata in zip(existing['ids'], existing['metadatas']):
+                    metadata = dict(metadata or {})
+                    metadata['source_email_ids'] = ','.join(sources.get(chunk_id, []))
+                    metadata['shared'] = True
+                    if chunk_id in newest:
+                        metadata['received_at'] = max(metadata.get('received_at', 0), newest[chunk_id])
+                    metadatas.append(metadata)
+                if metadatas:
+                    collection.update(ids=existing['ids'], metadatas=metadatas)
+        finally:
+            conn.close()
@@ -0,0 +1,229 @@
+import argparse
+import datetime
+import sqlite3
+import sys
+import time
+import traceback
+
+import metrics
+
+# Stage modules (and through them the vector store and the Google SDKs) are
+# imported inside the stages, so only the selected stages pay for them.
+
+# --- Configuration ---
+
+# 1. Pipeline stages, in run order
+STAGES = ("fetch", "index", "generate", "send")
+
+# 2. Stage checkpoints (kept apart from the files cron_job.sh clears)
+STATE_DB_FILE = "pipeline_state.db"
+
+
+class PipelineContext:
+    """
+    Clients shared by every stage of one run: the authenticated Gmail
+    service, the embedding backend (and through it the Gemini client) and
+    the vector-store client. Each is created the first time a stage needs it.
+    """
+
+    def __init__(self):
+        self.gmail_creds = None
+        self.gmail_service = None
+        self.embedder = None
+        self.chroma_client = None
+        self.report_filename = None
+
+    def get_gmail_service(self):
+        if self.gmail_service is None:
+            import gmail_fetcher
+            from googleapiclient.discovery import build
+            self.gmail_creds = gmail_fetcher.get_credentials()
+            self.gmail_service = build('gmail', 'v1', credentials=self.gmail_creds)
+        return self.gmail_service
+
+    def get_chroma_client(self, path):
+        if self.chroma_client is None:
+            import vector_store
+            self.chroma_client = vector_store.get_client(path)
+        return self.chroma_client
+
+
+def stage_fetch(ctx, args):
+    import gmail_fetcher
+    max_messages = gmail_fetcher.MAX_MESSAGES if args.max_messages is None else args.max_messages
+    workers = gmail_fetcher.FETCH_WORKERS if args.workers is None else args.workers
+    if args.stream:
+        # Index while fetching; the index stage then only picks up leftovers
+        import indexing
+        import streaming_ingest
+        if ctx.embedder is None:
+            ctx.embedder = indexing.get_embedder()
+            if ctx.embedder is None:
+                return False
+        return streaming_ingest.run(ctx.get_gmail_service(), ctx.gmail_creds, args.full,
+                                    max_messages or None, workers, ctx.embedder,
+                                    ctx.get_chroma_client(indexing.CHROMA_PATH))
+    return gmail_fetcher.run(ctx.get_gmail_service(), ctx.gmail_creds, full=args.full,
+                             max_messages=max_messages or None, workers=workers)
+
+def stage_index(ctx, args):
+    import indexing
+    if ctx.embedder is None:
+        ctx.embedder = indexing.get_embedder()
+        if ctx.embedder is None:
+            return False
+    return indexing.run(ctx.embedder, ctx.get_chroma_client(indexing.CHROMA_PATH))
+
+def stage_generate(ctx, args):
+    import report_generation
+    # Reuses the embedder and vector-store client if the index stage ran
+    ctx.report_filename = report_generation.run(args.no_cache, ctx.embedder, ctx.chroma_client)
+    return ctx.report_filename is not None
+
+def stage_send(ctx, args):
+    import send_report
+    return send_report.run(ctx.get_gmail_service(), ctx.report_filename)
+
+STAGE_FUNCTIONS = {
+    "fetch": stage_fetch,
+    "index": stage_index,
+    "generate": stage_generate,
+    "send": stage_send,
+}
+
+
+def setup_state_db(state_db=STATE_DB_FILE):
+    """
+    Creates the 'pipeline_stages' checkpoint table: one row per run and
+    stage with its status ('running', 'done' or 'failed').
+    """
+    conn = sqlite3.connect(state_db)
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS pipeline_stages (
+        run_id TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        status TEXT NOT NULL,
+        started_at TEXT,
+        finished_at TEXT,
+        error TEXT,
+        PRIMARY KEY (run_id, stage)
+    )
+    ''')
+    conn.commit()
+    conn.close()
+
+def get_completed_stages(run_id, state_db=STATE_DB_FILE):
+    conn = sqlite3.connect(state_db)
+    try:
+        rows = conn.execute(
+            "SELECT stage FROM pipeline_stages WHERE run_id = ? AND status = 'done'", (run_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return {stage for stage, in rows}
+
+def record_stage(run_id, stage, status, error=None, state_db=STATE_DB_FILE):
+    now = datetime.datetime.now().isoformat(' ', 'seconds')
+    conn = sqlite3.connect(state_db)
+    try:
+        with conn:
+            if status == "running":
+                conn.execute(
+                    "INSERT OR REPLACE INTO pipeline_stages (run_id, stage, status, started_at) "
+                    "VALUES (?, ?, ?, ?)", (run_id, stage, status, now)
+                )
+            else:
+                conn.execute(
+                    "UPDATE pipeline_stages SET status = ?, finished_at = ?, error = ? "
+                    "WHERE run_id = ? AND stage = ?", (status, now, error, run_id, stage)
+                )
+    finally:
+        conn.close()
+
+def run_pipeline(stages, run_id, resume=False, args=None, state_db=STATE_DB_FILE):
+    """
+    Runs the given stages in order in this process, sharing clients
+    between them. Each stage is checkpointed; with resume, stages already
+    done for run_id are skipped, so a failed run restarts at the stage
+    that failed. Stops at the first failing stage.
+    Returns True if every stage succeeded.
+    """
+    setup_state_db(state_db)
+    metrics.set_run_id(run_id)
+    completed = get_completed_stages(run_id, state_db) if resume else set()
+    ctx = PipelineContext()
+
+    for stage in stages:
+        if stage in completed:
+            print(f"--- Skipping stage '{stage}' (already done for run {run_id}) ---")
+            continue
+
+        print(f"\n--- Running stage '{stage}' (run {run_id}) ---")
+        record_stage(run_id, stage, "running", state_db=state_db)
+        started = time.monotonic()
+        try:
+            ok = STAGE_FUNCTIONS[stage](ctx, args)
+            error = None if ok else "stage reported failure"
+        except Exception as e:
+            traceback.print_exc()
+            ok = False
+            error = f"{type(e).__name__}: {e}"
+
+        elapsed = time.monotonic() - started
+        if not ok:
+            record_stage(run_id, stage, "failed", error, state_db=state_db)
+            print(f"--- Stage '{stage}' failed after {elapsed:.1f}s: {error} ---")
+            print(f"Fix the problem and rerun with --resume --run-id {run_id} to continue from here.")
+            return False
+
+        record_stage(run_id, stage, "done", state_db=state_db)
+        print(f"--- Stage '{stage}' done in {elapsed:.1f}s ---")
+    return True
+
+def parse_stages(value):
+    stages = [stage.strip() for stage in value.split(',') if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            f"unknown stage(s) {', '.join(unknown)}; choose from {', '.join(STAGES)}"
+        )
+    # Always run in pipeline order, whatever order they were given in
+    return [stage for stage in STAGES if stage in stages]
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run fetch -> index -> generate -> send in a single process."
+    )
+    parser.add_argument('--stages', type=parse_stages, default=list(STAGES),
+                        help=f"Comma-separated stages to run (default: {','.join(STAGES)}).")
+    parser.add_argument('--resume', action='store_true',
+                        help="Skip stages already completed for this run ID.")
+    parser.add_argument('--run-id', default=datetime.date.today().strftime("%Y-%m-%d"),
+                        help="Checkpoint key for this run (default: today's date).")
+    # Passed through to the stages
+    parser.add_argument('--full', action='store_true',
+                        help="fetch: ignore the stored historyId and do a full listing.")
+    parser.add_argument('--max-messages', type=int,
+                        help="fetch: upper bound on messages ingested (0 = no limit).")
+    parser.add_argument('--workers', type=int,
+                        help="fetch: concurrent fetch threads (0 = batch endpoint).")
+    parser.add_argument('--stream', action='store_true',
+                        help="fetch: index each email as it arrives (streaming mode).")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="generate: bypass the response cache.")
+    metrics.add_profile_argument(parser)
+    return parser.parse_args()
+
+def main():
+    """
+    Runs the selected pipeline stages; exits non-zero if one fails.
+    """
+    args = parse_args()
+    with metrics.profiled(args.profile, "pipeline"):
+        ok = run_pipeline(args.stages, args.run_id, args.resume, args)
+    metrics.flush("pipeline")
+    if not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import random
+import threading
+import time
+
+import metrics
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+    Tokens refill continuously at 'rate' per second, up to 'capacity'.
+    Callers block in acquire() until enough tokens are available.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Takes 'tokens' from the bucket, sleeping until they are available.
+        """
+        if tokens > self.capacity:
+            raise ValueError(f"Cannot acquire {tokens} tokens from a bucket of {self.capacity}")
+
+        while True:
+            wait = self._take(tokens)
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self, tokens=1):
+        """
+        Takes 'tokens' if they are available right now; never blocks.
+        Returns True on success.
+        """
+        return self._take(tokens) == 0
+
+    def _take(self, tokens):
+        # Returns 0 if the tokens were taken, otherwise the seconds to wait
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+
+def retry_with_backoff(func, is_retryable, max_retries=5, base_delay=1.0, max_delay=32.0,
+                       name="other"):
+    """
+    Calls func() and retries it when it raises an error for which
+    is_retryable(error) is true, using exponential backoff with full jitter.
+    The last error is re-raised once max_retries is exhausted.
+    Retries are counted in the 'retries_total' metric under name.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+            metrics.inc("retries_total", call=name)
+            print(f"  > Retryable error ({e}); retrying in {delay:.1f}s "
+                  f"(attempt {attempt + 1}/{max_retries})...")
+            time.sleep(delay)
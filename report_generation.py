@@ -1,6 +1,19 @@
-import chromadb
 import google.generativeai as genai
+import argparse
 import datetime
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import context_builder
+import email_db
+import embedders
+import embedding_cache
+import metrics
+import near_dedup
+import rate_limit
+import response_cache
+import vector_store
 
 # --- Configuration ---
 
@@ -17,13 +30,83 @@ EMBEDDING_MODEL = "models/text-embedding-004"
 # 4. Generation model (for writing the report)
 GENERATION_MODEL = "gemini-2.5-flash"
 
-# 5. How many email chunks to send to the LLM for context
-TOP_K_RESULTS = 5
+# 5. How many candidate chunks each search returns. The context builder
+# then picks from them until context_builder.CONTEXT_TOKEN_BUDGET is used.
+CANDIDATE_POOL_SIZE = 30
 
+# 6. Database file from Phase 1 (used for keyword search)
+DB_FILE = "my_emails.db"
 
-def initialize_services():
+# 7. Retrieval mode: "hybrid" (BM25 + vectors, fused), "vector" or "bm25"
+RETRIEVAL_MODE = "hybrid"
+
+# 8. Reciprocal rank fusion constant (60 is the usual choice)
+RRF_K = 60
+
+# 9. Only use emails received in the last N hours (None = whole corpus)
+REPORT_WINDOW_HOURS = 24
+
+# 10. Sections generated concurrently (1 = one after another)
+SECTION_WORKERS = 5
+
+# 11. Per-call timeout and retries for generate_content
+GENERATION_TIMEOUT_SECONDS = 120
+GENERATION_MAX_RETRIES = 3
+
+# 12. Reuse generated sections when the model, prompts and retrieved
+# chunks are unchanged (see response_cache.py; --no-cache bypasses it)
+USE_RESPONSE_CACHE = True
+
+# 13. Search each section only among emails labelled with its category at
+# index time (see email_categories.py). A routed search that finds fewer
+# than MIN_ROUTED_CANDIDATES candidates is repeated without the label
+# filter, so mail the classifier got wrong is still found.
+ROUTE_SECTIONS_BY_CATEGORY = True
+MIN_ROUTED_CANDIDATES = 5
+
+# 14. Map-reduce: a section whose candidates do not fit
+# context_builder.CONTEXT_TOKEN_BUDGET is searched again for up to
+# MAP_REDUCE_POOL_SIZE candidates, summarized in groups of
+# MAP_GROUP_TOKEN_BUDGET tokens (up to MAP_WORKERS at a time), then the
+# partial summaries are combined. Partial summaries that still fill more
+# than one group are summarized again, for up to MAX_MAP_LEVELS levels;
+# after that the rest are combined in one prompt. False disables it.
+USE_MAP_REDUCE = True
+MAP_REDUCE_POOL_SIZE = 100
+MAP_GROUP_TOKEN_BUDGET = 4000
+MAP_WORKERS = 4
+MAX_MAP_LEVELS = 3
+
+# 15. Most generate_content calls in flight at once, shared by every
+# section worker and map-reduce group so they stay within the LLM quota
+MAX_CONCURRENT_GENERATIONS = 5
+
+MAP_SYSTEM_PROMPT = """
+    You are extracting facts for one section of a daily email report.
+    - Read the email context provided.
+    - List every item that answers the query as a short bullet point, keeping names, dates and amounts.
+    - Do not add commentary or introductions.
+    - If nothing in the context answers the query, write only: NONE
+    """
+
+SECTION_ERROR_TEXT = "Error generating this section."
+
+# One GenerativeModel per system prompt, shared across sections and threads
+_models = {}
+_models_lock = threading.Lock()
+
+# Slots for generate_content calls (MAX_CONCURRENT_GENERATIONS)
+_generation_slots = threading.BoundedSemaphore(max(1, MAX_CONCURRENT_GENERATIONS))
+
+
+def initialize_services(embedder=None, chroma_client=None):
     """
-    Initializes and validates both the ChromaDB client and the Gemini API.
+    Initializes and validates the vector store, the Gemini API (for
+    generation) and the embedding backend (for queries). An embedder and
+    a vector-store client already set up by another stage can be passed in.
+    Returns (collection, gemini, embedder), or Nones on failure.
+    If the vector store or embedder is unavailable but keyword search can
+    be used, collection and embedder are None and gemini is still returned.
     """
     print("Initializing services...")
     
@@ -34,70 +117,360 @@ def initialize_services():
         print("https://aistudio.google.com/app/apikey")
         print("and paste it into the GOOGLE_API_KEY variable.")
         print("="*50)
-        return None, None
+        return None, None, None
     
     try:
         genai.configure(api_key=GOOGLE_API_KEY)
-        # Test API key
-        _ = genai.embed_content(model=EMBEDDING_MODEL, content="test", task_type="retrieval_query")
         print("Google API Key configured successfully.")
     except Exception as e:
         print(f"Error configuring Google API: {e}")
-        return None, None
+        return None, None, None
+
+    keyword_fallback = RETRIEVAL_MODE != "vector" and os.path.exists(DB_FILE)
+    if RETRIEVAL_MODE == "bm25":
+        print("Retrieval mode 'bm25': skipping the vector store.")
+        return None, genai, None
 
-    # --- ChromaDB Check ---
     try:
-        client = chromadb.PersistentClient(path=CHROMA_PATH)
+        if embedder is None:
+            embedder = embedders.get_embedder(GOOGLE_API_KEY, EMBEDDING_MODEL)
+            # Validate the setup with a test call (skipped if a recent probe succeeded)
+            if embedders.PROBE_EMBEDDER:
+                embedder.probe()
+    except Exception as e:
+        print(f"Error configuring the embedding backend: {e}")
+        if keyword_fallback:
+            print("Falling back to keyword (BM25) search only.")
+            return None, genai, None
+        return None, None, None
+
+    # --- Vector Store Check ---
+    try:
+        client = chroma_client or vector_store.get_client(CHROMA_PATH)
         collection = client.get_collection(name="emails")
-        print(f"ChromaDB collection 'emails' loaded. Total documents: {collection.count()}")
+        print(f"Vector store collection 'emails' loaded. Total documents: {collection.count()}")
     except Exception as e:
-        print(f"Error connecting to ChromaDB at {CHROMA_PATH}: {e}")
+        print(f"Error opening the vector store at {vector_store.store_path(CHROMA_PATH)}: {e}")
+        if keyword_fallback:
+            print("Falling back to keyword (BM25) search only.")
+            return None, genai, None
         print("Please ensure Phase 2 has been run at least once.")
-        return None, None
+        return None, None, None
 
-    return collection, genai
+    return collection, genai, embedder
 
-def query_vector_db(collection, query_text, k=TOP_K_RESULTS):
+def build_where(since=None, until=None, senders=None, sender_domains=None, categories=None,
+                shared=False):
     """
-    Embeds the query and retrieves the top-k most relevant text chunks
-    from the vector database.
+    Builds a Chroma 'where' clause from a time window (epoch seconds,
+    since inclusive / until exclusive), sender address/domain lists and
+    index-time category labels. shared restricts it to near-duplicate
+    representatives (see near_dedup.NearDuplicateFilter.save).
+    Returns None when there is nothing to filter on.
     """
-    print(f"\nQuerying vector DB for: '{query_text[:50]}...'")
-    
-    # 1. Embed the query
-    result = genai.embed_content(
-        model=EMBEDDING_MODEL,
-        content=query_text,
-        task_type="retrieval_query" # Important: specifies this is for search
-    )
-    query_embedding = result['embedding']
-    
-    # 2. Query ChromaDB
-    # 'n_results' is the number of results to return (our k)
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=k
-    )
-    
-    # Extract the 'documents' (the original text chunks)
-    # The 'documents' list is nested, so we access the first (and only) query's results
-    retrieved_chunks = results['documents'][0]
-    
-    print(f"  > Found {len(retrieved_chunks)} relevant chunks.")
-    return retrieved_chunks
+    conditions = []
+    if since is not None:
+        conditions.append({'received_at': {'$gte': int(since)}})
+    if until is not None:
+        conditions.append({'received_at': {'$lt': int(until)}})
+    if senders:
+        conditions.append({'sender': {'$in': [address.lower() for address in senders]}})
+    if sender_domains:
+        conditions.append({'sender_domain': {'$in': [domain.lower() for domain in sender_domains]}})
+    if categories:
+        conditions.append({'category': {'$in': list(categories)}})
+    if shared:
+        conditions.append({'shared': True})
+
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {'$and': conditions}
+
+def embed_queries(embedder, query_texts, cache=None):
+    """
+    Embeds all query texts with at most one API call. Vectors are looked
+    up in (and saved to) the persistent embedding cache, keyed by query
+    text and model, so a warm cache needs no embed call at all.
+    """
+    vectors = [None] * len(query_texts)
+    if cache is not None:
+        vectors = cache.get_many(query_texts, embedder.model_name, "retrieval_query")
+
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        # "retrieval_query" specifies these are for search
+        new_vectors = embedder.embed([query_texts[i] for i in missing], "retrieval_query")
+        for i, vector in zip(missing, new_vectors):
+            vectors[i] = vector
+        if cache is not None:
+            cache.put_many([query_texts[i] for i in missing], new_vectors,
+                           embedder.model_name, "retrieval_query")
+        print(f"  > Embedded {len(missing)} queries ({len(query_texts) - len(missing)} cached).")
+    else:
+        print(f"  > All {len(query_texts)} query embeddings served from cache.")
+    return vectors
+
+def query_vector_db(collection, query_embeddings, k=CANDIDATE_POOL_SIZE, since=None,
+                    until=None, senders=None, sender_domains=None, categories=None):
+    """
+    Retrieves the top-k most relevant text chunks for every query
+    embedding with a single vector-store query. The time window, sender
+    and category filters are passed as a Chroma-style 'where' clause
+    (both backends accept it), so filtering happens in the store.
+    A near-duplicate representative carries its first email's sender and
+    category, so with sender or category filters the shared
+    representatives are searched too and kept if any of their source
+    emails passes the filters.
+    Returns one list of hits ({'id', 'text', 'email_id', 'source'}) per
+    query, best first.
+    """
+    # 'n_results' is the number of results to return per query (our k)
+    with metrics.span("external_call_seconds", service="vector_store", call="query"):
+        results = collection.query(
+            query_embeddings=query_embeddings,
+            n_results=k,
+            where=build_where(since, until, senders, sender_domains, categories)
+        )
+    ranked = [
+        list(zip(distances, ids, documents, metadatas))
+        for ids, documents, metadatas, distances in zip(
+            results['ids'], results['documents'], results['metadatas'], results['distances']
+        )
+    ]
+
+    if senders or sender_domains or categories:
+        with metrics.span("external_call_seconds", service="vector_store", call="query"):
+            shared = collection.query(
+                query_embeddings=query_embeddings,
+                n_results=k,
+                where=build_where(since, until, shared=True)
+            )
+        matching = near_dedup.chunks_with_matching_source(
+            DB_FILE, {chunk_id for ids in shared['ids'] for chunk_id in ids},
+            since, until, senders, sender_domains, categories
+        )
+        for hits, ids, documents, metadatas, distances in zip(
+            ranked, shared['ids'], shared['documents'], shared['metadatas'], shared['distances']
+        ):
+            seen = {chunk_id for _, chunk_id, _, _ in hits}
+            hits.extend(hit for hit in zip(distances, ids, documents, metadatas)
+                        if hit[1] in matching and hit[1] not in seen)
+            hits.sort(key=lambda hit: hit[0])
+            del hits[k:]
+
+    # The result lists are nested: one inner list per query
+    return [
+        [
+            {'id': chunk_id, 'text': text, 'email_id': (metadata or {}).get('email_id'),
+             'source': 'vector'}
+            for _, chunk_id, text, metadata in hits
+        ]
+        for hits in ranked
+    ]
+
+def query_keyword_index(query_text, k=CANDIDATE_POOL_SIZE, since=None, until=None,
+                        senders=None, sender_domains=None, categories=None):
+    """
+    BM25 search over the emails table, with the same filters as
+    query_vector_db. Returns hits shaped like query_vector_db's, with the
+    best-matching body snippet as the text.
+    """
+    return [
+        {
+            'id': f"email_{hit['email_id']}_fts",
+            'text': f"Email Subject: {hit['subject']}\n\n{hit['snippet']}",
+            'email_id': hit['email_id'],
+            'source': 'bm25',
+        }
+        for hit in email_db.search_emails(DB_FILE, query_text, k, since, until,
+                                          senders, sender_domains, categories)
+    ]
+
+def reciprocal_rank_fusion(ranked_lists, k=RRF_K, with_scores=False):
+    """
+    Fuses several ranked hit lists at the email level:
+    score(email) = sum over lists of 1 / (k + rank of its best hit).
+    Returns [(email_id, hits)] best first, where hits keeps each list's
+    hits for that email in list order (vector chunks before snippets).
+    With with_scores, each entry also carries the fused score.
+    """
+    scores = {}
+    hits_by_email = {}
+    for hits in ranked_lists:
+        seen = set()
+        for rank, hit in enumerate(hits, start=1):
+            email_id = hit['email_id']
+            hits_by_email.setdefault(email_id, []).append(hit)
+            if email_id not in seen:
+                seen.add(email_id)
+                scores[email_id] = scores.get(email_id, 0.0) + 1.0 / (k + rank)
+
+    ordered = sorted(scores, key=lambda email_id: scores[email_id], reverse=True)
+    if with_scores:
+        return [(email_id, hits_by_email[email_id], scores[email_id]) for email_id in ordered]
+    return [(email_id, hits_by_email[email_id]) for email_id in ordered]
+
+def fused_candidates(ranked_lists):
+    """
+    Fuses ranked hit lists with reciprocal rank fusion and returns every
+    candidate chunk with a 'score', best first. For each fused email its
+    vector chunks are used; emails found only by keyword search contribute
+    their best-matching snippet. A chunk scores its email's fused score
+    plus its own reciprocal rank, so better chunks of one email come first.
+    """
+    candidates = []
+    seen_texts = set()
+    for _, hits, email_score in reciprocal_rank_fusion(ranked_lists, with_scores=True):
+        vector_hits = [hit for hit in hits if hit['source'] == 'vector']
+        for rank, hit in enumerate(vector_hits or hits[:1], start=1):
+            if hit['text'] not in seen_texts:
+                seen_texts.add(hit['text'])
+                candidates.append(dict(hit, score=email_score + 1.0 / (RRF_K + rank)))
+    candidates.sort(key=lambda hit: hit['score'], reverse=True)
+    return candidates
 
-def generate_section(gemini_model, system_prompt, query, context_chunks):
+def select_context(ranked_lists, token_budget=context_builder.CONTEXT_TOKEN_BUDGET):
+    """
+    Fuses ranked hit lists and packs the best, non-redundant chunks into
+    the token budget (see context_builder.build_context).
+    """
+    return context_builder.build_context(fused_candidates(ranked_lists), token_budget)
+
+def retrieve_candidates(collection, embedder, query_texts, k=CANDIDATE_POOL_SIZE, since=None,
+                        until=None, senders=None, sender_domains=None, cache=None,
+                        categories=None):
+    """
+    Retrieves the candidate chunks for each query. All queries are embedded
+    in one batch (or served from the cache) and sent to Chroma together;
+    BM25 runs locally per query. Each search returns k candidates; they
+    are fused with reciprocal rank fusion (whichever searches
+    RETRIEVAL_MODE allows), and chunks from an email already represented
+    or with near-identical text are dropped.
+    since/until/senders/sender_domains restrict both searches. categories,
+    if given, holds one list of category labels (or None) per query;
+    queries sharing the same labels go to Chroma together. A labelled
+    query with fewer than MIN_ROUTED_CANDIDATES candidates is searched
+    again without its labels.
+    Returns one list of scored chunk hits ({'id', 'text', 'email_id',
+    'source', 'score'}) per query, best first, in query order.
+    """
+    print(f"\nRetrieving context for {len(query_texts)} queries...")
+
+    filters = {'since': since, 'until': until, 'senders': senders,
+               'sender_domains': sender_domains}
+
+    if categories is None:
+        categories = [None] * len(query_texts)
+
+    query_embeddings = None
+    if collection is not None and RETRIEVAL_MODE in ("hybrid", "vector"):
+        query_embeddings = embed_queries(embedder, query_texts, cache)
+
+    def search(indexes, labels_of):
+        # Candidates for the given queries, searched with labels_of[i]
+        vector_results = {i: [] for i in indexes}
+        if query_embeddings is not None:
+            # A Chroma query has a single 'where' clause, so group queries by labels
+            groups = {}
+            for i in indexes:
+                groups.setdefault(tuple(labels_of[i] or ()), []).append(i)
+            for labels, group in groups.items():
+                # Over-fetch so the context builder has candidates to choose from
+                results = query_vector_db(collection, [query_embeddings[i] for i in group], k,
+                                          categories=list(labels), **filters)
+                for i, hits in zip(group, results):
+                    vector_results[i] = hits
+
+        found = {}
+        for i in indexes:
+            ranked_lists = [vector_results[i]]
+            if RETRIEVAL_MODE in ("hybrid", "bm25") or collection is None:
+                ranked_lists.append(query_keyword_index(query_texts[i], k, categories=labels_of[i],
+                                                        **filters))
+            found[i] = context_builder.drop_redundant(fused_candidates(ranked_lists))
+        return found
+
+    candidates = search(range(len(query_texts)), categories)
+    thin = [i for i, labels in enumerate(categories)
+            if labels and len(candidates[i]) < MIN_ROUTED_CANDIDATES]
+    if thin:
+        print(f"  > {len(thin)} routed searches found fewer than {MIN_ROUTED_CANDIDATES} "
+              f"candidates; searching them across all categories.")
+        candidates.update(search(thin, [None] * len(query_texts)))
+
+    for i, query_text in enumerate(query_texts):
+        print(f"  > Found {len(candidates[i])} candidate chunks for: '{query_text[:50]}...'")
+    return [candidates[i] for i in range(len(query_texts))]
+
+def pack_context(candidates, token_budget=context_builder.CONTEXT_TOKEN_BUDGET):
+    """
+    Packs one query's candidates into token_budget (see
+    context_builder.build_context).
+    """
+    context_chunks = context_builder.build_context(candidates, token_budget)
+    tokens = sum(context_builder.estimate_tokens(hit['text']) for hit in context_chunks)
+    print(f"  > Using {len(context_chunks)} of {len(candidates)} chunks (~{tokens} tokens) as context.")
+    return context_chunks
+
+def retrieve_contexts(collection, embedder, query_texts, k=CANDIDATE_POOL_SIZE, since=None,
+                      until=None, senders=None, sender_domains=None, cache=None,
+                      token_budget=context_builder.CONTEXT_TOKEN_BUDGET, categories=None):
+    """
+    Retrieves candidates for each query (see retrieve_candidates) and
+    packs each query's best, non-redundant chunks into token_budget.
+    Returns one list of chunk hits ({'id', 'text', 'email_id', 'source'})
+    per query, in query order.
+    """
+    candidate_lists = retrieve_candidates(collection, embedder, query_texts, k, since, until,
+                                          senders, sender_domains, cache, categories)
+    return [pack_context(candidates, token_budget) for candidates in candidate_lists]
+
+def retrieve_context(collection, embedder, query_text, k=CANDIDATE_POOL_SIZE, **filters):
+    """
+    Single-query form of retrieve_contexts.
+    """
+    return retrieve_contexts(collection, embedder, [query_text], k, **filters)[0]
+
+def get_generation_model(gemini_model, system_prompt):
+    """
+    Returns the GenerativeModel for a system prompt, creating it once.
+    """
+    with _models_lock:
+        model = _models.get(system_prompt)
+        if model is None:
+            model = gemini_model.GenerativeModel(
+                model_name=GENERATION_MODEL,
+                system_instruction=system_prompt
+            )
+            _models[system_prompt] = model
+        return model
+
+def generate_section(gemini_model, system_prompt, query, context_chunks, cache=None):
     """
     Calls the Gemini API with a system prompt, context, and a query
-    to generate a single section of the report.
+    to generate a single section of the report. Each call has a timeout,
+    waits for one of the MAX_CONCURRENT_GENERATIONS slots, and rate-limit
+    or transient errors are retried with backoff.
+    If a response cache is given, an unchanged prompt/context is answered
+    from it and new successful responses are stored in it.
     """
     if not context_chunks:
         return "No relevant information found in today's emails."
+
+    cache_key = None
+    if cache is not None:
+        cache_key = response_cache.response_key(GENERATION_MODEL, system_prompt, query, context_chunks)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            print("  > Section served from the response cache.")
+            return cached
     
     print(f"  > Calling LLM to generate report section...")
 
     # Build the context string
-    context_str = "\n\n---\n\n".join(context_chunks)
+    context_str = "\n\n---\n\n".join(chunk['text'] for chunk in context_chunks)
     
     # Construct the full prompt
     full_prompt = f"""
@@ -111,30 +484,117 @@ def generate_section(gemini_model, system_prompt, query, context_chunks):
     """
     
     try:
-        # Set up the generation model
-        model = gemini_model.GenerativeModel(
-            model_name=GENERATION_MODEL,
-            system_instruction=system_prompt
-        )
+        # Reuse the generation model for this system prompt
+        model = get_generation_model(gemini_model, system_prompt)
         
         # Make the API call
-        response = model.generate_content(full_prompt)
+        def call():
+            # Held for the call only, not while backing off between retries
+            with _generation_slots, metrics.span("external_call_seconds", service="gemini",
+                                                 call="generate_content"):
+                return model.generate_content(
+                    full_prompt,
+                    request_options={'timeout': GENERATION_TIMEOUT_SECONDS}
+                )
+        response = rate_limit.retry_with_backoff(
+            call, embedders.is_retryable_error, max_retries=GENERATION_MAX_RETRIES,
+            name="generate"
+        )
         
-        return response.text.strip()
+        text = response.text.strip()
+        record_token_usage(response, full_prompt, text)
+        if cache is not None:
+            cache.put(cache_key, text)
+        return text
         
     except Exception as e:
         print(f"  > ERROR generating text: {e}")
-        return "Error generating this section."
+        return SECTION_ERROR_TEXT
 
-def main():
+def record_token_usage(response, prompt, text):
     """
-    Main function to run the full RAG pipeline and generate the report.
+    Counts a generation's prompt and output tokens, from the response's
+    usage metadata when the API reports it, otherwise estimated.
+    """
+    usage = getattr(response, 'usage_metadata', None)
+    prompt_tokens = getattr(usage, 'prompt_token_count', None)
+    output_tokens = getattr(usage, 'candidates_token_count', None)
+    if prompt_tokens is None:
+        prompt_tokens = context_builder.estimate_tokens(prompt)
+    if output_tokens is None:
+        output_tokens = context_builder.estimate_tokens(text)
+    metrics.inc("tokens_total", prompt_tokens, kind="prompt")
+    metrics.inc("tokens_total", output_tokens, kind="output")
+
+def generate_section_map_reduce(gemini_model, system_prompt, query, candidates, cache=None):
+    """
+    Generates a section from more candidates than fit one prompt. The
+    candidates are split into groups that fit MAP_GROUP_TOKEN_BUDGET, each
+    group is summarized in parallel (map), and the partial summaries are
+    combined into the section with its own system prompt (reduce). While
+    the partial summaries still fill more than one group they are grouped
+    and summarized again, so no candidate is dropped.
+    Candidates that fit a single group are sent in one normal prompt.
+    """
+    groups = context_builder.pack_groups(candidates, MAP_GROUP_TOKEN_BUDGET)
+    if len(groups) == 1:
+        return generate_section(gemini_model, system_prompt, query, groups[0], cache)
+
+    def summarize(group):
+        return generate_section(gemini_model, MAP_SYSTEM_PROMPT, query, group, cache)
+
+    hits = candidates
+    for level in range(1, max(1, MAX_MAP_LEVELS) + 1):
+        print(f"  > Map-reduce level {level}: {len(hits)} chunks in {len(groups)} groups...")
+        with ThreadPoolExecutor(max_workers=max(1, MAP_WORKERS)) as executor:
+            partials = list(executor.map(summarize, groups))
+
+        failed = sum(1 for text in partials if text == SECTION_ERROR_TEXT)
+        if failed == len(partials):
+            return SECTION_ERROR_TEXT
+        if failed:
+            print(f"  > WARNING: {failed} of {len(partials)} groups failed; reducing the rest.")
+
+        # Partial summaries are keyed by their text, so unchanged groups also
+        # give a cached reduce step
+        hits = [
+            {'id': f"partial_{level}_{i}", 'text': text}
+            for i, text in enumerate(partials)
+            if text != SECTION_ERROR_TEXT and text.strip().upper() != "NONE"
+        ]
+        groups = context_builder.pack_groups(hits, MAP_GROUP_TOKEN_BUDGET)
+        if len(groups) <= 1:
+            break
+    return generate_section(gemini_model, system_prompt, query, hits, cache)
+
+def needs_map_reduce(candidates, token_budget=context_builder.CONTEXT_TOKEN_BUDGET):
+    """
+    True when a section's candidates do not all fit one prompt.
+    """
+    if not USE_MAP_REDUCE:
+        return False
+    return sum(context_builder.estimate_tokens(hit['text']) for hit in candidates) > token_budget
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Phase 3: generate the daily report.")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Bypass the response cache and regenerate every section.")
+    metrics.add_profile_argument(parser)
+    return parser.parse_args()
+
+@metrics.stage("generate")
+def run(no_cache=False, embedder=None, chroma_client=None):
+    """
+    Runs Phase 3: retrieves context for each section and writes the report.
+    An embedder and a vector-store client can be passed in to share them with
+    other stages. no_cache bypasses the response cache.
+    Returns the report filename, or None on failure.
     """
     print("Starting Phase 3: Report Generation...")
     
-    collection, gemini = initialize_services()
-    if not collection:
-        return
+    collection, gemini, embedder = initialize_services(embedder, chroma_client)
+    if not gemini:
+        return None
 
     # --- 1. Define Your Custom Queries ---
     
@@ -199,20 +659,62 @@ def main():
         ("Rent & Utilities", q_rent, sp_rent),
         ("Other Action Items", q_actions, sp_actions),
     ]
+
+    # Index-time category each section searches (see email_categories.py)
+    section_categories = [["jobs"], ["banking"], ["linkedin"], ["rent_utilities"], ["other"]]
+    if not ROUTE_SECTIONS_BY_CATEGORY:
+        section_categories = None
     
     report_sections = []
+
+    # Restrict retrieval to the report window (e.g. the last 24 hours)
+    since = None
+    if REPORT_WINDOW_HOURS is not None:
+        since = time.time() - REPORT_WINDOW_HOURS * 3600
     
-    # --- 2. Generate Each Report Section ---
-    for title, query, system_prompt in queries:
-        # 2a. Retrieve context chunks from ChromaDB
-        context_chunks = query_vector_db(collection, query)
-        
-        # 2b. Generate the summary for this section
-        section_content = generate_section(gemini, system_prompt, query, context_chunks)
-        
+    # --- 2. Retrieve Candidates for All Sections at Once ---
+    # One batched (cached) query embedding call; one Chroma query per category filter
+    cache = embedding_cache.EmbeddingCache()
+    candidate_lists = retrieve_candidates(
+        collection, embedder, [query for _, query, _ in queries], CANDIDATE_POOL_SIZE, since=since,
+        cache=cache, categories=section_categories
+    )
+    # Sections that overflow one prompt get a larger pool for map-reduce
+    busy = [i for i, candidates in enumerate(candidate_lists) if needs_map_reduce(candidates)]
+    if busy:
+        larger = retrieve_candidates(
+            collection, embedder, [queries[i][1] for i in busy], MAP_REDUCE_POOL_SIZE, since=since,
+            cache=cache, categories=[section_categories[i] for i in busy] if section_categories else None
+        )
+        for i, candidates in zip(busy, larger):
+            candidate_lists[i] = candidates
+    cache.close()
+
+    # --- 3. Generate the Report Sections Concurrently ---
+    responses = None
+    if USE_RESPONSE_CACHE and not no_cache:
+        responses = response_cache.ResponseCache()
+
+    def run_section(section):
+        (_, query, system_prompt), candidates = section
+        # Busy sections are summarized in groups instead of truncated to one prompt
+        if needs_map_reduce(candidates):
+            return generate_section_map_reduce(gemini, system_prompt, query, candidates, responses)
+        context_chunks = pack_context(candidates)
+        return generate_section(gemini, system_prompt, query, context_chunks, responses)
+
+    # map() keeps results in section order, whatever order they finish in
+    with ThreadPoolExecutor(max_workers=max(1, SECTION_WORKERS)) as executor:
+        section_contents = list(executor.map(run_section, zip(queries, candidate_lists)))
+
+    if responses is not None:
+        print(f"Response cache: {responses.hits} hits, {responses.misses} misses.")
+        responses.close()
+
+    for (title, _, _), section_content in zip(queries, section_contents):
         report_sections.append(f"## {title}\n\n{section_content}\n")
 
-    # --- 3. Assemble and Save the Final Report ---
+    # --- 4. Assemble and Save the Final Report ---
     today_date = datetime.date.today().strftime("%Y-%m-%d")
     report_filename = f"daily_report_{today_date}.md"
     
@@ -226,6 +728,16 @@ def main():
     print("Phase 3 (Generation) complete!")
     print(f"Your new report is saved as: {report_filename}")
     print("="*50)
+    return report_filename
+
+def main():
+    """
+    Main function to run the full RAG pipeline and generate the report.
+    """
+    args = parse_args()
+    with metrics.profiled(args.profile, "generate"):
+        run(no_cache=args.no_cache)
+    metrics.flush("generate")
 
 if __name__ == '__main__':
     main()
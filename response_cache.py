@@ -0,0 +1,119 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+import metrics
+
+# --- Configuration ---
+
+# 1. Cache file (kept outside the directories cron_job.sh wipes)
+CACHE_FILE = "response_cache.db"
+
+# 2. How long a cached response stays valid
+TTL_SECONDS = 24 * 60 * 60
+
+# 3. Upper bound on stored response bytes; least recently used entries
+# are evicted beyond this
+MAX_CACHE_BYTES = 20 * 1024 * 1024
+
+
+def sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def response_key(model, system_prompt, query, context_chunks):
+    """
+    Cache key for one generate_content call: the model, a hash of the
+    system prompt, the query, and the ordered IDs and content hashes of
+    the retrieved chunks.
+    """
+    h = hashlib.sha256()
+    for part in (model, sha256(system_prompt), query):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    for chunk in context_chunks:
+        h.update(f"{chunk['id']}:{sha256(chunk['text'])}".encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent cache of generated report sections with TTL and size-based
+    LRU eviction. Safe to share between threads.
+    """
+
+    def __init__(self, path=CACHE_FILE, ttl=TTL_SECONDS, max_bytes=MAX_CACHE_BYTES):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+            ''')
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used)"
+            )
+            # Drop anything that expired since the last run
+            self.conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - ttl,))
+            self.conn.commit()
+
+    def get(self, key):
+        """
+        Returns the cached response for key, or None if missing or expired.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT response FROM responses WHERE key = ? AND created_at >= ?",
+                (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.inc("cache_total", cache="response", result="miss")
+                return None
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+            metrics.inc("cache_total", cache="response", result="hit")
+            return row[0]
+
+    def put(self, key, response):
+        """
+        Stores a response, then evicts least recently used entries while
+        the cache is larger than max_bytes.
+        """
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now)
+            )
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                to_delete = []
+                for old_key, old_size in self.conn.execute(
+                    "SELECT key, size FROM responses ORDER BY last_used"
+                ).fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    to_delete.append((old_key,))
+                    total -= old_size
+                self.conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,4 +1,5 @@
 import os.path
+import argparse
 import base64
 import datetime
 from email.mime.text import MIMEText
@@ -7,6 +8,7 @@ from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+import metrics
 
 # This MUST match the scope in gmail_fetcher_v2.py
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
@@ -45,18 +47,19 @@ def send_message(service, user_id, message):
       Sent Message.
     """
     try:
-        message = (service.users().messages().send(userId=user_id, body=message)
-                   .execute())
+        with metrics.span("external_call_seconds", service="gmail", call="messages.send"):
+            message = (service.users().messages().send(userId=user_id, body=message)
+                       .execute())
         print(f'Message Id: {message["id"]} sent.')
         return message
     except HttpError as error:
         print(f'An error occurred: {error}')
 
-def main():
+def get_credentials():
     """
-    Loads credentials, finds today's report, and emails it.
+    Loads the Gmail credentials from token.json, refreshing them if they
+    expired. Returns None if there is no usable token.
     """
-    print("Starting Phase 4: Sending Report...")
     creds = None
     # The file token.json stores the user's access and refresh tokens.
     if os.path.exists('token.json'):
@@ -72,21 +75,35 @@ def main():
             # as token.json should be valid from the prerequisite step.
             print("Error: No valid token.json found.")
             print("Please run the prerequisite step (modify and run gmail_fetcher_v2.py).")
-            return
+            return None
         # Save the credentials for the next run
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
+    return creds
+
+@metrics.stage("send")
+def run(service=None, report_filename=None):
+    """
+    Runs Phase 4: emails the report (today's by default) to the
+    authenticated user. An already authenticated Gmail service can be
+    passed in. Returns True once the email is sent.
+    """
+    print("Starting Phase 4: Sending Report...")
 
     try:
-        service = build('gmail', 'v1', credentials=creds)
+        if service is None:
+            creds = get_credentials()
+            if creds is None:
+                return False
+            service = build('gmail', 'v1', credentials=creds)
 
         # --- 1. Find and Read the Report File ---
         today_date = datetime.date.today().strftime("%Y-%m-%d")
-        report_filename = f"daily_report_{today_date}.md"
+        report_filename = report_filename or f"daily_report_{today_date}.md"
         
         if not os.path.exists(report_filename):
             print(f"Error: Report file {report_filename} not found.")
-            return
+            return False
 
         with open(report_filename, "r", encoding="utf-8") as f:
             report_content = f.read()
@@ -97,7 +114,7 @@ def main():
         
         if not user_email:
             print("Error: Could not retrieve your email address.")
-            return
+            return False
 
         print(f"Report file found. Preparing to send to {user_email}...")
 
@@ -105,14 +122,28 @@ def main():
         subject = f"Your Daily Email Report - {today_date}"
         message = create_message(user_email, user_email, subject, report_content)
         
-        send_message(service, 'me', message)
+        if send_message(service, 'me', message) is None:
+            return False
         
         print("Phase 4 (Email Report) complete.")
+        return True
 
     except HttpError as error:
         print(f'An error occurred: {error}')
     except Exception as e:
         print(f'An unexpected error occurred: {e}')
+    return False
+
+def main():
+    """
+    Loads credentials, finds today's report, and emails it.
+    """
+    parser = argparse.ArgumentParser(description="Phase 4: email today's report.")
+    metrics.add_profile_argument(parser)
+    args = parser.parse_args()
+    with metrics.profiled(args.profile, "send"):
+        run()
+    metrics.flush("send")
 
 if __name__ == '__main__':
     main()
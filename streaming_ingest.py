@@ -0,0 +1,242 @@
+import argparse
+import functools
+import queue
+import threading
+import time
+
+import email_db
+import gmail_fetcher
+import indexing
+import metrics
+
+# --- Configuration ---
+
+# 1. Capacity of each queue between stages. A full queue blocks the stage
+# feeding it, so memory stays bounded whatever the mailbox size.
+QUEUE_SIZE = 200
+
+# 2. Parsed emails written to SQLite per transaction
+WRITE_GROUP_SIZE = 50
+
+# 3. Seconds a stage waits for more input before passing on a partial
+# group or batch, so a slow stream is still indexed promptly
+IDLE_FLUSH_SECONDS = 1.0
+
+_END = object()
+
+
+def put(q, item, stop):
+    """
+    Blocking put that gives up once stop is set, so a stage whose consumer
+    failed does not wait forever on a full queue. Returns True if queued.
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def fetch_stage(service, msg_ids, creds, workers, raw_queue, stop, counts, failed):
+    """
+    Fetches raw messages for the listed IDs (batch endpoint, or the
+    concurrent pool when workers > 0) and queues them for parsing.
+    Messages that could not be fetched are appended to failed.
+    """
+    def counted(ids):
+        for msg_id in ids:
+            counts['listed'] += 1
+            yield msg_id
+
+    try:
+        if workers > 0:
+            responses = gmail_fetcher.fetch_messages_concurrent(creds, counted(msg_ids), workers, failed)
+        else:
+            responses = gmail_fetcher.fetch_messages_batch(service, counted(msg_ids), failed)
+
+        for msg_raw in responses:
+            counts['fetched'] += 1
+            if not put(raw_queue, msg_raw, stop):
+                return
+    finally:
+        put(raw_queue, _END, stop)
+
+def parse_stage(raw_queue, email_queue, stop, counts):
+    """
+    Parses raw messages, writes them to SQLite in small transactions and
+    queues the new or changed rows (with their IDs) for indexing. Messages
+    already in the database unchanged are skipped here; Phase 2 picks them
+    up if unprocessed.
+    """
+    writer = email_db.EmailWriter(gmail_fetcher.DB_FILE)
+    group = []
+
+    def write_group():
+        rows = writer.insert_returning_ids(group)
+        for email_data, written in zip(group, rows):
+            if written is None:
+                continue
+            email_id, indexed_hash = written
+            row = {
+                'id': email_id,
+                'indexed_hash': indexed_hash,
+                'from_sender': email_data['from'],
+                'subject': email_data['subject'],
+                'body': email_data['body'],
+                'received_at': email_data['received_at'],
+            }
+            if not put(email_queue, row, stop):
+                break
+        group.clear()
+
+    try:
+        while not stop.is_set():
+            try:
+                msg_raw = raw_queue.get(timeout=IDLE_FLUSH_SECONDS)
+            except queue.Empty:
+                # Nothing new for a while; pass on what we have
+                if group:
+                    write_group()
+                continue
+            if msg_raw is _END:
+                break
+
+            try:
+                group.append(gmail_fetcher.parse_raw_message(msg_raw))
+            except Exception as e:
+                print(f"Could not parse email with ID {msg_raw['id']}: {e}")
+                metrics.inc("messages_total", state="parse_failed")
+                continue
+            if len(group) >= WRITE_GROUP_SIZE:
+                write_group()
+
+        if group:
+            write_group()
+    finally:
+        writer.close()
+        counts['inserted'] = writer.inserted
+        counts['skipped'] = writer.skipped
+        put(email_queue, _END, stop)
+
+def run_stage(target, stop, errors, *args):
+    # Thread body: record the error and stop the other stages on failure
+    try:
+        target(*args)
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+
+def ingest_and_index(service, msg_ids, creds=None, workers=gmail_fetcher.FETCH_WORKERS,
+                     embedder=None, collection=None, failed=None):
+    """
+    Streaming replacement for gmail_fetcher.ingest_messages that also
+    indexes each email as it arrives. Fetching, MIME parsing and SQLite
+    writes, and chunking/embedding/Chroma writes run in their own threads,
+    connected by bounded queues:
+
+        fetch -> raw_queue -> parse + write -> email_queue -> chunk, embed, store
+
+    so the network-bound fetch and embed steps overlap instead of running
+    one after the other. Partial batches are flushed after
+    IDLE_FLUSH_SECONDS without input.
+    Returns (listed, fetched) and fills failed like ingest_messages.
+    """
+    started = time.monotonic()
+    raw_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    email_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    stop = threading.Event()
+    errors = []
+    counts = {'listed': 0, 'fetched': 0, 'inserted': 0, 'skipped': 0}
+
+    threads = [
+        threading.Thread(target=run_stage, daemon=True, args=(
+            fetch_stage, stop, errors,
+            service, msg_ids, creds, workers, raw_queue, stop, counts, failed)),
+        threading.Thread(target=run_stage, daemon=True, args=(
+            parse_stage, stop, errors,
+            raw_queue, email_queue, stop, counts)),
+    ]
+    for thread in threads:
+        thread.start()
+
+    indexer = indexing.EmailIndexer(collection, embedder)
+    first_indexed = None
+    dirty = False
+    try:
+        try:
+            while True:
+                try:
+                    email_row = email_queue.get(timeout=IDLE_FLUSH_SECONDS)
+                except queue.Empty:
+                    if errors:
+                        break
+                    if dirty:
+                        # Quiet moment: embed what is buffered and save progress
+                        indexer.checkpoint()
+                        dirty = False
+                    continue
+                if email_row is _END:
+                    break
+                indexer.add(email_row)
+                dirty = True
+
+                if first_indexed is None and indexer.scheduler.stored_ids:
+                    first_indexed = time.monotonic() - started
+                    print(f"  > First email indexed {first_indexed:.1f}s after the stream started.")
+                    metrics.observe("first_email_indexed_seconds", first_indexed)
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            for thread in threads:
+                thread.join()
+
+        # Errors raised while listing (e.g. HistoryExpiredError) surface here
+        if errors:
+            raise errors[0]
+
+        indexer.finish()
+    finally:
+        # Closed even when an error is re-raised, so a caller that falls
+        # back to a full sync does not run alongside this indexer
+        indexer.close()
+    gmail_fetcher.record_message_counts(counts['listed'], counts['fetched'],
+                                        counts['inserted'], counts['skipped'])
+    print(f"  > Saved {counts['inserted']} new emails to DB ({counts['skipped']} already in DB); "
+          f"indexed {indexer.indexed} in {time.monotonic() - started:.1f}s.")
+    return counts['listed'], counts['fetched']
+
+def run(service=None, creds=None, full=False, max_messages=gmail_fetcher.MAX_MESSAGES,
+        workers=gmail_fetcher.FETCH_WORKERS, embedder=None, chroma_client=None):
+    """
+    Runs Phases 1 and 2 as one stream. Clients can be passed in to share
+    them with other stages. Returns True on success.
+    """
+    if embedder is None:
+        embedder = indexing.get_embedder()
+        if embedder is None:
+            return False
+    collection = indexing.get_collection(chroma_client)
+    ingest = functools.partial(ingest_and_index, embedder=embedder, collection=collection)
+    return gmail_fetcher.run(service, creds, full, max_messages, workers, ingest=ingest)
+
+def main():
+    """
+    Fetches and indexes new emails in streaming mode.
+    """
+    parser = argparse.ArgumentParser(description="Phases 1 and 2 as one streaming pipeline.")
+    parser.add_argument('--full', action='store_true',
+                        help="Ignore the stored historyId and do a full listing.")
+    parser.add_argument('--max-messages', type=int, default=gmail_fetcher.MAX_MESSAGES,
+                        help="Upper bound on messages ingested this run (0 = no limit).")
+    parser.add_argument('--workers', type=int, default=gmail_fetcher.FETCH_WORKERS,
+                        help="Fetch with this many concurrent threads (0 = batch endpoint).")
+    metrics.add_profile_argument(parser)
+    args = parser.parse_args()
+    with metrics.profiled(args.profile, "stream"):
+        run(full=args.full, max_messages=args.max_messages or None, workers=args.workers)
+    metrics.flush("stream")
+
+if __name__ == '__main__':
+    main()
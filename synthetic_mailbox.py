@@ -0,0 +1,271 @@
+import argparse
+import base64
+import datetime
+import os
+import quopri
+import random
+from email.utils import format_datetime
+
+# --- Configuration ---
+
+# 1. Hours the generated mail is spread over, newest first (the report
+# window, so every message is in scope for Phase 3)
+WINDOW_HOURS = 24
+
+# 2. Share of messages in each layout
+LAYOUT_WEIGHTS = {
+    "plain": 0.25,          # text/plain only
+    "alternative": 0.45,    # multipart/alternative, plain + HTML
+    "html": 0.2,            # text/html only
+    "attachment": 0.1,      # multipart/mixed with a PDF attachment
+}
+
+# Senders per category; the domains match email_categories.SENDER_DOMAIN_RULES
+# where a rule exists, so both labelling paths are exercised
+SENDERS = {
+    "jobs": [
+        ("Acme Recruiting", "no-reply@greenhouse.io"),
+        ("Initech Careers", "careers@myworkday.com"),
+        ("HackerRank", "support@hackerrank.com"),
+        ("Globex Talent", "talent@globex-corp.com"),
+    ],
+    "banking": [
+        ("Chase", "no-reply@alerts.chase.com"),
+        ("Bank of America", "onlinebanking@ealerts.bankofamerica.com"),
+        ("Credit Union", "alerts@localcu.org"),
+    ],
+    "linkedin": [
+        ("LinkedIn", "messages-noreply@linkedin.com"),
+        ("LinkedIn Invitations", "invitations@linkedin.com"),
+    ],
+    "rent_utilities": [
+        ("Parkview Apartments", "billing@parkview-living.com"),
+        ("City Power & Light", "ebill@citypower.com"),
+        ("FiberNet", "billing@fibernet.net"),
+    ],
+    "other": [
+        ("Weekly Digest", "news@digest-weekly.com"),
+        ("Dr. Müller's Office", "frontdesk@muller-clinic.de"),
+        ("Alex Kim", "alex.kim@gmail.com"),
+        ("Campus Events", "events@university.edu"),
+    ],
+}
+
+CATEGORY_WEIGHTS = {"jobs": 0.2, "banking": 0.15, "linkedin": 0.15, "rent_utilities": 0.1, "other": 0.4}
+
+SUBJECTS = {
+    "jobs": ["Your application for {role}", "Online assessment invitation: {role}",
+             "Interview availability for {role}", "Update on your {role} application"],
+    "banking": ["Your statement is ready", "Transaction alert: ${amount}",
+                "Low balance warning", "New sign-in to your account"],
+    "linkedin": ["{name} sent you a message", "{name} wants to connect",
+                 "You appeared in {count} searches this week"],
+    "rent_utilities": ["Rent due on {date}", "Your electric bill: ${amount}",
+                       "Internet payment reminder", "Lease renewal offer"],
+    "other": ["Weekly digest #{count}", "Reminder: appointment on {date}",
+              "Can you review the draft by {date}?", "Événements de la semaine"],
+}
+
+PARAGRAPHS = {
+    "jobs": [
+        "Thank you for applying for the {role} position. Our team has reviewed your application and would like to invite you to the next step.",
+        "Please complete the online assessment within 7 days. It takes about 90 minutes and covers data structures and system design.",
+        "We would like to schedule a 45 minute interview with the hiring manager. Please choose a slot that works for you by {date}.",
+        "After careful consideration we have decided to move forward with other candidates for the {role} role at this time.",
+    ],
+    "banking": [
+        "A transaction of ${amount} was made with your card ending in {card} at an online merchant on {date}.",
+        "Your monthly statement for the account ending in {card} is now available. Log in to view it.",
+        "Your available balance has dropped below ${amount}. Consider transferring funds to avoid overdraft fees.",
+        "We noticed a new sign-in to your account from a new device. If this was not you, contact us immediately.",
+    ],
+    "linkedin": [
+        "{name} sent you a message: Hi, I came across your profile and would love to chat about an opening on my team.",
+        "{name} would like to join your professional network. You have {count} mutual connections.",
+        "Your profile appeared in {count} searches this week. See who is looking at your profile.",
+    ],
+    "rent_utilities": [
+        "This is a reminder that your rent of ${amount} is due on {date}. Late fees apply after the 5th.",
+        "Your electricity bill for this period is ${amount}, due on {date}. Enroll in autopay to never miss a payment.",
+        "Your internet payment of ${amount} is scheduled for {date}. No action is needed if your card is up to date.",
+        "Your lease ends soon. Renew before {date} to lock in the current monthly rate.",
+    ],
+    "other": [
+        "Here are this week's top stories, picked for you. Read about new research, local events and product launches.",
+        "Just a reminder that your appointment is on {date} at 10:30. Please arrive 10 minutes early.",
+        "Could you review the attached draft and send me your comments by {date}? Thanks a lot for your help.",
+        "Découvrez les événements de la semaine sur le campus: conférences, ateliers et soirées.",
+    ],
+}
+
+# Repeated boilerplate, collapsed by near_dedup in Phase 2
+FOOTERS = [
+    "You are receiving this email because you signed up for notifications. To unsubscribe, click here. View our privacy policy.",
+    "This message was sent from an unmonitored mailbox. Please do not reply. © 2024 All rights reserved.",
+    "CONFIDENTIALITY NOTICE: This email and any attachments are for the sole use of the intended recipient.",
+]
+
+ROLES = ["Software Engineer", "Data Analyst", "Product Intern", "ML Engineer", "Backend Developer"]
+NAMES = ["Priya Shah", "Jordan Lee", "Sam Ortiz", "Mei Chen", "Omar Haddad", "Zoë Brandt"]
+
+
+def message_id(index):
+    """
+    Gmail-style hex ID of the message at index (0 = newest).
+    """
+    return f"{index + 1:016x}"
+
+def message_index(msg_id):
+    return int(msg_id, 16) - 1
+
+def pick(rng, weights):
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+def fill(rng, template):
+    return template.format(
+        role=rng.choice(ROLES),
+        name=rng.choice(NAMES),
+        amount=f"{rng.uniform(5, 2500):.2f}",
+        card=f"{rng.randrange(10000):04d}",
+        date=(datetime.date(2024, 1, 1) + datetime.timedelta(days=rng.randrange(365))).strftime("%b %d"),
+        count=rng.randrange(2, 60),
+    )
+
+def to_html(paragraphs):
+    """
+    Wraps paragraphs in a newsletter-like HTML layout (tables, styles,
+    a tracking pixel) so the HTML-to-text path does real work.
+    """
+    rows = "".join(
+        f'<tr><td style="padding:12px;font-family:Arial">{paragraph}</td></tr>'
+        for paragraph in paragraphs
+    )
+    return (
+        "<html><head><style>td { color: #333; } .hide { display: none; }</style></head>"
+        "<body><table width=\"600\" align=\"center\">"
+        f"{rows}"
+        "</table><img src=\"https://example.com/pixel.gif\" width=\"1\" height=\"1\">"
+        "<script>track();</script></body></html>"
+    )
+
+def encode_header(value):
+    # RFC 2047 encoded-word for non-ASCII headers, as real mailers send them
+    if value.isascii():
+        return value
+    return "=?utf-8?b?" + base64.b64encode(value.encode('utf-8')).decode('ASCII') + "?="
+
+def text_part(subtype, content):
+    body = quopri.encodestring(content.encode('utf-8')).decode('ASCII')
+    return (f"Content-Type: text/{subtype}; charset=\"utf-8\"\r\n"
+            f"Content-Transfer-Encoding: quoted-printable\r\n\r\n{body}\r\n")
+
+def multipart(subtype, boundary, parts):
+    body = "".join(f"--{boundary}\r\n{part}" for part in parts) + f"--{boundary}--\r\n"
+    return f"Content-Type: multipart/{subtype}; boundary=\"{boundary}\"\r\n\r\n{body}"
+
+def build_message(index, seed=0, newest=None, spacing=None):
+    """
+    Builds the raw RFC 822 bytes of the synthetic message at index.
+    The same (index, seed) always yields the same content, so messages can
+    be regenerated on demand instead of being kept in memory. The MIME
+    text is written directly; the email package's generator is too slow
+    for million-message runs.
+    Returns (raw_bytes, internal_date_ms).
+    """
+    rng = random.Random(seed * 1_000_003 + index)
+    category = pick(rng, CATEGORY_WEIGHTS)
+    layout = pick(rng, LAYOUT_WEIGHTS)
+    sender_name, sender = rng.choice(SENDERS[category])
+
+    paragraphs = [fill(rng, p) for p in rng.sample(PARAGRAPHS[category], k=rng.randint(1, 3))]
+    if rng.random() < 0.6:
+        paragraphs.append(rng.choice(FOOTERS))
+    text = "\n\n".join(paragraphs)
+
+    if layout == "plain":
+        body = text_part("plain", text)
+    elif layout == "html":
+        body = text_part("html", to_html(paragraphs))
+    else:
+        boundary = f"=_alt_{index:x}"
+        body = multipart("alternative", boundary, [
+            text_part("plain", text), text_part("html", to_html(paragraphs))
+        ])
+        if layout == "attachment":
+            pdf = b"%PDF-1.4\n" + rng.randbytes(rng.randrange(2_000, 20_000)) + b"\n%%EOF"
+            attachment = (
+                f"Content-Type: application/pdf; name=\"document_{index}.pdf\"\r\n"
+                f"Content-Disposition: attachment; filename=\"document_{index}.pdf\"\r\n"
+                f"Content-Transfer-Encoding: base64\r\n\r\n"
+                + base64.encodebytes(pdf).decode('ASCII').replace("\n", "\r\n")
+            )
+            body = multipart("mixed", f"=_mixed_{index:x}", [body, attachment])
+
+    received = newest - index * spacing
+    headers = (
+        f"From: {encode_header(sender_name)} <{sender}>\r\n"
+        f"To: me@example.com\r\n"
+        f"Subject: {encode_header(fill(rng, rng.choice(SUBJECTS[category])))}\r\n"
+        f"Date: {format_datetime(received)}\r\n"
+        f"Message-ID: <{message_id(index)}.{seed}@synthetic.example>\r\n"
+        f"MIME-Version: 1.0\r\n"
+    )
+    return (headers + body).encode('ASCII'), int(received.timestamp() * 1000)
+
+
+class SyntheticMailbox:
+    """
+    A deterministic mailbox of 'size' messages spread over the last
+    window_hours, newest first. Messages are generated when asked for,
+    so even a million-message mailbox costs no memory up front.
+    """
+
+    def __init__(self, size, seed=0, window_hours=WINDOW_HOURS, newest=None):
+        self.size = size
+        self.seed = seed
+        self.newest = newest or datetime.datetime.now(datetime.timezone.utc)
+        self.spacing = datetime.timedelta(hours=window_hours) / max(1, size)
+
+    def ids(self, start=0, stop=None):
+        stop = self.size if stop is None else min(stop, self.size)
+        return [message_id(index) for index in range(start, stop)]
+
+    def build(self, msg_id):
+        index = message_index(msg_id)
+        if not 0 <= index < self.size:
+            raise KeyError(msg_id)
+        return build_message(index, self.seed, self.newest, self.spacing)
+
+    def get_raw(self, msg_id):
+        """
+        The message as a Gmail 'raw' format response.
+        """
+        raw_bytes, internal_date = self.build(msg_id)
+        return {
+            'id': msg_id,
+            'threadId': msg_id,
+            'labelIds': ['UNREAD', 'INBOX'],
+            'internalDate': str(internal_date),
+            'raw': base64.urlsafe_b64encode(raw_bytes).decode('ASCII'),
+        }
+
+def main():
+    """
+    Writes a sample of the synthetic mailbox as .eml files for inspection.
+    """
+    parser = argparse.ArgumentParser(description="Write synthetic MIME messages as .eml files.")
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default="synthetic_mail")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    mailbox = SyntheticMailbox(args.count, args.seed)
+    for msg_id in mailbox.ids():
+        raw_bytes, _ = mailbox.build(msg_id)
+        with open(os.path.join(args.out, f"{msg_id}.eml"), "wb") as f:
+            f.write(raw_bytes)
+    print(f"Wrote {args.count} messages to {args.out}/")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,448 @@
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+
+# Vector-store backends. Both hand out collections with the part of the
+# chromadb Collection API the pipeline uses (add/upsert/update/get/
+# delete/query/count), so indexing, near_dedup, report_generation and
+# maintenance work unchanged on either:
+#   "chroma"  chromadb.PersistentClient (HNSW index, imported on first use)
+#   "memmap"  MemmapClient below: an append-only np.memmap matrix of
+#             normalized float16 or int8 vectors plus an SQLite sidecar
+#             with the IDs, documents and metadata. Search is an exact,
+#             vectorized cosine top-k over the rows that pass the
+#             metadata filter; with a few thousand chunks a day that is
+#             faster to open and smaller on disk than an HNSW index.
+
+# --- Configuration ---
+
+# 1. Which backend to use: "chroma" or "memmap"
+VECTOR_STORE_BACKEND = os.environ.get("VECTOR_STORE", "chroma")
+
+# 2. Folder of the memmap backend (one subfolder per collection)
+MEMMAP_PATH = "email_vectors"
+
+# 3. How the memmap backend stores vectors: "float16" (2 bytes per
+# dimension) or "int8" (1 byte per dimension plus a per-row scale).
+# Existing collections keep the type they were created with until they
+# are rebuilt (maintenance.py --compact).
+MEMMAP_DTYPE = os.environ.get("VECTOR_STORE_DTYPE", "float16")
+
+# 4. Rows scored per block during a search (bounds the float32 copy)
+QUERY_BLOCK_ROWS = 65536
+
+VECTORS_FILE = "vectors.bin"
+SIDECAR_FILE = "records.sqlite3"
+INT8_MAX = 127
+FIELD_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+COMPARISONS = {'$eq': '=', '$ne': '!=', '$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+
+
+def get_client(chroma_path, backend=VECTOR_STORE_BACKEND):
+    """
+    Opens the configured vector store. chroma_path is where the "chroma"
+    backend keeps its files; the "memmap" backend uses MEMMAP_PATH.
+    """
+    if backend == "chroma":
+        import chromadb
+        return chromadb.PersistentClient(path=chroma_path)
+    if backend == "memmap":
+        return MemmapClient(MEMMAP_PATH)
+    raise ValueError(f"Unknown vector store backend: {backend}")
+
+def store_path(chroma_path, backend=VECTOR_STORE_BACKEND):
+    """
+    Folder the configured backend keeps its files in.
+    """
+    return MEMMAP_PATH if backend == "memmap" else chroma_path
+
+def where_sql(where):
+    """
+    Translates a Chroma 'where' clause ($and/$or, $eq/$ne/$gt/$gte/$lt/
+    $lte/$in/$nin and bare values for equality) into an SQL condition on
+    the sidecar's JSON metadata. Returns (sql, params).
+    """
+    if not where:
+        return "1", []
+
+    clauses = []
+    params = []
+    for key, condition in where.items():
+        if key in ('$and', '$or'):
+            parts = [where_sql(part) for part in condition]
+            joiner = " AND " if key == '$and' else " OR "
+            clauses.append("(" + joiner.join(sql for sql, _ in parts) + ")")
+            for _, part_params in parts:
+                params.extend(part_params)
+            continue
+
+        if not FIELD_RE.match(key):
+            raise ValueError(f"Unsupported metadata field in where clause: {key!r}")
+        field = f"json_extract(metadata, '$.{key}')"
+        if not isinstance(condition, dict):
+            condition = {'$eq': condition}
+        for op, value in condition.items():
+            if op in ('$in', '$nin'):
+                values = list(value)
+                if not values:
+                    clauses.append("0" if op == '$in' else "1")
+                    continue
+                negate = "NOT " if op == '$nin' else ""
+                clauses.append(f"{field} {negate}IN ({','.join('?' for _ in values)})")
+                params.extend(values)
+            elif op in COMPARISONS:
+                clauses.append(f"{field} {COMPARISONS[op]} ?")
+                params.append(value)
+            else:
+                raise ValueError(f"Unsupported operator in where clause: {op}")
+    return " AND ".join(clauses), params
+
+
+class MemmapClient:
+    """
+    The chromadb client calls the pipeline makes, for memmap collections
+    stored under 'path'.
+    """
+
+    def __init__(self, path=MEMMAP_PATH):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _collection_path(self, name):
+        return os.path.join(self.path, name)
+
+    def list_collections(self):
+        return sorted(
+            name for name in os.listdir(self.path)
+            if os.path.exists(os.path.join(self.path, name, SIDECAR_FILE))
+        )
+
+    def get_collection(self, name):
+        if name not in self.list_collections():
+            raise ValueError(f"Collection {name} does not exist.")
+        return MemmapCollection(self, name)
+
+    def create_collection(self, name, metadata=None):
+        if name in self.list_collections():
+            raise ValueError(f"Collection {name} already exists.")
+        return MemmapCollection(self, name, metadata, create=True)
+
+    def get_or_create_collection(self, name, metadata=None):
+        if name in self.list_collections():
+            return MemmapCollection(self, name)
+        return MemmapCollection(self, name, metadata, create=True)
+
+    def delete_collection(self, name):
+        shutil.rmtree(self._collection_path(name), ignore_errors=True)
+
+
+class MemmapCollection:
+    """
+    One collection: an append-only file of fixed-size vector records,
+    read through np.memmap, and an SQLite sidecar mapping each live ID to
+    its row, document and metadata. Upserts append new rows and repoint
+    the ID; deletes only drop sidecar rows. The rows left behind are
+    reclaimed when maintenance.py rebuilds the collection.
+
+    Vectors are L2-normalized before storage, so cosine similarity is a
+    dot product. int8 rows carry a float32 scale.
+    """
+
+    def __init__(self, client, name, metadata=None, create=False):
+        import numpy as np
+        self.np = np
+        self.client = client
+        self.name = name
+        self.lock = threading.Lock()
+        self._matrix = None
+        self._open(metadata, create)
+
+    def _open(self, metadata=None, create=False):
+        path = self.client._collection_path(self.name)
+        os.makedirs(path, exist_ok=True)
+        self.vectors_path = os.path.join(path, VECTORS_FILE)
+        self.conn = sqlite3.connect(os.path.join(path, SIDECAR_FILE), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS records (
+                id TEXT PRIMARY KEY,
+                row INTEGER NOT NULL,
+                document TEXT,
+                metadata TEXT
+            )
+            ''')
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_records_received_at "
+                "ON records (json_extract(metadata, '$.received_at'))"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+            if create:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)",
+                    [('dtype', MEMMAP_DTYPE), ('metadata', json.dumps(metadata or {}))]
+                )
+        settings = dict(self.conn.execute("SELECT key, value FROM settings"))
+        self.dtype = settings.get('dtype', MEMMAP_DTYPE)
+        if self.dtype not in ("float16", "int8"):
+            raise ValueError(f"Unsupported vector dtype: {self.dtype}")
+        self.dim = int(settings['dim']) if 'dim' in settings else None
+        self.metadata = json.loads(settings.get('metadata') or '{}')
+
+    def _record_dtype(self, dim):
+        if self.dtype == "int8":
+            return self.np.dtype([('scale', '<f4'), ('vector', 'i1', (dim,))])
+        return self.np.dtype([('vector', '<f2', (dim,))])
+
+    def _rows(self):
+        # Complete rows in the vectors file (a crash can leave a partial one)
+        if self.dim is None or not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // self._record_dtype(self.dim).itemsize
+
+    def _matrix_view(self):
+        rows = self._rows()
+        if rows == 0:
+            return None
+        if self._matrix is None or len(self._matrix) != rows:
+            self._matrix = self.np.memmap(self.vectors_path, dtype=self._record_dtype(self.dim),
+                                          mode='r', shape=(rows,))
+        return self._matrix
+
+    def _normalize(self, embeddings):
+        vectors = self.np.asarray(embeddings, dtype=self.np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors[None, :]
+        norms = self.np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _encode(self, embeddings):
+        vectors = self._normalize(embeddings)
+        dim = vectors.shape[1]
+        if self.dim is None:
+            self.dim = dim
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('dim', ?)",
+                                  (str(dim),))
+        elif dim != self.dim:
+            raise ValueError(f"Embedding dimension {dim} does not match collection dimensionality "
+                             f"{self.dim}; rebuild the index after changing the embedding size.")
+
+        records = self.np.zeros(len(vectors), dtype=self._record_dtype(dim))
+        if self.dtype == "int8":
+            peaks = self.np.abs(vectors).max(axis=1)
+            peaks[peaks == 0] = 1.0
+            records['scale'] = peaks / INT8_MAX
+            records['vector'] = self.np.rint(vectors / records['scale'][:, None])
+        else:
+            records['vector'] = vectors
+        return records
+
+    def _decode(self, records):
+        vectors = records['vector'].astype(self.np.float32)
+        if self.dtype == "int8":
+            vectors *= records['scale'][:, None]
+        return vectors
+
+    def _append(self, embeddings):
+        # Returns the row number of the first appended vector. The vectors
+        # are on disk before the sidecar points at them.
+        records = self._encode(embeddings)
+        with open(self.vectors_path, "ab") as f:
+            first_row = f.tell() // records.dtype.itemsize
+            # Drop a partial row left by a crash mid-append
+            if f.tell() != first_row * records.dtype.itemsize:
+                f.truncate(first_row * records.dtype.itemsize)
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        return first_row
+
+    def _write(self, ids, embeddings, documents, metadatas, replace):
+        ids = list(ids)
+        documents = list(documents) if documents is not None else [None] * len(ids)
+        metadatas = list(metadatas) if metadatas is not None else [None] * len(ids)
+        with self.lock:
+            if not replace:
+                existing = set(self._existing(ids))
+                keep = [i for i, record_id in enumerate(ids) if record_id not in existing]
+                ids = [ids[i] for i in keep]
+                embeddings = [embeddings[i] for i in keep]
+                documents = [documents[i] for i in keep]
+                metadatas = [metadatas[i] for i in keep]
+            if not ids:
+                return
+            first_row = self._append(embeddings)
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO records (id, row, document, metadata) VALUES (?, ?, ?, ?)",
+                    [(record_id, first_row + i, document, json.dumps(metadata or {}))
+                     for i, (record_id, document, metadata) in enumerate(zip(ids, documents, metadatas))]
+                )
+
+    def _existing(self, ids):
+        found = []
+        for start in range(0, len(ids), 500):
+            part = ids[start:start + 500]
+            placeholders = ','.join('?' for _ in part)
+            found.extend(row[0] for row in self.conn.execute(
+                f"SELECT id FROM records WHERE id IN ({placeholders})", part
+            ))
+        return found
+
+    def add(self, ids, embeddings, documents=None, metadatas=None):
+        """
+        Stores new records; IDs that already exist are skipped, like Chroma.
+        """
+        self._write(ids, embeddings, documents, metadatas, replace=False)
+
+    def upsert(self, ids, embeddings, documents=None, metadatas=None):
+        self._write(ids, embeddings, documents, metadatas, replace=True)
+
+    def update(self, ids, embeddings=None, documents=None, metadatas=None):
+        """
+        Replaces the given fields of existing records; unknown IDs are ignored.
+        """
+        ids = list(ids)
+        with self.lock:
+            first_row = self._append(embeddings) if embeddings is not None else None
+            with self.conn:
+                for i, record_id in enumerate(ids):
+                    if first_row is not None:
+                        self.conn.execute("UPDATE records SET row = ? WHERE id = ?", (first_row + i, record_id))
+                    if documents is not None:
+                        self.conn.execute("UPDATE records SET document = ? WHERE id = ?",
+                                          (documents[i], record_id))
+                    if metadatas is not None:
+                        self.conn.execute("UPDATE records SET metadata = ? WHERE id = ?",
+                                          (json.dumps(metadatas[i] or {}), record_id))
+
+    def delete(self, ids=None, where=None):
+        """
+        Deletes records by ID and/or where clause. Like Chroma, refuses a
+        call with neither, so a caller bug cannot empty the collection.
+        """
+        if ids is None and not where:
+            raise ValueError("delete() needs ids or a where clause")
+        sql, params = where_sql(where)
+        with self.lock, self.conn:
+            if ids is None:
+                self.conn.execute(f"DELETE FROM records WHERE {sql}", params)
+                return
+            ids = list(ids)
+            for start in range(0, len(ids), 500):
+                part = ids[start:start + 500]
+                placeholders = ','.join('?' for _ in part)
+                self.conn.execute(f"DELETE FROM records WHERE id IN ({placeholders}) AND {sql}",
+                                  part + params)
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=('documents', 'metadatas')):
+        """
+        Records by ID and/or where clause, in storage order.
+        """
+        sql, params = where_sql(where)
+        if ids is not None:
+            ids = list(ids)
+            if not ids:
+                return {'ids': [], 'documents': [], 'metadatas': [], 'embeddings': []}
+            sql += f" AND id IN ({','.join('?' for _ in ids)})"
+            params = params + ids
+        query = f"SELECT id, row, document, metadata FROM records WHERE {sql} ORDER BY row"
+        if limit is not None or offset:
+            query += " LIMIT ? OFFSET ?"
+            params = params + [limit if limit is not None else -1, offset or 0]
+        with self.lock:
+            records = self.conn.execute(query, params).fetchall()
+            matrix = self._matrix_view() if 'embeddings' in include else None
+
+        result = {
+            'ids': [record[0] for record in records],
+            'documents': [record[2] for record in records] if 'documents' in include else None,
+            'metadatas': [json.loads(record[3]) for record in records] if 'metadatas' in include else None,
+            'embeddings': None,
+        }
+        if matrix is not None and records:
+            rows = self.np.array([record[1] for record in records])
+            result['embeddings'] = self._decode(matrix[rows]).tolist()
+        elif 'embeddings' in include:
+            result['embeddings'] = []
+        return result
+
+    def query(self, query_embeddings, n_results=10, where=None,
+              include=('documents', 'metadatas', 'distances')):
+        """
+        Exact cosine top-k for each query vector over the records that
+        match 'where'. Returns Chroma-style nested lists, best first, with
+        cosine distances (1 - similarity).
+        """
+        queries = self._normalize(query_embeddings)
+        sql, params = where_sql(where)
+        with self.lock:
+            candidates = self.conn.execute(
+                f"SELECT row FROM records WHERE {sql} ORDER BY row", params
+            ).fetchall()
+            matrix = self._matrix_view()
+
+        if not candidates or matrix is None:
+            return {key: [[] for _ in queries] for key in ('ids', 'documents', 'metadatas', 'distances')}
+        if queries.shape[1] != self.dim:
+            raise ValueError(f"Query dimension {queries.shape[1]} does not match collection "
+                             f"dimensionality {self.dim}.")
+
+        rows = self.np.array([candidate[0] for candidate in candidates], dtype=self.np.int64)
+        scores = self.np.empty((len(rows), len(queries)), dtype=self.np.float32)
+        for start in range(0, len(rows), QUERY_BLOCK_ROWS):
+            block = rows[start:start + QUERY_BLOCK_ROWS]
+            scores[start:start + len(block)] = self._decode(matrix[block]) @ queries.T
+
+        k = min(n_results, len(rows))
+        top = self.np.argpartition(-scores, k - 1, axis=0)[:k]
+        best = []
+        for q in range(len(queries)):
+            order = top[self.np.argsort(-scores[top[:, q], q]), q]
+            best.append([(int(rows[i]), float(scores[i, q])) for i in order])
+
+        wanted = sorted({row for hits in best for row, _ in hits})
+        by_row = {}
+        with self.lock:
+            for start in range(0, len(wanted), 500):
+                part = wanted[start:start + 500]
+                placeholders = ','.join('?' for _ in part)
+                for record_id, row, document, metadata in self.conn.execute(
+                    f"SELECT id, row, document, metadata FROM records WHERE row IN ({placeholders})", part
+                ):
+                    by_row[row] = (record_id, document, json.loads(metadata))
+
+        hits = [[(by_row[row], score) for row, score in query_hits if row in by_row]
+                for query_hits in best]
+        return {
+            'ids': [[record[0] for record, _ in query_hits] for query_hits in hits],
+            'documents': [[record[1] for record, _ in query_hits] for query_hits in hits],
+            'metadatas': [[record[2] for record, _ in query_hits] for query_hits in hits],
+            'distances': [[1.0 - score for _, score in query_hits] for query_hits in hits],
+        }
+
+    def modify(self, name=None, metadata=None):
+        """
+        Renames the collection and/or replaces its metadata.
+        """
+        with self.lock:
+            if metadata is not None:
+                with self.conn:
+                    self.conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('metadata', ?)",
+                                      (json.dumps(metadata),))
+                self.metadata = metadata
+            if name is not None and name != self.name:
+                self.conn.close()
+                self._matrix = None
+                os.rename(self.client._collection_path(self.name), self.client._collection_path(name))
+                self.name = name
+                self._open()